@@ -1,14 +1,10 @@
 #!/usr/bin/python3
 
 import argparse
-import requests
-import json
 import os
-import teamsenum.auth
-import time
-import threading
-from teamsenum.auth import p_success, p_err, p_warn, p_normal, p_info
-from teamsenum.enum import TeamsUserEnumerator
+import teamsenum.console
+import teamsenum.endpoints
+from teamsenum.utils import p_err, p_warn, p_info
 
 def banner(__version__):
    print(r"""
@@ -26,9 +22,14 @@ def banner(__version__):
 def enumerate_user(enum, email, accounttype, presence, outfile):
    enum.check_user(email.strip(), accounttype, presence=presence, outfile=outfile)
 
+def enumerate_users(enum, emails, accounttype, presence, outfile):
+   enum.check_users(emails, accounttype, presence=presence, outfile=outfile)
+
 def enumerate_guid(enum, guid, outfile):
    enum.check_guid(guid.strip(), outfile=outfile)
 
+def enumerate_guids(enum, guids, outfile):
+   enum.check_guids(guids, outfile=outfile)
 
 if __name__ == "__main__":
    """
@@ -48,30 +49,106 @@ if __name__ == "__main__":
    parser.add_argument('-a', '--authentication', dest='authentication', choices=['devicecode','password','token','credfile'], required=True, help='')
    parser.add_argument('-u', '--username', dest='username', type=str, required=False,  help='Username for authentication')
    parser.add_argument('-p', '--password', dest='password', type=str, required=False, help='Password for authentication')
-   parser.add_argument('-o', '--outfile', dest='outfile', type=str, required=False, help='File to write the results to')
+   parser.add_argument('--lookup-cache', dest='lookup_cache', type=str, required=False, help='SQLite file that caches the account type of the username and the tenant ID of its domain between runs. May be the same file as --cache')
+   parser.add_argument('--lookup-ttl', dest='lookup_ttl', type=int, required=False, default=86400, help='Time in [s] after which cached account types and tenant IDs are looked up again. Default: 86400 (1 day)')
+   parser.add_argument('--token-cache', dest='token_cache', type=str, required=False, help='Encrypted file that keeps the MSAL tokens between runs, so device code and password logins are only needed once. The key is read from the environment variable TEAMSENUM_TOKEN_CACHE_KEY or stored in <file>.key')
+   parser.add_argument('-o', '--outfile', dest='outfile', type=str, required=False, help='File to write the results to. Files ending with .gz or .zst are compressed')
+
+   parser.add_argument('--format', dest='format', choices=['jsonl','parquet'], required=False, default='jsonl', help='Format of the outfile. parquet writes presence observations as typed columns (-g or --presence-only, requires pyarrow). Default: jsonl')
 
    parser.add_argument('-d', '--devicecode', dest='devicecode', type=str, required=False, help='Use Device code authentication flow')
 
    parser.add_argument('-s', '--skypetoken',  dest='skypetoken',  type=str, required=False, help='Skype specific token from X-Skypetoken header. Only required for personal accounts')
    parser.add_argument('-t', '--accesstoken', dest='bearertoken', type=str, required=False,  help='Bearer token from Authorization: Bearer header. Required by teams and live.com accounts')
 
-   parser.add_argument('--delay', dest='delay', type=int, required=False, default=0, help='Delay in [s] between each attempt. Default: 0')
+   parser.add_argument('--delay', dest='delay', type=float, required=False, default=0, help='Delay in [s] between each attempt, e.g. 0.2. Default: 0')
+   parser.add_argument('--rate', dest='rate', type=float, required=False, default=0, help='Maximum number of requests per second across all threads, e.g. 20 or 0.5. Throttled requests (HTTP 429/503) are repeated after their Retry-After and reduce the number of requests in flight until the endpoint recovers. Default: 0 (no limit)')
 
    parser_inputdata_group = parser.add_mutually_exclusive_group(required=True)
    parser_inputdata_group.add_argument('-e', '--targetemail', dest='email', type=str, required=False, help='Single target email address')
-   parser_inputdata_group.add_argument('-f', '--file', dest='file', type=str, required=False, help='Input file containing a list of target email addresses')
-   parser_inputdata_group.add_argument('-g', '--guids', dest='guids', type=str, required=False, help='Input file containing a list of user Object ID GUIDs')
-
-   parser.add_argument('-n', '--threads', dest='num_threads', type=int, required=False, default=7, help='Number of threads to use for enumeration. Default: 7')
+   parser_inputdata_group.add_argument('-f', '--file', dest='file', type=str, required=False, help='Input file containing a list of target email addresses. Accepts gzip-compressed files and - for stdin')
+   parser_inputdata_group.add_argument('-g', '--guids', dest='guids', type=str, required=False, help='Input file containing a list of user Object ID GUIDs. Accepts gzip-compressed files and - for stdin')
+
+   parser.add_argument('--dedupe', dest='dedupe', choices=['exact','bloom','off'], required=False, default='exact', help='Duplicate detection for input files. bloom uses a fixed amount of memory, but may skip a small fraction of targets. Default: exact')
+   parser.add_argument('--dedupe-capacity', dest='dedupe_capacity', type=int, required=False, default=10000000, help='Expected number of targets, used to size the bloom filter. Default: 10000000')
+   parser.add_argument('--resume', dest='resume', type=str, required=False, help='Journal file of completed targets. Targets listed in the journal are skipped and completed targets are appended, so an interrupted run can be continued')
+   parser.add_argument('--cache', dest='cache', type=str, required=False, help='SQLite file used to cache user lookups between runs')
+   parser.add_argument('--cache-ttl', dest='cache_ttl', type=int, required=False, default=604800, help='Time in [s] after which cached user lookups are refreshed. Default: 604800 (7 days)')
+   parser.add_argument('--cache-size', dest='cache_size', type=int, required=False, default=1000000, help='Maximum number of cached user lookups. The least recently used entries are evicted first. Default: 1000000')
+   parser.add_argument('--refresh', dest='refresh', action='store_true', help='Ignore cached user lookups, but update the cache with fresh results')
+   parser.add_argument('--mri-index', dest='mri_index', type=str, required=False, help='SQLite file that maps email addresses to MRIs. Filled by every user lookup')
+   parser.add_argument('--presence-only', dest='presence_only', action='store_true', help='Only check the presence of users that are already in the MRI index, instead of looking them up again. Requires --mri-index')
+   parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, required=False, default=1, help='Number of targets to query per request. Applies to presence lookups (-g) and personal account lookups (-f). Default: 1')
+   parser.add_argument('-n', '--threads', dest='num_threads', type=int, required=False, default=7, help='Number of threads to use for enumeration. With the async engine, the number of requests kept in flight. Default: 7')
+   parser.add_argument('--retries', dest='retries', type=int, required=False, default=1, help='Number of times a target is retried after an error, with a jittered backoff. The async engine only retries timeouts, connection and server errors. Default: 1')
+   parser.add_argument('--request-retries', dest='request_retries', type=int, required=False, default=2, help='Number of times a single request is retried after a timeout, a connection error or a server error, with exponential jittered backoff. Default: 2')
+   parser.add_argument('--timeout', dest='timeouts', action='append', metavar='NAME=CONNECT,READ', required=False, help='Connect and read timeout in [s] of an endpoint category (%s), e.g. presence=3,5. Can be given multiple times. Default: %s' % (", ".join(teamsenum.endpoints.DEFAULT_TIMEOUTS), " ".join("%s=%g,%g" % ((name,) + timeout) for name, timeout in teamsenum.endpoints.DEFAULT_TIMEOUTS.items())))
+   parser.add_argument('--failed-file', dest='failed_file', type=str, required=False, help='File to which targets are appended that still fail after all retries. It can be used as input file (-f or -g) of a later run')
+   parser.add_argument('--engine', dest='engine', choices=['threads','async'], required=False, default='threads', help='Enumeration engine. The async engine requires aiohttp. Default: threads')
+   parser.add_argument('--region', dest='region', choices=teamsenum.endpoints.REGIONS + ['auto'], required=False, default=None, help='Teams middle tier region. auto selects the region with the lowest latency. Default: emea')
+   parser.add_argument('--endpoint', dest='endpoints', action='append', metavar='NAME=URL', required=False, help='Overrides the base URL of an endpoint (%s). Can be given multiple times' % (", ".join(teamsenum.endpoints.DEFAULT_ENDPOINTS)))
+   parser.add_argument('--endpoints-config', dest='endpoints_config', type=str, required=False, help='Configuration file with an [endpoints] section of base URLs and an optional region')
+   parser.add_argument('--schedule', dest='schedule', type=int, choices=[15,30], required=False, help='Run as a daemon that repeats the enumeration of the input file every 15 or 30 minutes, aligned to the quarter or half hour. Tokens and connections are reused between sweeps')
    parser.add_argument("-v", "--verbose", help="enable verbose output", action='store_true')
-   parser.add_argument("-db", "--database", help="enable logging to remote database (optional connection string)", type=str, nargs='?', const='db.conf', default=None)
+   parser.add_argument('--log-level', dest='log_level', choices=list(teamsenum.console.LEVELS), required=False, default='info', help='Console messages below this level are not shown. -v is the same as --log-level debug. Default: info')
+   parser.add_argument("-db", "--database", help="enable logging to a MySQL or SQLite database (optional path of the configuration file, default: db.conf)", type=str, nargs='?', const='db.conf', default=None)
+   parser.add_argument("--db-batch-size", dest='db_batch_size', type=int, required=False, default=500, help='Number of rows per table that are written to the database at once. Default: 500')
+   parser.add_argument("--db-flush-interval", dest='db_flush_interval', type=float, required=False, default=2.0, help='Time in [s] after which buffered rows are written to the database. Default: 2')
+   parser.add_argument("--rollup", dest='rollup', action='store_true', help='Maintain the daily_stats_detailed and daily_stats_summary tables while presence rows are logged. Requires -db')
+   parser.add_argument("--rollup-interval", dest='rollup_interval', type=float, required=False, default=60, help='Time in [s] between two updates of the daily statistics. Default: 60')
+   parser.add_argument("--changes-only", dest='changes_only', action='store_true', help='Only log presence rows that differ from the last logged state of the GUID, plus a heartbeat row. Requires -db')
+   parser.add_argument("--heartbeat", dest='heartbeat', type=int, required=False, default=3600, help='Time in [s] after which an unchanged presence state is logged again with --changes-only. Default: 3600')
    parser.add_argument("-se", "--session", help="add a session name/tag for remote database (8 char max)", type=str, nargs='?', default='default')
 
    args = parser.parse_args()
    session = "default"
 
+   teamsenum.console.set_level('debug' if args.verbose else args.log_level)
+
+   if args.presence_only and not args.mri_index:
+      p_warn("--presence-only requires an MRI index (--mri-index)", exit=True)
+
+   if args.schedule and (args.email or args.resume or (args.file or args.guids) == "-"):
+      p_warn("--schedule requires an input file (-f or -g) that can be read again, and can't be combined with --resume", exit=True)
+
+   if args.token_cache and args.authentication not in ("devicecode", "password"):
+      p_warn("--token-cache requires device code or password-based authentication", exit=True)
+
+   if args.token_cache:
+      import importlib.util
+      if importlib.util.find_spec("cryptography") is None:
+         p_warn("--token-cache requires the cryptography package. Install it with: pip3 install cryptography", exit=True)
+
+   if args.delay < 0 or args.rate < 0:
+      p_warn("--delay and --rate can't be negative", exit=True)
+
+   if (args.rollup or args.changes_only) and not args.database:
+      p_warn("--rollup and --changes-only require database logging (-db)", exit=True)
+
+   if args.format == "parquet" and not (args.outfile and (args.guids or args.presence_only)):
+      p_warn("--format parquet requires an outfile (-o) and a presence sweep (-g or --presence-only)", exit=True)
+
+   if args.engine == "async":
+      try:
+         import teamsenum.aio
+      except ImportError:
+         p_warn("The async engine requires the aiohttp package. Install it with: pip3 install aiohttp", exit=True)
+
+   # Modules that load requests are only imported once the arguments are valid, so --help and usage errors return right away.
+   # MSAL, the database drivers and the optional sinks are imported further down, when they are selected
+   import teamsenum.auth
+   import teamsenum.transport
+   import teamsenum.utils
+   from teamsenum.enum import TeamsUserEnumerator
+   from teamsenum.workers import WorkerPool
+   from teamsenum.inputs import read_targets, batched
+   from teamsenum.journal import Journal, FailedTargets
+   from teamsenum.schedule import Scheduler
+   from teamsenum.ratelimit import RateLimiter
+   from teamsenum.output import WriterError
+
    if args.outfile:
-      fd = teamsenum.utils.open_file(args.outfile)
+      fd = teamsenum.utils.open_file(args.outfile, args.format)
    else:
       fd = None
 
@@ -91,71 +168,172 @@ if __name__ == "__main__":
          try:
             #this can take a value of filename
             #check_db_conf()
-            print("DB LOGGING = TRUE")
+            p_info("DB LOGGING = TRUE")
             #db_logging = True
             db_logging = db_file
          except:
             db_logging = False
+      else:
+         p_warn("Database configuration file %s does not exist" % (db_file), exit=True)
    else:
-      print("DB LOGGING = FALSE")
+      p_info("DB LOGGING = FALSE")
       db_logging = False
 
 
    if args.authentication == "credfile":
       # check for the file specified
       if not os.path.isfile(args.authentication):
-         print(f"Error: credfile does not exist at {args.authentication}")
+         p_err(f"Error: credfile does not exist at {args.authentication}")
          exit
 
 
+   db_writer = None
+   if db_logging:
+      db_config = teamsenum.utils.check_db_conf(db_logging)
+      if db_config is None:
+         p_warn("Invalid database configuration in %s" % (db_logging), exit=True)
+      from teamsenum.storage import DatabaseWriter, PresenceChanges
+      from teamsenum.rollup import Rollup
+      try:
+         rollup = Rollup(args.rollup_interval) if args.rollup else None
+         changes = PresenceChanges(args.heartbeat) if args.changes_only else None
+         db_writer = DatabaseWriter(db_config, args.db_batch_size, args.db_flush_interval, rollup=rollup, changes=changes)
+      except Exception as err:
+         p_warn("Unable to connect to the database: %s" % (err), exit=True)
+
+   journal = None
+   if args.resume:
+      journal = Journal(args.resume)
+      if journal.num_completed:
+         p_info("Resuming run. Skipping %d targets that were already completed" % (journal.num_completed))
+
+   # Keep one idle connection per worker thread, so every thread can reuse an established TLS session
+   http = teamsenum.transport.get_pool(args.num_threads)
+   limiter = RateLimiter(args.rate, args.num_threads)
+   http.limiter = limiter
+   http.policy = teamsenum.transport.RetryPolicy(args.request_retries)
+   try:
+      http.timeouts.update(teamsenum.endpoints.parse_timeouts(args.timeouts))
+   except ValueError as err:
+      p_warn(str(err), exit=True)
+
+   # Endpoint settings from the command line take precedence over the configuration file
+   region, overrides = teamsenum.endpoints.load_config(args.endpoints_config) if args.endpoints_config else (None, {})
+   overrides.update(teamsenum.endpoints.parse_overrides(args.endpoints))
+   region = args.region or region or teamsenum.endpoints.DEFAULT_REGION
+   endpoints = teamsenum.endpoints.Endpoints(overrides, teamsenum.endpoints.DEFAULT_REGION if region == "auto" else region)
+   if region == "auto":
+      p_info("Selected region %s" % (endpoints.probe_region(http)))
+   elif region not in teamsenum.endpoints.REGIONS:
+      p_warn("Unknown region %s. Valid regions: %s" % (region, ", ".join(teamsenum.endpoints.REGIONS)), exit=True)
+   teamsenum.endpoints.set_endpoints(endpoints)
+
+   lookup_cache = None
+   if args.lookup_cache:
+      from teamsenum.cache import LookupCache
+      lookup_cache = LookupCache(args.lookup_cache, args.lookup_ttl)
+      teamsenum.auth.set_lookup_cache(lookup_cache)
+
    accounttype, bearertoken, skypetoken, teams_enrolled, refresh_token, auth_app, auth_metadata = teamsenum.auth.do_logon(args)
-   enum = TeamsUserEnumerator(skypetoken, bearertoken, teams_enrolled, refresh_token, auth_app, auth_metadata, db_logging, session)
-
-
-   if args.email or args.file:
-      if args.email:
-         emails = [args.email]
-
-      if args.file:
-         with open(args.file) as f:
-            emails = f.readlines()
-
-      p_info("Starting user enumeration\n")
-      threads = []
-      for email in emails:
-         time.sleep(args.delay)
-         thread = threading.Thread(target=enumerate_user, args=(enum, email, accounttype, True, fd))
-         threads.append(thread)
-         thread.start()
-
-         # Limit the number of active threads
-         if len(threads) >= args.num_threads:
-            for t in threads:
-               t.join()
-            threads = []
-
-   if args.guids:
-      with open(args.guids) as f:
-         guids = f.readlines()
-
-      p_info("Starting user enumeration\n")
-      threads = []
-      for guid in guids:
-         time.sleep(args.delay)
-         thread = threading.Thread(target=enumerate_guid, args=(enum, guid, fd))
-         threads.append(thread)
-         thread.start()
-
-         # Limit the number of active threads
-         if len(threads) >= args.num_threads:
-            for t in threads:
-               t.join()
-            threads = []
-
-
-   # Wait for the remaining threads to finish
-   for thread in threads:
-      thread.join()
-
-   if fd:
-      fd.close()
+   if args.cache or args.mri_index:
+      from teamsenum.cache import ResultCache, MriIndex
+   cache = ResultCache(args.cache, args.cache_ttl, args.cache_size) if args.cache else None
+   mri_index = MriIndex(args.mri_index) if args.mri_index else None
+   enum = TeamsUserEnumerator(skypetoken, bearertoken, teams_enrolled, refresh_token, auth_app, auth_metadata, db_logging, session, http=http, cache=cache, refresh=args.refresh, mri_index=mri_index, presence_only=args.presence_only, db_writer=db_writer, endpoints=endpoints)
+
+
+   on_done = journal.record if journal else None
+   failed = FailedTargets(args.failed_file) if args.failed_file else None
+   on_failed = failed.record if failed else None
+
+   # Renew the bearer token before it expires, instead of waiting for requests to be rejected
+   enum.tokens.start()
+
+   def sweep():
+      """
+      Reads the targets and enumerates them once. Input files are read again for every scheduled sweep
+
+      Returns:
+         Summary (dict): Summary of the thread engine, or None
+      """
+      if args.email or args.file:
+         if args.email:
+            emails = [args.email]
+
+         if args.file:
+            emails = read_targets(args.file, args.dedupe, args.dedupe_capacity)
+
+         if journal:
+            emails = journal.skip(emails)
+
+         if args.batch_size > 1 and (accounttype == "personal" or args.presence_only):
+            # Group the addresses, so that each worker performs a single searchUsers (or presence) request for a whole batch
+            items = batched(emails, args.batch_size)
+            worker = lambda enum, batch: enumerate_users(enum, batch, accounttype, True, fd)
+            job = lambda engine, batch: engine.check_users(batch, accounttype, presence=True)
+         else:
+            items = emails
+            worker = lambda enum, email: enumerate_user(enum, email, accounttype, True, fd)
+            job = lambda engine, email: engine.check_user(email.strip(), accounttype, presence=True)
+
+      if args.guids:
+         guids = read_targets(args.guids, args.dedupe, args.dedupe_capacity)
+
+         if journal:
+            guids = journal.skip(guids)
+
+         if args.batch_size > 1:
+            # Group the GUIDs, so that each worker performs a single presence request for a whole batch
+            items = batched(guids, args.batch_size)
+            worker = lambda enum, batch: enumerate_guids(enum, batch, fd)
+            job = lambda engine, batch: engine.check_guids(batch)
+         else:
+            items = guids
+            worker = lambda enum, guid: enumerate_guid(enum, guid, fd)
+            job = lambda engine, guid: engine.check_guid(guid)
+
+      if args.engine == "async":
+         teamsenum.aio.run_async(enum, items, job, args.num_threads, args.delay, fd, on_done, limiter, on_failed, args.retries)
+      else:
+         pool = WorkerPool(lambda item: worker(enum, item), args.num_threads, args.delay, args.retries, on_done, on_failed, http.policy)
+         return pool.run(items)
+
+   p_info("Starting user enumeration\n")
+   try:
+      if args.schedule:
+         Scheduler(args.schedule).run(sweep)
+      else:
+         sweep()
+   finally:
+      enum.tokens.stop()
+      if limiter.throttled:
+         p_info("Throttled responses: %d" % (limiter.throttled))
+      if enum.presence_failures:
+         p_warn("The presence lookup of %d found users was rejected. They were reported without presence" % (enum.presence_failures))
+      if journal:
+         journal.close()
+      if failed:
+         if failed.count:
+            p_warn("%d failed targets were written to %s" % (failed.count, failed.filename))
+         failed.close()
+      if cache:
+         p_info("Cache: %d hits, %d misses" % (cache.hits, cache.misses))
+         cache.close()
+      if mri_index:
+         mri_index.close()
+      if lookup_cache:
+         lookup_cache.close()
+      if db_writer:
+         db_writer.close()
+      if fd:
+         try:
+            fd.close()
+         except WriterError as err:
+            p_err("The output file %s is incomplete. %s" % (fd.filename, err))
+         if getattr(fd, 'skipped', 0):
+            p_warn("%d user lookup results don't fit the Parquet presence schema and were not written" % (fd.skipped))
+
+   stats = http.stats()
+   p_info("HTTP: %d requests over %d connections (%d reused, %d retried)" % (stats.get('requests'), stats.get('connections'), stats.get('reused'), stats.get('retried')))
+   http.close()
+   teamsenum.console.flush()
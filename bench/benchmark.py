@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+"""
+End-to-end throughput benchmark of the enumeration engines against the local mock server.
+Each engine and thread count runs in its own process, so that the reported peak RSS belongs to a single configuration.
+
+   python3 bench/benchmark.py --engines threads,async --threads 7,32,128 --targets 2000 --mode guids --batch-size 10
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mock_server
+
+def make_targets(mode, count):
+   if mode == "guids":
+      return [str(uuid.uuid5(uuid.NAMESPACE_OID, "bench-%d" % (i))) for i in range(count)]
+   return ["user%d@bench.local" % (i) for i in range(count)]
+
+def percentile(values, p):
+   if not values:
+      return 0
+   values = sorted(values)
+   index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+   return values[index]
+
+def local_enumerator(base_url, threads, account_type):
+   from teamsenum.enum import TeamsUserEnumerator
+   from teamsenum.endpoints import Endpoints, DEFAULT_ENDPOINTS
+   from teamsenum.transport import HttpPool
+
+   # Every endpoint is served by the mock server
+   endpoints = Endpoints({name: base_url for name in DEFAULT_ENDPOINTS})
+   skypetoken = "bench-skypetoken" if account_type == "personal" else None
+   return TeamsUserEnumerator(skypetoken, "bench-token", True, None, None, {}, False, "bench", http=HttpPool(threads), endpoints=endpoints)
+
+def run_one(args):
+   """
+   Runs a single configuration and prints its result as JSON on the last line of stdout
+   """
+   from teamsenum.console import flush
+   from teamsenum.inputs import batched
+   from teamsenum.workers import WorkerPool
+
+   enum = local_enumerator(args.base_url, args.threads, args.account_type)
+   targets = make_targets(args.mode, args.targets)
+   items = list(batched(targets, args.batch_size)) if args.batch_size > 1 else targets
+
+   if args.mode == "guids":
+      check = (lambda item: enum.check_guids(item)) if args.batch_size > 1 else (lambda item: enum.check_guid(item))
+      acheck = (lambda engine, item: engine.check_guids(item)) if args.batch_size > 1 else (lambda engine, item: engine.check_guid(item))
+   else:
+      check = (lambda item: enum.check_users(item, args.account_type, presence=True)) if args.batch_size > 1 else (lambda item: enum.check_user(item, args.account_type, presence=True))
+      acheck = (lambda engine, item: engine.check_users(item, args.account_type, presence=True)) if args.batch_size > 1 else (lambda engine, item: engine.check_user(item, args.account_type, presence=True))
+
+   latencies = []
+
+   def worker(item):
+      start = time.perf_counter()
+      check(item)
+      latencies.append(time.perf_counter() - start)
+
+   async def job(engine, item):
+      start = time.perf_counter()
+      await acheck(engine, item)
+      latencies.append(time.perf_counter() - start)
+
+   with open(os.devnull, "w") as devnull:
+      start = time.perf_counter()
+      with contextlib.redirect_stdout(devnull):
+         if args.engine == "async":
+            import teamsenum.aio
+            teamsenum.aio.run_async(enum, items, job, args.threads, 0, devnull)
+         else:
+            WorkerPool(worker, args.threads).run(items)
+         flush()
+      elapsed = time.perf_counter() - start
+
+   stats = enum.http.stats()
+   result = {
+      'engine': args.engine,
+      'threads': args.threads,
+      'batch_size': args.batch_size,
+      'targets': args.targets,
+      'elapsed': round(elapsed, 3),
+      'users_per_sec': round(args.targets / elapsed, 1) if elapsed else 0,
+      'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+      'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+      'rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+      'connections': stats.get('connections')
+   }
+   print(json.dumps(result))
+
+def main(args):
+   config = mock_server.config_from_args(args)
+   server = mock_server.start_server(config)
+   base_url = "http://%s:%d" % server.server_address
+
+   print("%-8s %8s %6s %10s %10s %9s %9s %8s" % ("engine", "threads", "batch", "elapsed_s", "users/s", "p50_ms", "p99_ms", "rss_mb"))
+   for engine in args.engines.split(","):
+      for threads in [int(n) for n in args.threads.split(",")]:
+         command = [sys.executable, os.path.abspath(__file__), "--run-one", "--base-url", base_url,
+                    "--engine", engine, "--threads", str(threads), "--targets", str(args.targets),
+                    "--mode", args.mode, "--account-type", args.account_type, "--batch-size", str(args.batch_size)]
+         process = subprocess.run(command, capture_output=True, text=True)
+         lines = process.stdout.strip().splitlines()
+         if process.returncode != 0 or not lines:
+            print("%-8s %8d   failed: %s" % (engine, threads, (process.stderr.strip().splitlines() or ["no output"])[-1]))
+            continue
+         result = json.loads(lines[-1])
+         print("%-8s %8d %6d %10.2f %10.1f %9.1f %9.1f %8.1f" % (engine, threads, result['batch_size'], result['elapsed'], result['users_per_sec'], result['p50_ms'], result['p99_ms'], result['rss_mb']))
+
+   server.shutdown()
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Throughput benchmark of the TeamsEnum engines against a local mock server")
+   parser.add_argument('--engines', default='threads,async', help='Comma separated engines to benchmark. Default: threads,async')
+   parser.add_argument('--threads', default='7,32,128', help='Comma separated thread counts (requests in flight for the async engine). Default: 7,32,128')
+   parser.add_argument('--targets', type=int, default=1000, help='Number of targets per run. Default: 1000')
+   parser.add_argument('--mode', choices=['users','guids'], default='users', help='Enumerate email addresses (-f) or GUIDs (-g). Default: users')
+   parser.add_argument('--account-type', dest='account_type', choices=['corporate','personal'], default='corporate', help='Account type used for user enumeration. Default: corporate')
+   parser.add_argument('--batch-size', dest='batch_size', type=int, default=1, help='Targets per request, as with -b. Default: 1')
+   parser.add_argument('--run-one', dest='run_one', action='store_true', help=argparse.SUPPRESS)
+   parser.add_argument('--base-url', dest='base_url', help=argparse.SUPPRESS)
+   parser.add_argument('--engine', help=argparse.SUPPRESS)
+   mock_server.add_arguments(parser)
+   args = parser.parse_args()
+
+   if args.run_one:
+      args.threads = int(args.threads)
+      run_one(args)
+   else:
+      main(args)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+"""
+Cold start benchmark of the command line tool. Every scenario runs in fresh interpreters, and the median wall time and the modules
+it loaded are reported. Exits with status 1 if a scenario loads a module it must not load, or exceeds its time budget.
+
+   python3 bench/import_time.py --runs 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only the selected features may load
+HEAVY = ['requests', 'msal', 'mysql.connector', 'sqlite3', 'pyarrow', 'aiohttp', 'zstandard']
+
+# (name, code, modules that must not be loaded)
+SCENARIOS = [
+   ('help', "import runpy, sys; sys.argv = ['TeamsEnum.py', '--help']; runpy.run_path('TeamsEnum.py', run_name='__main__')", HEAVY),
+   ('token auth', "import teamsenum.auth, teamsenum.enum, teamsenum.workers, teamsenum.inputs, teamsenum.journal, teamsenum.ratelimit", ['msal', 'mysql.connector', 'sqlite3', 'pyarrow', 'aiohttp', 'zstandard']),
+   ('database', "import teamsenum.enum, teamsenum.storage, teamsenum.rollup", ['msal', 'mysql.connector', 'pyarrow', 'aiohttp'])
+]
+
+# Appended to every scenario. Prints the loaded modules after the scenario ran, including when it exited, as with --help
+REPORT = """
+import atexit, sys
+atexit.register(lambda: sys.__stderr__.write("MODULES " + " ".join(sorted(sys.modules)) + "\\n"))
+"""
+
+def run_scenario(code):
+   started = time.perf_counter()
+   process = subprocess.run([sys.executable, "-c", REPORT + code], cwd=ROOT, capture_output=True, text=True)
+   elapsed = time.perf_counter() - started
+   modules = set()
+   for line in process.stderr.splitlines():
+      if line.startswith("MODULES "):
+         modules = set(line.split()[1:])
+   return elapsed, modules
+
+def main(args):
+   baseline = statistics.median(run_scenario("pass")[0] for i in range(args.runs))
+   print("Interpreter startup: %.1f ms" % (baseline * 1000))
+   print("%-12s %10s %10s  %s" % ("scenario", "median_ms", "import_ms", "heavy modules"))
+
+   failed = False
+   for name, code, forbidden in SCENARIOS:
+      timings = []
+      modules = set()
+      for i in range(args.runs):
+         elapsed, modules = run_scenario(code)
+         timings.append(elapsed)
+      median = statistics.median(timings)
+      loaded = [module for module in HEAVY if module in modules]
+      violations = [module for module in forbidden if module in modules]
+      print("%-12s %10.1f %10.1f  %s" % (name, median * 1000, (median - baseline) * 1000, ", ".join(loaded) or "-"))
+      if violations:
+         print("   FAIL: loads %s" % (", ".join(violations)))
+         failed = True
+      if args.budget_ms and name == 'help' and (median - baseline) * 1000 > args.budget_ms:
+         print("   FAIL: takes longer than the budget of %d ms" % (args.budget_ms))
+         failed = True
+
+   sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Cold start benchmark of the TeamsEnum command line tool")
+   parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters per scenario. Default: 5')
+   parser.add_argument('--budget-ms', dest='budget_ms', type=float, default=100, help='Maximum import time of --help in [ms] on top of the interpreter startup. 0 disables the check. Default: 100')
+   main(parser.parse_args())
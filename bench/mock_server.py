@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+"""
+Local stand-in for the Teams endpoints used by TeamsEnum. Serves externalsearchv3, searchUsers, getpresence and users/tenants
+with configurable latency, error rates and payload sizes, so the enumeration can be measured without live Microsoft endpoints.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+AVAILABILITIES = ["Available", "Busy", "DoNotDisturb", "Away", "Offline"]
+DEVICES = ["Desktop", "Mobile", "Web", None]
+
+class MockConfig:
+   """ Behaviour of the mock server """
+
+   def __init__(self, latency="fixed", latency_ms=50, latency_sigma=0.5, rate_401=0.0, rate_403=0.0, rate_429=0.0, rate_missing=0.1, rate_ooo=0.05, payload_bytes=0, seed=None):
+      """
+      Args:
+         latency (str): Latency distribution, either 'fixed', 'uniform' (0 to 2x latency_ms) or 'lognormal' (median latency_ms)
+         latency_ms (float): Latency in [ms]
+         latency_sigma (float): Sigma of the lognormal distribution
+         rate_401 (float): Fraction of requests answered with 401
+         rate_403 (float): Fraction of user lookups answered with 403
+         rate_429 (float): Fraction of requests answered with 429
+         rate_missing (float): Fraction of users that don't exist
+         rate_ooo (float): Fraction of presence records with an out-of-office note
+         payload_bytes (int): Padding added to each user profile and presence record
+         seed (int): Seed for the random generator
+      """
+      self.latency = latency
+      self.latency_ms = latency_ms
+      self.latency_sigma = latency_sigma
+      self.rate_401 = rate_401
+      self.rate_403 = rate_403
+      self.rate_429 = rate_429
+      self.rate_missing = rate_missing
+      self.rate_ooo = rate_ooo
+      self.payload_bytes = payload_bytes
+      self.random = random.Random(seed)
+      self.lock = threading.Lock()
+      self.requests = 0
+
+   def delay(self):
+      with self.lock:
+         self.requests += 1
+         if self.latency == "uniform":
+            seconds = self.random.uniform(0, 2 * self.latency_ms) / 1000
+         elif self.latency == "lognormal":
+            seconds = self.random.lognormvariate(0, self.latency_sigma) * self.latency_ms / 1000
+         else:
+            seconds = self.latency_ms / 1000
+      time.sleep(seconds)
+
+   def chance(self, rate):
+      with self.lock:
+         return self.random.random() < rate
+
+def user_profile(email, config):
+   guid = str(uuid.uuid5(uuid.NAMESPACE_DNS, email))
+   name = email.split("@")[0]
+   profile = {
+      "tenantId": str(uuid.uuid5(uuid.NAMESPACE_DNS, email.split("@")[-1])),
+      "isShortProfile": False,
+      "accountEnabled": True,
+      "featureSettings": {"coExistenceMode": "TeamsOnly"},
+      "userPrincipalName": email,
+      "givenName": name,
+      "surname": "Mock",
+      "email": email,
+      "tenantName": "Mock Tenant",
+      "displayName": "%s Mock" % (name),
+      "type": "Federated",
+      "mri": "8:orgid:%s" % (guid),
+      "objectId": guid
+   }
+   if config.payload_bytes:
+      profile["padding"] = "x" * config.payload_bytes
+   return profile
+
+def presence_record(mri, config):
+   availability = config.random.choice(AVAILABILITIES)
+   presence = {
+      "sourceNetwork": "Federated",
+      "availability": availability,
+      "activity": availability,
+      "deviceType": None if availability == "Offline" else config.random.choice(DEVICES),
+      "calendarData": {}
+   }
+   if config.chance(config.rate_ooo):
+      presence["calendarData"] = {
+         "outOfOfficeNote": {"message": "<p>I am out of the office until next week.</p>", "publishTime": "2024-01-01T00:00:00Z", "expiry": "2024-01-08T00:00:00Z"},
+         "isOutOfOffice": True
+      }
+   record = {"mri": mri, "presence": presence, "etagMatch": False, "etag": uuid.uuid4().hex, "status": 20000}
+   if config.payload_bytes:
+      record["padding"] = "x" * config.payload_bytes
+   return record
+
+class MockHandler(BaseHTTPRequestHandler):
+   protocol_version = "HTTP/1.1"
+   # Headers and body are written separately. With Nagle's algorithm, the delayed ACK of the client adds ~40 ms to every keep-alive response
+   disable_nagle_algorithm = True
+   config = MockConfig()
+
+   def reply(self, status, body=None, headers=None):
+      data = json.dumps(body).encode("utf-8") if body is not None else b""
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      for name, value in (headers or {}).items():
+         self.send_header(name, value)
+      self.end_headers()
+      self.wfile.write(data)
+
+   def read_json(self):
+      length = int(self.headers.get("Content-Length", 0))
+      return json.loads(self.rfile.read(length) or b"null")
+
+   def common_errors(self):
+      """ Answers with an injected error. Returns True if an error was sent """
+      self.config.delay()
+      if self.config.chance(self.config.rate_429):
+         self.reply(429, {"error": "Too many requests"}, {"Retry-After": "1"})
+         return True
+      if self.config.chance(self.config.rate_401):
+         self.reply(401, {"error": "Unauthorized"})
+         return True
+      return False
+
+   def do_GET(self):
+      match = re.match(r"^/api/mt/[^/]+/beta/users/([^/]+)/externalsearchv3", self.path)
+      if match:
+         if self.common_errors():
+            return
+         email = match.group(1)
+         if self.config.chance(self.config.rate_403):
+            return self.reply(403, {"errorCode": "Forbidden"})
+         if self.config.chance(self.config.rate_missing):
+            return self.reply(200, [])
+         return self.reply(200, [user_profile(email, self.config)])
+
+      if re.match(r"^/api/mt/[^/]+/beta/users/tenants", self.path):
+         if self.common_errors():
+            return
+         return self.reply(200, [{"tenantId": str(uuid.uuid4()), "userId": str(uuid.uuid4()), "tenantName": "Mock Tenant"}])
+
+      self.reply(404, {"error": "Not found"})
+
+   def do_POST(self):
+      if self.path.startswith("/api/mt/beta/users/searchUsers"):
+         payload = self.read_json()
+         if self.common_errors():
+            return
+         result = {}
+         for email in payload.get("emails", []):
+            if self.config.chance(self.config.rate_missing):
+               result[email] = {"status": "NotFound", "userProfiles": []}
+            else:
+               profile = user_profile(email, self.config)
+               profile["mri"] = "8:live:%s" % (email.split("@")[0])
+               result[email] = {"status": "Success", "userProfiles": [profile]}
+         return self.reply(200, result)
+
+      if self.path.startswith("/v1/presence/getpresence"):
+         payload = self.read_json()
+         if self.common_errors():
+            return
+         return self.reply(200, [presence_record(item.get("mri"), self.config) for item in payload])
+
+      self.reply(404, {"error": "Not found"})
+
+   def log_message(self, format, *args):
+      pass
+
+class MockServer(ThreadingHTTPServer):
+   """ Threading HTTP server with a listen backlog that holds the connection bursts of the benchmark """
+
+   # Read by server_activate() in the constructor. The default of 5 drops SYNs and delays connections by about a second
+   request_queue_size = 1024
+   daemon_threads = True
+
+def start_server(config, host="127.0.0.1", port=0):
+   """
+   Starts the mock server in a background thread
+
+   Args:
+      config (MockConfig): Behaviour of the server
+      host (str): Address to listen on
+      port (int): Port to listen on. 0 picks a free port
+
+   Returns:
+      Server (MockServer): The running server. Its address is available as server.server_address
+   """
+   handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config})
+   server = MockServer((host, port), handler)
+   thread = threading.Thread(target=server.serve_forever, daemon=True)
+   thread.start()
+   return server
+
+def add_arguments(parser):
+   parser.add_argument('--latency', choices=['fixed','uniform','lognormal'], default='fixed', help='Latency distribution. Default: fixed')
+   parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=50, help='Latency in [ms]. Median for lognormal, mean for uniform. Default: 50')
+   parser.add_argument('--latency-sigma', dest='latency_sigma', type=float, default=0.5, help='Sigma of the lognormal latency distribution. Default: 0.5')
+   parser.add_argument('--rate-401', dest='rate_401', type=float, default=0.0, help='Fraction of requests answered with 401. Default: 0')
+   parser.add_argument('--rate-403', dest='rate_403', type=float, default=0.0, help='Fraction of user lookups answered with 403. Default: 0')
+   parser.add_argument('--rate-429', dest='rate_429', type=float, default=0.0, help='Fraction of requests answered with 429. Default: 0')
+   parser.add_argument('--rate-missing', dest='rate_missing', type=float, default=0.1, help='Fraction of users that do not exist. Default: 0.1')
+   parser.add_argument('--payload-bytes', dest='payload_bytes', type=int, default=0, help='Padding added to each user profile and presence record. Default: 0')
+   parser.add_argument('--seed', type=int, default=None, help='Seed for the random generator')
+
+def config_from_args(args):
+   return MockConfig(args.latency, args.latency_ms, args.latency_sigma, args.rate_401, args.rate_403, args.rate_429, args.rate_missing, payload_bytes=args.payload_bytes, seed=args.seed)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Local stand-in for the Teams endpoints")
+   parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default: 127.0.0.1')
+   parser.add_argument('--port', type=int, default=8080, help='Port to listen on. 0 picks a free port. Default: 8080')
+   add_arguments(parser)
+   args = parser.parse_args()
+
+   server = start_server(config_from_args(args), args.host, args.port)
+   print("Mock server listening on http://%s:%d" % server.server_address)
+   sys.stdout.flush()
+   try:
+      while True:
+         time.sleep(3600)
+   except KeyboardInterrupt:
+      server.shutdown()
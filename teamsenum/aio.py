@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+
+import asyncio
+import aiohttp
+from teamsenum.utils import p_warn, p_err
+from teamsenum.transport import TransientError, SimpleResponse
+from teamsenum.endpoints import DEFAULT_TIMEOUTS
+from teamsenum.enum import observation_time, guid_to_mri, PresenceError
+from teamsenum.ratelimit import check_throttled
+
+class AsyncEnumerator:
+   """ asyncio based enumeration engine. Performs the HTTP requests itself and hands the responses to a TeamsUserEnumerator for parsing and output """
+
+   def __init__(self, enum, concurrency=7, outfile=None, limiter=None):
+      """
+      Constructor that wraps an authenticated TeamsUserEnumerator
+
+      Args:
+         enum (TeamsUserEnumerator): Enumerator that holds the tokens and handles the responses
+         concurrency (int): Number of requests that are kept in flight
+         outfile (str): File descriptor for writing the results into an outfile
+         limiter (teamsenum.ratelimit.RateLimiter): Rate limiter that paces all requests
+
+      Returns:
+         None
+      """
+      self.enum = enum
+      self.concurrency = max(1, concurrency)
+      self.outfile = outfile
+      self.limiter = limiter
+      self.http = None
+      self.requests = 0
+      self.connections = 0
+      self.retried = 0
+
+   async def fetch(self, request):
+      """
+      Sends a request that was built by one of the TeamsUserEnumerator *_request methods
+
+      Args:
+         request (dict): Request description with method, url, headers and an optional json payload
+
+      Returns:
+         Response (teamsenum.transport.SimpleResponse): Status code, body and headers of the response. After the last retry, this may be an error response
+
+      Raises:
+         TransientError: If the request timed out or the connection failed on every attempt
+      """
+      # The timeouts and the retry policy are shared with the HTTP pool of the thread engine
+      policy = self.enum.http.policy
+      connect, read = self.enum.http.timeouts.get(request.get('endpoint'), DEFAULT_TIMEOUTS['search'])
+      timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+      for attempt in range(policy.retries + 1):
+         try:
+            response = await self.send_paced(request, timeout)
+         except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            if attempt == policy.retries:
+               raise TransientError("%s %s failed: %s" % (request.get('method'), request.get('url'), str(err) or type(err).__name__)) from err
+         else:
+            if attempt == policy.retries or not policy.retryable(response.status_code, self.limiter is not None):
+               return response
+         self.retried += 1
+         await asyncio.sleep(policy.backoff(attempt))
+
+   async def send_paced(self, request, timeout):
+      if not self.limiter:
+         return await self.send(request, timeout)
+
+      # Throttled requests are sent again once the pause requested by the server is over
+      for attempt in range(self.limiter.max_retries + 1):
+         await self.limiter.acquire_async()
+         response = None
+         try:
+            response = await self.send(request, timeout)
+         finally:
+            throttled = self.limiter.release(response.status_code if response is not None else None, response.headers if response is not None else None)
+         if not throttled:
+            break
+      return response
+
+   async def send(self, request, timeout):
+      async with self.http.request(request.get('method'), request.get('url'), headers=request.get('headers'), json=request.get('json'), timeout=timeout) as response:
+         text = await response.text()
+         return SimpleResponse(response.status, text, response.headers)
+
+   async def refresh_access_token(self, stale=None):
+      # MSAL is synchronous, so the refresh runs in the default executor to keep the event loop responsive
+      loop = asyncio.get_running_loop()
+      return await loop.run_in_executor(None, self.enum.refresh_access_token, stale)
+
+   async def check_user(self, email, type, presence=False):
+      mri = self.enum.indexed_mri(email)
+      if mri:
+         await self.check_teams_guid(mri, self.outfile)
+      elif type == "personal":
+         await self.check_live_users([email], presence)
+      elif type == "corporate":
+         await self.check_teams_user(email, presence)
+
+   async def check_users(self, emails, type, presence=False):
+      mris, emails = self.enum.indexed_mris(emails)
+      if mris:
+         await self.check_guids(mris)
+
+      if type == "personal":
+         await self.check_live_users(emails, presence)
+      elif type == "corporate":
+         for email in emails:
+            await self.check_teams_user(email.strip(), presence)
+
+   async def check_teams_user(self, email, presence=False, recursive_call=False):
+      token = self.enum.bearertoken
+      content = self.enum.cached_response(email, "corporate")
+      if content is None:
+         content = await self.fetch(self.enum.teams_user_request(email))
+         self.enum.store_response(email, "corporate", content)
+
+      if content.status_code == 401:
+         if not recursive_call and await self.refresh_access_token(token):
+            return await self.check_teams_user(email, presence=presence, recursive_call=True)
+         p_warn("Unable to enumerate user. Is the access token valid?", exit=True)
+
+      user = self.enum.process_teams_user(email, content, self.outfile)
+      if user is None:
+         return
+
+      user_presence = None
+      mri = self.enum.presence_mri(user) if presence else None
+      if mri:
+         try:
+            user_presence = await self.check_teams_guid(mri, None)
+         except PresenceError as err:
+            self.enum.record_presence_failure(email, user, err)
+      self.enum.report_teams_user(email, user, user_presence, self.outfile)
+
+   async def check_live_users(self, emails, presence=False):
+      emails = [email.strip() for email in emails if email.strip()]
+      cached, emails = self.enum.cached_live_users(emails)
+      await self.finish_live_users(cached, presence)
+      if not emails:
+         return
+
+      content = await self.fetch(self.enum.live_users_request(emails))
+
+      # Splitting a throttled batch would only multiply the rejected requests
+      check_throttled(content)
+      if content.status_code != 200 and content.status_code != 401 and len(emails) > 1:
+         p_warn("Error: %d for a batch of %d users. Splitting the batch..." % (content.status_code, len(emails)))
+         half = len(emails) // 2
+         await self.check_live_users(emails[:half], presence)
+         await self.check_live_users(emails[half:], presence)
+         return
+
+      await self.finish_live_users(self.enum.process_live_users(emails, content), presence)
+
+   async def finish_live_users(self, users, presence=False):
+      for email, user in users:
+         user_presence = None
+         mri = self.enum.presence_mri(user) if presence else None
+         if mri:
+            try:
+               user_presence = await self.check_teams_guid(mri, self.outfile)
+            except PresenceError as err:
+               self.enum.record_presence_failure(email, user, err)
+         self.enum.report_live_user(email, user, user_presence, self.outfile)
+
+   async def check_guid(self, guid):
+      await self.check_teams_guid(guid.strip(), self.outfile)
+
+   async def check_teams_presence(self, mri, recursive_call=False):
+      token = self.enum.bearertoken
+      content = await self.fetch(self.enum.presence_request(mri))
+      if content.status_code == 401 and not recursive_call and await self.refresh_access_token(token):
+         return await self.check_teams_presence(mri, recursive_call=True)
+      return self.enum.process_presence_response(content)
+
+   async def check_teams_guid(self, guid, outfile):
+      observed = observation_time()
+      if not guid:
+         return
+
+      mri, guid = guid_to_mri(guid)
+      presence = await self.check_teams_presence(mri)
+      if not presence:
+         p_warn("%s - Unable to retrieve presence information" % (guid))
+         return
+
+      self.enum.process_presence_record(guid, presence[0], outfile, observed)
+      return presence
+
+   async def check_guids(self, guids):
+      observed = observation_time()
+      targets = self.enum.presence_targets(guids)
+      if not targets:
+         return
+
+      presence = await self.check_teams_presence([mri for mri, guid in targets.values()])
+      self.enum.process_presence_batch(targets, presence, self.outfile, observed)
+
+   async def worker(self, queue, job, on_done, on_failed, retries):
+      while True:
+         item = await queue.get()
+         try:
+            if item is None:
+               return
+            await self.process(item, job, on_done, on_failed, retries)
+         finally:
+            queue.task_done()
+
+   async def process(self, item, job, on_done, on_failed, retries):
+      for attempt in range(retries + 1):
+         try:
+            await job(self, item)
+            if on_done:
+               on_done(item)
+            return
+         except TransientError as err:
+            if attempt < retries:
+               p_warn("Error while enumerating %s: %s. Retrying..." % (str(item).strip(), err))
+               await asyncio.sleep(self.enum.http.policy.backoff(attempt))
+               continue
+            p_err("Error while enumerating %s: %s" % (str(item).strip(), err))
+         except Exception as err:
+            p_err("Error while enumerating %s: %s" % (str(item).strip(), err))
+         break
+      if on_failed:
+         on_failed(item)
+
+   async def run(self, items, job, delay=0, on_done=None, on_failed=None, retries=0):
+      """
+      Runs the job for every item, keeping a fixed number of jobs in flight.
+      The queue between producer and workers is bounded, so the memory usage doesn't depend on the number of items.
+
+      Args:
+         items (iterable): Targets that are handed to the job one by one
+         job (coroutine function): Called as job(engine, item) for each item
+         delay (float): Delay in [s] between starting two items
+         on_done (function): Called as on_done(item) after an item was enumerated successfully
+         on_failed (function): Called as on_failed(item) after an item failed on its last attempt
+         retries (int): Number of times an item is retried after a transient error
+
+      Returns:
+         None
+      """
+      connector = aiohttp.TCPConnector(limit=self.concurrency)
+      async with aiohttp.ClientSession(connector=connector, trace_configs=[self.trace_config()]) as http:
+         self.http = http
+         queue = asyncio.Queue(maxsize=self.concurrency * 2)
+         workers = [asyncio.create_task(self.worker(queue, job, on_done, on_failed, retries)) for i in range(self.concurrency)]
+
+         for item in items:
+            await queue.put(item)
+            if delay:
+               await asyncio.sleep(delay)
+
+         for worker in workers:
+            await queue.put(None)
+         await asyncio.gather(*workers)
+         self.http = None
+      # Reported together with the requests of the thread engine and of the authentication
+      self.enum.http.add_stats(self.requests, self.connections, self.retried)
+
+   def trace_config(self):
+      """
+      Counts the requests and the newly opened connections of the session
+
+      Returns:
+         Trace configuration (aiohttp.TraceConfig): Configuration for the ClientSession
+      """
+      async def on_request_start(session, context, params):
+         self.requests += 1
+
+      async def on_connection_create_end(session, context, params):
+         self.connections += 1
+
+      trace_config = aiohttp.TraceConfig()
+      trace_config.on_request_start.append(on_request_start)
+      trace_config.on_connection_create_end.append(on_connection_create_end)
+      return trace_config
+
+def run_async(enum, items, job, concurrency=7, delay=0, outfile=None, on_done=None, limiter=None, on_failed=None, retries=0):
+   """
+   Entrypoint of the asyncio engine
+
+   Args:
+      enum (TeamsUserEnumerator): Authenticated enumerator
+      items (iterable): Targets to enumerate
+      job (coroutine function): Called as job(engine, item) for each item
+      concurrency (int): Number of requests that are kept in flight
+      delay (float): Delay in [s] between starting two items
+      outfile (str): File descriptor for writing the results into an outfile
+      on_done (function): Called as on_done(item) after an item was enumerated successfully
+      limiter (teamsenum.ratelimit.RateLimiter): Rate limiter that paces all requests
+      on_failed (function): Called as on_failed(item) after an item failed on its last attempt
+      retries (int): Number of times an item is retried after a transient error
+
+   Returns:
+      None
+   """
+   engine = AsyncEnumerator(enum, concurrency, outfile, limiter)
+   asyncio.run(engine.run(items, job, delay, on_done, on_failed, retries))
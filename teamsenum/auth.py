@@ -1,15 +1,65 @@
 #!/usr/bin/python3
 
-import requests
+from teamsenum.transport import get_pool
+from teamsenum.endpoints import get_endpoints
 import json
+import threading
 from getpass import getpass
-from msal import PublicClientApplication
-from teamsenum.utils import p_success, p_warn, p_err, p_normal, p_info, p_file
+from teamsenum.utils import p_success, p_warn, p_err, p_info, p_debug
+from teamsenum.console import get_console
+
+_lookup_cache = None
+_memo = {}
+_memo_lock = threading.Lock()
+
+def set_lookup_cache(cache):
+   """
+   Sets the persistent cache that is consulted by check_account_type and get_tenant_id
+
+   Args:
+      cache (teamsenum.cache.LookupCache): The cache, or None to only keep lookups in memory
+
+   Returns:
+      None
+   """
+   global _lookup_cache
+   _lookup_cache = cache
+
+def cached_lookup(kind, key, fetch, persist=None):
+   """
+   Returns the result of a lookup from the in-process memo or the persistent cache, and only calls fetch on a miss of both
+
+   Args:
+      kind (str): Type of the lookup, e.g. 'tenant_id'
+      key (str): Key of the lookup. Compared case-insensitively
+      fetch (function): Called as fetch(key) to perform the lookup
+      persist (function): Called with the result. Only results for which it returns True are stored persistently. Defaults to all results
+
+   Returns:
+      Value: Result of the lookup
+   """
+   memo_key = (kind, key.lower())
+   with _memo_lock:
+      if memo_key in _memo:
+         return _memo[memo_key]
+
+   value = _lookup_cache.get(kind, key) if _lookup_cache else None
+   if value is not None:
+      p_debug("Using cached %s of %s" % (kind, key))
+   else:
+      value = fetch(key)
+      if _lookup_cache and value is not None and (persist is None or persist(value)):
+         _lookup_cache.put(kind, key, value)
+
+   with _memo_lock:
+      _memo[memo_key] = value
+   return value
 
 def check_account_type(username):
    """
    Checks whether the user account is a personal or corporate account.
    This information is important since different endpoints and token types are used between those two categories.
+   Accounts that exist are cached, see cached_lookup.
 
    Args:
        username (str): The username that is used for authentication.
@@ -20,6 +70,18 @@ def check_account_type(username):
    if "@" not in username:
       p_warn("Invalid username format", exit=True)
 
+   return cached_lookup('account_type', username, fetch_account_type, persist=lambda account_type: account_type.get('exists'))
+
+def fetch_account_type(username):
+   """
+   Requests the account type of a username from the GetCredentialType endpoint
+
+   Args:
+       username (str): The username that is used for authentication.
+
+   Returns:
+       A JSON structure containing information about the accounts existence, and its type (dict)
+   """
    domain = username.split("@")[-1]
 
    is_microsoft_account = False
@@ -37,7 +99,7 @@ def check_account_type(username):
    }
 
    # Fetch some information about the provided user account
-   content = requests.post("https://login.microsoftonline.com/common/GetCredentialType", headers=headers, json=payload)
+   content = get_pool().post(get_endpoints().url('login', "/common/GetCredentialType"), headers=headers, json=payload, endpoint="auth")
 
    json_content = json.loads(content.text)
    if "IfExistsResult" not in json_content:
@@ -63,6 +125,7 @@ def check_account_type(username):
 def get_tenant_id(username):
    """
    Based on an email address, try to fetch the tenant id if a corporate account is used.
+   The tenant id is cached per domain, see cached_lookup.
 
    Args:
        username (str): The username that is used to check what tenant it belongs to.
@@ -70,8 +133,19 @@ def get_tenant_id(username):
    Returns:
        Tenant-ID (str): ID of the queried tenant
    """
-   domain = username.split("@")[-1]
-   response = requests.get("https://login.microsoftonline.com/%s/.well-known/openid-configuration" % (domain))
+   return cached_lookup('tenant_id', username.split("@")[-1], fetch_tenant_id)
+
+def fetch_tenant_id(domain):
+   """
+   Reads the tenant id of a domain from its OpenID configuration
+
+   Args:
+       domain (str): Domain of the tenant
+
+   Returns:
+       Tenant-ID (str): ID of the queried tenant
+   """
+   response = get_pool().get(get_endpoints().url('login', "/%s/.well-known/openid-configuration" % (domain)), endpoint="auth")
    if response.status_code != 200:
       p_warn("Could not retrieve tenant id for domain %s" % (domain), exit=True)
    json_content = json.loads(response.text)
@@ -97,7 +171,7 @@ def account_is_teams_enrolled(accesstoken, account_type):
    }
 
    # Fetch information about the own user
-   response = requests.get("https://teams.microsoft.com/api/mt/emea/beta/users/tenants", headers=headers)
+   response = get_pool().get(get_endpoints().url('teams', "/api/mt/{region}/beta/users/tenants"), headers=headers, endpoint="auth")
 
    if response.status_code != 200:
       p_warn("Could not retrieve Teams enrollment status for account")
@@ -135,7 +209,7 @@ def get_skype_token(access_token):
    }
 
    # Requests a Skypetoken
-   content = requests.post("https://teams.live.com/api/auth/v1.0/authz/consumer", headers=headers)
+   content = get_pool().post(get_endpoints().url('teams_live', "/api/auth/v1.0/authz/consumer"), headers=headers, endpoint="auth")
 
    if content.status_code != 200:
       p_err("Error: %d" % (content.status_code), exit=True)
@@ -146,7 +220,46 @@ def get_skype_token(access_token):
       p_warn("Could not retrieve Skype token", exit=True)
    return json_content.get("skypeToken").get("skypetoken")
 
-def logon_with_credentials(auth_metadata, username, password, account_type):
+def create_app(auth_metadata, token_cache=None):
+   """
+   Creates the MSAL application for device code or password-based authentication
+
+   Args:
+       auth_metadata (dict): Dict containing scope, client_id and tenant for oauth flow.
+       token_cache (msal.SerializableTokenCache): Token cache, e.g. a teamsenum.tokencache.EncryptedTokenCache. Defaults to an in-memory cache
+
+   Returns:
+       App (msal.application.PublicClientApplication): The application context used to log in
+   """
+   # MSAL is only loaded for interactive logins. Token authentication doesn't need it
+   from msal import PublicClientApplication
+   return PublicClientApplication( auth_metadata.get('client_id'), authority=get_endpoints().url('login', "/%s" % (auth_metadata.get('tenant'))), http_client=get_pool().client("auth"), token_cache=token_cache )
+
+def logon_silently(app, auth_metadata, username):
+   """
+   Attempts to log in with the tokens of a previous run from the token cache, without user interaction
+
+   Args:
+       app (msal.application.PublicClientApplication): The application context, created with a persistent token cache
+       auth_metadata (dict): Dict containing scope, client_id and tenant for oauth flow.
+       username (str): The username to log in
+
+   Returns:
+       Access token (dict): An object containing access tokens, or None if the cache holds no usable token
+   """
+   accounts = app.get_accounts(username=username)
+   if not accounts:
+      return None
+   try:
+      result = app.acquire_token_silent(scopes=[auth_metadata.get('scope')], account=accounts[0])
+   except Exception as err:
+      p_warn("Unable to use the cached login: %s" % (err))
+      return None
+   if result and 'access_token' in result:
+      return result
+   return None
+
+def logon_with_credentials(auth_metadata, username, password, account_type, app=None):
    """
    Attempts to log in to the specified app using the provided credentials and scope.
    This method can't be used with personal accounts.
@@ -156,6 +269,7 @@ def logon_with_credentials(auth_metadata, username, password, account_type):
        username (str): The username to use for authentication.
        password (str): The password to use for authentication.
        account_type (dict): Dict containing information about the user account
+       app (msal.application.PublicClientApplication): The application context. Created if omitted
 
    Returns:
        Access token (dict): An object containing access tokens
@@ -169,10 +283,11 @@ def logon_with_credentials(auth_metadata, username, password, account_type):
    # Ask for the password if not specified on the command line. Otherwise use the provided value
    if password is None:
       p_info("Please enter the password to authenticate:")
+      get_console().flush()
       password = getpass("")
 
    # Initialize MSAL logon sequence only if device code or password-based authentication is used.
-   app = PublicClientApplication( auth_metadata.get('client_id'), authority="https://login.microsoftonline.com/%s" % (auth_metadata.get('tenant')) )
+   app = app if app else create_app(auth_metadata)
 
    result = None
 
@@ -185,18 +300,19 @@ def logon_with_credentials(auth_metadata, username, password, account_type):
       p_warn("Error while acquring token", exit=True)
    return result, app
 
-def logon_with_devicecode(auth_metadata):
+def logon_with_devicecode(auth_metadata, app=None):
    """
    Attempts to log in based on a device code authentication flow. This routine is recommended when using this script on a machine without internet access or when MFA is required.
 
    Args:
        auth_metadata (dict): Dict containing scope, client_id and tenant for oauth flow.
+       app (msal.application.PublicClientApplication): The application context. Created if omitted
 
    Returns:
        Access token (dict): An object containing access tokens
    """
    # Initialize MSAL logon sequence only if device code or password-based authentication is used.
-   app = PublicClientApplication( auth_metadata.get('client_id'), authority="https://login.microsoftonline.com/%s" % (auth_metadata.get('tenant')) )
+   app = app if app else create_app(auth_metadata)
 
    try:
       # Initiate the device code authentication flow and print instruction message
@@ -215,12 +331,13 @@ def logon_with_devicecode(auth_metadata):
 
    return result, app
 
-def logon_with_accesstoken(auth_metadata, app, scope_list=None):
+def logon_with_accesstoken(auth_metadata, app, scope_list=None, force_refresh=False):
    """
    Attempts to log in based on an access token. This step is required to acquire a X-Skypetoken using the previously acquired Bearer token
 
    Args:
        app (msal.application.PublicClientApplication): The application context used to log in.
+       force_refresh (boolean): Redeems the refresh token even if MSAL still caches a valid access token
 
    Returns:
        Access token (dict): An object containing access tokens
@@ -237,7 +354,7 @@ def logon_with_accesstoken(auth_metadata, app, scope_list=None):
    try:
       # Fetches cached logins
       accounts = app.get_accounts()
-      result = app.acquire_token_silent(scopes=scopes, account=accounts[0])
+      result = app.acquire_token_silent(scopes=scopes, account=accounts[0], force_refresh=force_refresh)
    except Exception as err:
       p_warn("Error while authenticating: %s" % (err.args[0]), exit=True)
 
@@ -308,11 +425,15 @@ def do_logon(args):
        Access Token (str): Access token for primary authentication
        Skypetoken (str): Skypetoken, used by personal accounts
        teams_enrolled (boolean): Flag whether the own account is enrolled in Teams
+       Refresh token (str): Refresh token, if one was issued. None for token authentication
+       App (msal.application.PublicClientApplication): MSAL application used to renew the access token. None for token authentication
+       Authentication metadata (dict): Scope, client_id and tenant used during the login
    """
    if args.authentication == "token":
       account_type, accesstoken, skypetoken = check_token_format(args.bearertoken, args.skypetoken)
       teams_enrolled = account_is_teams_enrolled(accesstoken, account_type)
-      return account_type, accesstoken, skypetoken, teams_enrolled
+      # A token that was passed in can't be renewed, so there is no refresh token and no MSAL application
+      return account_type, accesstoken, skypetoken, teams_enrolled, None, None, {}
 
    # If device code or password-based authentication is used, the username needs to be provided to check if the account is a personal or corporate account
    if not args.username:
@@ -331,13 +452,23 @@ def do_logon(args):
       p_warn("Username does not exist", exit=True)
 
    result = None
-
-   # Go to device code login sequence
-   if args.authentication == "devicecode":
-      result, app = logon_with_devicecode( auth_metadata )
-   # Go to password-based login sequence
-   elif args.authentication == "password":
-      result, app = logon_with_credentials( auth_metadata, args.username, args.password, account_type )
+   app = None
+
+   # With a persistent token cache, the refresh token of a previous run is used first, so no interaction is needed
+   if getattr(args, 'token_cache', None):
+      from teamsenum.tokencache import EncryptedTokenCache
+      app = create_app(auth_metadata, EncryptedTokenCache(args.token_cache, args.username, auth_metadata.get('tenant')))
+      result = logon_silently(app, auth_metadata, args.username)
+      if result:
+         p_info("Reusing the cached login of %s" % (args.username))
+
+   if result is None:
+      # Go to device code login sequence
+      if args.authentication == "devicecode":
+         result, app = logon_with_devicecode( auth_metadata, app )
+      # Go to password-based login sequence
+      elif args.authentication == "password":
+         result, app = logon_with_credentials( auth_metadata, args.username, args.password, account_type, app )
 
    # Login not successful
    if "access_token" not in result:
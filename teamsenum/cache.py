@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+import json
+import sqlite3
+import threading
+import time
+from teamsenum.transport import SimpleResponse
+
+def open_database(filename):
+   """
+   Opens a SQLite database for concurrent use by the enumeration threads
+
+   Args:
+      filename (str): Path of the SQLite database
+
+   Returns:
+      Connection (sqlite3.Connection): Connection in WAL mode. Callers serialize access with their own lock
+   """
+   connection = sqlite3.connect(filename, check_same_thread=False)
+   connection.execute("PRAGMA journal_mode=WAL")
+   connection.execute("PRAGMA synchronous=NORMAL")
+   return connection
+
+class ResultCache:
+   """ On-disk cache of user lookup responses, keyed by email address and account type, with a TTL and LRU eviction """
+
+   def __init__(self, filename, ttl=604800, max_entries=1000000):
+      """
+      Constructor that opens (or creates) the cache database
+
+      Args:
+         filename (str): Path of the SQLite database
+         ttl (int): Time in [s] after which a cached response is no longer used
+         max_entries (int): Number of entries after which the least recently used entries are evicted
+
+      Returns:
+         None
+      """
+      self.ttl = ttl
+      self.max_entries = max(1, max_entries)
+      self.lock = threading.Lock()
+      self.connection = open_database(filename)
+      self.connection.execute("""
+         CREATE TABLE IF NOT EXISTS results (
+            email TEXT NOT NULL,
+            account_type TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (email, account_type)
+         )
+      """)
+      self.connection.execute("CREATE INDEX IF NOT EXISTS idx_results_last_used ON results (last_used)")
+      self.connection.commit()
+      self.writes = 0
+      self.hits = 0
+      self.misses = 0
+
+   def get(self, email, account_type):
+      """
+      Looks up a cached response
+
+      Args:
+         email (str): Email address of the user
+         account_type (str): Either 'personal' or 'corporate'
+
+      Returns:
+         Response (teamsenum.transport.SimpleResponse): The cached response, or None if there is no fresh entry
+      """
+      now = time.time()
+      with self.lock:
+         row = self.connection.execute("SELECT status, body, created FROM results WHERE email = ? AND account_type = ?", (email.lower(), account_type)).fetchone()
+         if row is None or now - row[2] > self.ttl:
+            self.misses += 1
+            return None
+         self.connection.execute("UPDATE results SET last_used = ? WHERE email = ? AND account_type = ?", (now, email.lower(), account_type))
+         self.hits += 1
+         self.commit_periodically()
+      return SimpleResponse(row[0], row[1])
+
+   def put(self, email, account_type, status, body):
+      """
+      Stores a response
+
+      Args:
+         email (str): Email address of the user
+         account_type (str): Either 'personal' or 'corporate'
+         status (int): HTTP status code of the response
+         body (str): Body of the response
+
+      Returns:
+         None
+      """
+      now = time.time()
+      with self.lock:
+         self.connection.execute("INSERT OR REPLACE INTO results (email, account_type, status, body, created, last_used) VALUES (?, ?, ?, ?, ?, ?)", (email.lower(), account_type, status, body, now, now))
+         self.commit_periodically()
+
+   def commit_periodically(self):
+      # Committing every write would sync the WAL for each lookup. Commit in batches and check the size limit at the same time
+      self.writes += 1
+      if self.writes % 100 == 0:
+         self.connection.commit()
+      if self.writes % 1000 == 0:
+         self.evict()
+
+   def evict(self):
+      count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+      if count <= self.max_entries:
+         return
+      # Evict down to 90% of the limit, so eviction doesn't run again right away
+      excess = count - int(self.max_entries * 0.9)
+      self.connection.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT ?)", (excess,))
+      self.connection.commit()
+
+   def close(self):
+      with self.lock:
+         self.evict()
+         self.connection.commit()
+         self.connection.close()
+
+class MriIndex:
+   """ Persistent mapping of email addresses to MRIs. The MRI of a user doesn't change, so entries never expire """
+
+   def __init__(self, filename):
+      """
+      Constructor that opens (or creates) the index database
+
+      Args:
+         filename (str): Path of the SQLite database. May be the same file as the result cache
+
+      Returns:
+         None
+      """
+      self.lock = threading.Lock()
+      self.connection = open_database(filename)
+      self.connection.execute("""
+         CREATE TABLE IF NOT EXISTS mri_index (
+            email TEXT NOT NULL PRIMARY KEY,
+            mri TEXT NOT NULL,
+            updated REAL NOT NULL
+         )
+      """)
+      self.connection.commit()
+      self.writes = 0
+
+   def get(self, email):
+      """
+      Looks up the MRI of a user
+
+      Args:
+         email (str): Email address of the user
+
+      Returns:
+         MRI (str): The MRI of the user, or None if it was not resolved yet
+      """
+      with self.lock:
+         row = self.connection.execute("SELECT mri FROM mri_index WHERE email = ?", (email.lower(),)).fetchone()
+      return row[0] if row else None
+
+   def put(self, email, mri):
+      """
+      Stores the MRI of a user
+
+      Args:
+         email (str): Email address of the user
+         mri (str): MRI of the user
+
+      Returns:
+         None
+      """
+      with self.lock:
+         self.connection.execute("INSERT OR REPLACE INTO mri_index (email, mri, updated) VALUES (?, ?, ?)", (email.lower(), mri, time.time()))
+         self.writes += 1
+         if self.writes % 100 == 0:
+            self.connection.commit()
+
+   def close(self):
+      with self.lock:
+         self.connection.commit()
+         self.connection.close()
+
+class LookupCache:
+   """ Persistent cache of login lookups that rarely change, e.g. the tenant ID of a domain or the account type of a username, with a TTL """
+
+   def __init__(self, filename, ttl=86400):
+      """
+      Constructor that opens (or creates) the cache database
+
+      Args:
+         filename (str): Path of the SQLite database. May be the same file as the result cache
+         ttl (int): Time in [s] after which a cached lookup is done again
+
+      Returns:
+         None
+      """
+      self.ttl = ttl
+      self.lock = threading.Lock()
+      self.connection = open_database(filename)
+      self.connection.execute("""
+         CREATE TABLE IF NOT EXISTS lookups (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+         )
+      """)
+      self.connection.commit()
+
+   def get(self, kind, key):
+      """
+      Looks up a cached value
+
+      Args:
+         kind (str): Type of the lookup, e.g. 'tenant_id'
+         key (str): Key of the lookup, e.g. the domain
+
+      Returns:
+         Value (dict, list or str): The cached value, or None if there is no fresh entry
+      """
+      with self.lock:
+         row = self.connection.execute("SELECT value, created FROM lookups WHERE kind = ? AND key = ?", (kind, key.lower())).fetchone()
+      if row is None or time.time() - row[1] > self.ttl:
+         return None
+      return json.loads(row[0])
+
+   def put(self, kind, key, value):
+      """
+      Stores a value. Lookups are rare, so every value is committed right away
+
+      Args:
+         kind (str): Type of the lookup
+         key (str): Key of the lookup
+         value (dict, list or str): JSON-serializable value
+
+      Returns:
+         None
+      """
+      with self.lock:
+         self.connection.execute("INSERT OR REPLACE INTO lookups (kind, key, value, created) VALUES (?, ?, ?, ?)", (kind, key.lower(), json.dumps(value), time.time()))
+         self.connection.commit()
+
+   def close(self):
+      with self.lock:
+         self.connection.close()
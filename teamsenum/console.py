@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+import atexit
+import queue
+import sys
+import threading
+from colorama import Style
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+LEVELS = {
+   'debug': DEBUG,
+   'info': INFO,
+   'warn': WARN,
+   'error': ERROR
+}
+
+class Console:
+   """
+   Leveled console output. Messages are queued by the callers and written by a single background thread,
+   so enumeration threads don't wait for the stdout lock or for a slow terminal.
+   """
+
+   def __init__(self, level=INFO, batch_size=256):
+      """
+      Constructor. The writer thread is started with the first message
+
+      Args:
+         level (int): Messages below this level are dropped
+         batch_size (int): Maximum number of queued messages that are written at once
+
+      Returns:
+         None
+      """
+      self.level = level
+      self.batch_size = max(1, batch_size)
+      self.queue = queue.SimpleQueue()
+      self.thread = None
+      self.start_lock = threading.Lock()
+
+   def enabled(self, level):
+      return level >= self.level
+
+   def emit(self, level, prefix, msg, end="\n"):
+      """
+      Queues a message. Formatting is done by the writer thread, so debug dumps of large structures don't cost the caller anything
+
+      Args:
+         level (int): Level of the message
+         prefix (str): Colored prefix, e.g. '[+] '
+         msg (object): Message. Converted with str() when it is written
+         end (str): Line terminator
+
+      Returns:
+         None
+      """
+      if level < self.level:
+         return
+      if self.thread is None:
+         self.start()
+      self.queue.put((prefix, msg, end))
+
+   def start(self):
+      with self.start_lock:
+         if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+   def run(self):
+      while True:
+         entries = [self.queue.get()]
+         # Write everything that queued up in the meantime with a single write and flush
+         while len(entries) < self.batch_size:
+            try:
+               entries.append(self.queue.get_nowait())
+            except queue.Empty:
+               break
+
+         text = []
+         for entry in entries:
+            if isinstance(entry, threading.Event):
+               self.write("".join(text))
+               text = []
+               entry.set()
+            else:
+               prefix, msg, end = entry
+               text.append("%s%s%s%s" % (prefix, msg, Style.RESET_ALL, end))
+         self.write("".join(text))
+
+   def write(self, text):
+      if not text:
+         return
+      try:
+         sys.stdout.write(text)
+         sys.stdout.flush()
+      except (OSError, ValueError):
+         pass
+
+   def flush(self, timeout=5):
+      """
+      Waits until all queued messages are written. Required before exiting and before prompting for input
+
+      Args:
+         timeout (float): Maximum time in [s] to wait for the writer thread
+
+      Returns:
+         None
+      """
+      if self.thread is None or not self.thread.is_alive() or threading.current_thread() is self.thread:
+         return
+      done = threading.Event()
+      self.queue.put(done)
+      done.wait(timeout)
+
+_console = Console()
+atexit.register(_console.flush)
+
+def get_console():
+   return _console
+
+def set_level(level):
+   """
+   Sets the level below which console messages are dropped
+
+   Args:
+      level (int or str): One of the level constants, or its name ('debug', 'info', 'warn', 'error')
+
+   Returns:
+      None
+   """
+   _console.level = LEVELS.get(level, INFO) if isinstance(level, str) else level
+
+def flush():
+   _console.flush()
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+import configparser
+import threading
+import time
+from teamsenum.utils import p_warn
+
+# Base URLs of the services TeamsEnum talks to. Each one can be overridden, e.g. to send the requests to a local stand-in
+DEFAULT_ENDPOINTS = {
+   'login': "https://login.microsoftonline.com",
+   'teams': "https://teams.microsoft.com",
+   'presence': "https://presence.teams.microsoft.com",
+   'teams_live': "https://teams.live.com",
+   'presence_live': "https://presence.teams.live.com"
+}
+
+# Regional partitions of the Teams middle tier (teams.microsoft.com/api/mt/<region>/...)
+REGIONS = ["emea", "amer", "apac"]
+DEFAULT_REGION = "emea"
+
+# Default (connect, read) timeouts in [s] per endpoint category
+DEFAULT_TIMEOUTS = {
+   'search': (5, 15),
+   'presence': (5, 10),
+   'auth': (10, 30)
+}
+
+class Endpoints:
+   """ Registry of the endpoint base URLs and the Teams middle tier region """
+
+   def __init__(self, overrides=None, region=DEFAULT_REGION):
+      """
+      Constructor that starts from the default endpoints and applies the overrides
+
+      Args:
+         overrides (dict): Base URLs keyed by endpoint name
+         region (str): Teams middle tier region
+
+      Returns:
+         None
+      """
+      self.bases = dict(DEFAULT_ENDPOINTS)
+      self.region = region
+      for name, url in (overrides or {}).items():
+         self.override(name, url)
+
+   def override(self, name, url):
+      """
+      Replaces the base URL of an endpoint
+
+      Args:
+         name (str): Name of the endpoint, one of DEFAULT_ENDPOINTS
+         url (str): New base URL, e.g. http://127.0.0.1:8080
+
+      Returns:
+         None
+      """
+      if name not in DEFAULT_ENDPOINTS:
+         p_warn("Unknown endpoint %s. Valid endpoints: %s" % (name, ", ".join(DEFAULT_ENDPOINTS)), exit=True)
+      self.bases[name] = url.rstrip("/")
+
+   def url(self, name, path):
+      """
+      Builds the URL of a request
+
+      Args:
+         name (str): Name of the endpoint
+         path (str): Path below the base URL, starting with a slash. {region} is replaced by the selected region
+
+      Returns:
+         URL (str): Absolute URL
+      """
+      return self.bases[name] + path.replace("{region}", self.region)
+
+   def probe_region(self, http, regions=REGIONS, attempts=3):
+      """
+      Selects the Teams middle tier region with the lowest round-trip time.
+      Sends unauthenticated requests, so no token is needed. The fastest of several attempts is used per region.
+
+      Args:
+         http (teamsenum.transport.HttpPool): HTTP pool used for the probes
+         regions (str []): Regions to compare
+         attempts (int): Number of probes per region
+
+      Returns:
+         Region (str): The selected region
+      """
+      timings = {}
+      for region in regions:
+         url = self.bases['teams'] + "/api/mt/%s/beta/users/tenants" % (region)
+         best = None
+         for i in range(attempts):
+            start = time.perf_counter()
+            try:
+               http.get(url, timeout=10)
+            except Exception:
+               continue
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+         if best is not None:
+            timings[region] = best
+
+      if timings:
+         self.region = min(timings, key=timings.get)
+      else:
+         p_warn("Unable to reach any Teams region. Using %s" % (self.region))
+      return self.region
+
+def load_config(filename):
+   """
+   Reads endpoint settings from a configuration file with an [endpoints] section, e.g.
+
+      [endpoints]
+      region = amer
+      teams = http://127.0.0.1:8080
+
+   Args:
+      filename (str): Path of the configuration file
+
+   Returns:
+      Region (str): Region from the file, or None
+      Overrides (dict): Base URLs keyed by endpoint name
+   """
+   config = configparser.ConfigParser()
+   if not config.read(filename):
+      p_warn("Endpoint configuration file %s does not exist" % (filename), exit=True)
+   if not config.has_section("endpoints"):
+      p_warn("Missing [endpoints] section in %s" % (filename), exit=True)
+
+   overrides = dict(config.items("endpoints"))
+   region = overrides.pop("region", None)
+   return region, overrides
+
+def parse_overrides(values):
+   """
+   Parses NAME=URL command line overrides
+
+   Args:
+      values (str []): Overrides as given on the command line
+
+   Returns:
+      Overrides (dict): Base URLs keyed by endpoint name
+   """
+   overrides = {}
+   for value in values or []:
+      if "=" not in value:
+         p_warn("Invalid endpoint override %s. Expected NAME=URL" % (value), exit=True)
+      name, url = value.split("=", 1)
+      overrides[name.strip()] = url.strip()
+   return overrides
+
+def parse_timeouts(values):
+   """
+   Parses timeout overrides of the form NAME=CONNECT,READ or NAME=SECONDS
+
+   Args:
+      values (str []): Overrides, e.g. from the command line
+
+   Returns:
+      Timeouts (dict): Tuples of connect and read timeout in [s], keyed by endpoint category
+   """
+   timeouts = {}
+   for value in values or []:
+      name, sep, seconds = value.partition("=")
+      name = name.strip()
+      if not sep or name not in DEFAULT_TIMEOUTS:
+         raise ValueError("Invalid timeout %s. Expected NAME=CONNECT,READ with NAME one of %s" % (value, ", ".join(DEFAULT_TIMEOUTS)))
+      parts = [float(part) for part in seconds.split(",")]
+      if len(parts) == 1:
+         parts = parts * 2
+      if len(parts) != 2 or min(parts) <= 0:
+         raise ValueError("Invalid timeout %s. Expected NAME=CONNECT,READ with positive values" % (value))
+      timeouts[name] = tuple(parts)
+   return timeouts
+
+_default_endpoints = None
+_default_lock = threading.Lock()
+
+def get_endpoints():
+   """
+   Returns the process-wide endpoint registry, creating it with the defaults on first use
+
+   Returns:
+      Endpoints (Endpoints): The shared registry
+   """
+   global _default_endpoints
+   with _default_lock:
+      if _default_endpoints is None:
+         _default_endpoints = Endpoints()
+      return _default_endpoints
+
+def set_endpoints(endpoints):
+   """
+   Replaces the process-wide endpoint registry
+
+   Args:
+      endpoints (Endpoints): The registry used by all subsequent requests
+
+   Returns:
+      None
+   """
+   global _default_endpoints
+   with _default_lock:
+      _default_endpoints = endpoints
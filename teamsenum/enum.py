@@ -1,15 +1,60 @@
 #!/usr/bin/python3
 
 from datetime import datetime, date
-import requests
+from teamsenum.transport import get_pool
+from teamsenum.endpoints import get_endpoints
 import json
-from teamsenum.utils import p_success, p_err, p_warn, p_normal, p_file, remove_html_preserve_newlines, check_db_conf, log_presence_db, log_ooo_db, sanitize_and_truncate, calculate_md5, log_userinfo_db
+import threading
+from teamsenum.utils import p_success, p_warn, p_debug, p_info, p_file, remove_html_preserve_newlines, check_db_conf, sanitize_and_truncate, calculate_md5
 from teamsenum.auth import logon_with_accesstoken
+from teamsenum.console import get_console, DEBUG
+from teamsenum.output import PresenceParquetWriter
+from teamsenum.tokens import TokenManager
+from teamsenum.ratelimit import check_throttled
+
+def guid_to_mri(guid):
+   """
+   Converts an ObjectID GUID into a Teams MRI. Values that already are MRIs are kept as they are.
+
+   Args:
+      guid (str): ObjectID GUID or MRI ('8:orgid:<guid>', '8:sfb:<guid>' or '8:live:<id>') of a user
+
+   Returns:
+      MRI (str): MRI used for the presence lookup
+      GUID (str): Bare GUID without the MRI prefix
+   """
+   if guid.startswith(("8:orgid:", "8:sfb:", "8:live:")):
+      prefix, bare_guid = guid.split(":", 2)[1:]
+      return guid, bare_guid
+   return f"8:orgid:{guid}", guid
+
+def observation_time():
+   """
+   Returns the timestamp information that is stored alongside each presence observation
+
+   Returns:
+      Observation time (dict): Unix time, ISO date and the quarter-hour and half-hour period of the day
+   """
+   now = datetime.now()
+   totalminutes = now.hour * 60 + now.minute
+   return {
+      'unixtime': str(int(now.timestamp())),
+      'currentdate': now.date().isoformat(),
+      'qh_period': totalminutes // 15,
+      'hh_period': totalminutes // 30
+   }
+
+class PresenceError(Exception):
+   """ Raised when the presence endpoint rejects a lookup, so the target fails instead of being counted as done """
+
+   def __init__(self, status_code):
+      super().__init__("Presence lookup failed: HTTP %d" % (status_code))
+      self.status_code = status_code
 
 class TeamsUserEnumerator:
    """ Class that handles enumeration of users that use Microsoft Teams either from a personal, or corporate account  """
 
-   def __init__(self, skypetoken, bearertoken, teams_enrolled, refresh_token, auth_app, auth_metadata, db_logging, session):
+   def __init__(self, skypetoken, bearertoken, teams_enrolled, refresh_token, auth_app, auth_metadata, db_logging, session, http=None, cache=None, refresh=False, mri_index=None, presence_only=False, db_writer=None, endpoints=None, tokens=None):
       """
       Constructor that accepts authentication tokens for use during enumeration
 
@@ -17,29 +62,57 @@ class TeamsUserEnumerator:
          skypetoken (str): Skype access token
          bearertoken (str): Bearer token for Teams
          teams_enrolled (boolean): Flag to indicate whether the own account has a valid Teams subscription
+         http (teamsenum.transport.HttpPool): Keep-alive HTTP pool used for all requests. Defaults to the process-wide pool
+         cache (teamsenum.cache.ResultCache): Optional cache of user lookup responses
+         refresh (boolean): If True, cached responses are not used, but still updated
+         mri_index (teamsenum.cache.MriIndex): Optional index of email addresses to MRIs, filled by every user lookup
+         presence_only (boolean): If True, users with a known MRI are not looked up again, only their presence is checked
+         db_writer (teamsenum.storage.DatabaseWriter): Writer used for database logging. Created from the db_logging configuration file if omitted
+         endpoints (teamsenum.endpoints.Endpoints): Endpoint base URLs and region. Defaults to the process-wide registry
+         tokens (teamsenum.tokens.TokenManager): Manager of the bearer token. Created from bearertoken if omitted. It renews the token with the MSAL application, if there is one
 
       Returns:
          None
       """
       self.skypetoken = skypetoken
-      self.bearertoken = bearertoken
       self.teams_enrolled = teams_enrolled
       self.refresh_token = refresh_token
       self.auth_app = auth_app
       self.auth_metadata = auth_metadata
+      self.tokens = tokens if tokens else TokenManager(bearertoken, self.acquire_access_token if auth_app else None)
       self.db_logging = db_logging
+      self.db_writer = None
       if self.db_logging:
          self.database = check_db_conf(self.db_logging)
-         print("DB LOGGING IS ON")
+         if not db_writer:
+            # The storage backends are only loaded when database logging is enabled
+            from teamsenum.storage import DatabaseWriter
+            db_writer = DatabaseWriter(self.database)
+         self.db_writer = db_writer
+         p_info("DB LOGGING IS ON")
       self.session = session
+      self.http = http if http else get_pool()
+      self.endpoints = endpoints if endpoints else get_endpoints()
+      self.cache = cache
+      self.refresh = refresh
+      self.mri_index = mri_index
+      self.presence_only = presence_only
+      self.presence_failures = 0
+      self.presence_lock = threading.Lock()
+
+   @property
+   def bearertoken(self):
+      """ Current bearer token. Read from the token manager, so a renewed token is used by the next request """
+      return self.tokens.token
 
    def check_guid(self, guid, outfile=None):
-      print(f"Guid: {guid}, DB Logging: {self.db_logging}")
+      p_debug(f"Guid: {guid}, DB Logging: {self.db_logging}")
       self.check_teams_guid(guid,outfile)
 
    def check_user(self, email, type, presence=False, outfile=None):
       """
-      Wrapper that either calls check_live_user or check_teams_user depending on the account type
+      Wrapper that either calls check_live_user or check_teams_user depending on the account type.
+      In presence-only mode, users with an indexed MRI are passed to check_teams_guid right away
 
       Args:
          email (str): Email address of the user that should be checked
@@ -50,11 +123,89 @@ class TeamsUserEnumerator:
       Returns:
          None
       """
-      if type == "personal":
+      mri = self.indexed_mri(email)
+      if mri:
+         self.check_teams_guid(mri, outfile)
+      elif type == "personal":
          self.check_live_user(email, presence, outfile)
       elif type == "corporate":
          self.check_teams_user(email, presence, outfile)
 
+   def check_users(self, emails, type, presence=False, outfile=None):
+      """
+      Batched variant of check_user. Personal accounts are checked with a single searchUsers request, corporate accounts are checked one after another
+
+      Args:
+         emails (str []): Email addresses of the users that should be checked
+         type (str): Type of the account (either 'personal' or 'corporate')
+         presence (boolean): Flag that indicates whether the presence should also be checked
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         None
+      """
+      mris, emails = self.indexed_mris(emails)
+      if mris:
+         self.check_guids(mris, outfile)
+
+      if type == "personal":
+         self.check_live_users(emails, presence, outfile)
+      elif type == "corporate":
+         for email in emails:
+            self.check_teams_user(email.strip(), presence, outfile)
+
+   def indexed_mri(self, email):
+      """
+      Returns the indexed MRI of a user, if presence-only sweeps are enabled
+
+      Args:
+         email (str): Email address of the user
+
+      Returns:
+         MRI (str): The MRI of the user, or None if the user has to be looked up
+      """
+      if not self.presence_only or self.mri_index is None:
+         return None
+      return self.mri_index.get(email.strip())
+
+   def indexed_mris(self, emails):
+      """
+      Splits a batch of addresses into indexed MRIs, whose presence can be checked right away, and addresses that have to be looked up
+
+      Args:
+         emails (str []): Email addresses of the users that should be checked
+
+      Returns:
+         MRIs (str []): MRIs of the indexed users
+         Emails (str []): Addresses that are not indexed
+      """
+      mris = []
+      misses = []
+      for email in emails:
+         mri = self.indexed_mri(email)
+         if mri:
+            mris.append(mri)
+         else:
+            misses.append(email)
+      return mris, misses
+
+   def index_mri(self, email, user):
+      """
+      Stores the MRI of an existing user in the index
+
+      Args:
+         email (str): Email address of the user
+         user (dict): User structure, as returned by process_teams_user or live_user
+
+      Returns:
+         None
+      """
+      if self.mri_index is None:
+         return
+      mri = self.presence_mri(user)
+      if mri:
+         self.mri_index.put(email, mri)
+
    def check_teams_user(self, email, presence=False, outfile=None, recursive_call=False):
       """
       Checks the existence and properties of a user, using the teams.microsoft.com endpoint
@@ -67,18 +218,74 @@ class TeamsUserEnumerator:
       Returns:
          None
       """
+      token = self.bearertoken
+      content = self.cached_response(email, "corporate")
+      if content is None:
+         content = self.http.request(**self.teams_user_request(email))
+         self.store_response(email, "corporate", content)
+
+      if content.status_code == 401:
+         if not recursive_call and self.refresh_access_token(token):
+            return self.check_teams_user(email, presence=presence, outfile=outfile, recursive_call=True)
+         p_warn("Unable to enumerate user. Is the access token valid?", exit=True)
+
+      user = self.process_teams_user(email, content, outfile)
+      if user is None:
+         return
+
+      user_presence = None
+      mri = self.presence_mri(user) if presence else None
+      if mri:
+         p_debug(f"Performing additional lookup of MRI: {mri}")
+         try:
+            user_presence = self.check_teams_guid(mri)
+         except PresenceError as err:
+            self.record_presence_failure(email, user, err)
+         #user_presence = self.check_teams_presence(mri)
+      self.report_teams_user(email, user, user_presence, outfile)
+
+   def teams_user_request(self, email):
+      """
+      Builds the externalsearchv3 request for a user
+
+      Args:
+         email (str): Email address of the user that should be checked
+
+      Returns:
+         Request (dict): Keyword arguments for teamsenum.transport.HttpPool.request
+      """
       headers = {
          "Authorization": "Bearer " + self.bearertoken,
          "X-Ms-Client-Version": "1415/1.0.0.2023031528",
          "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"
       }
 
+      return {
+         'method': "GET",
+         'url': self.endpoints.url('teams', "/api/mt/{region}/beta/users/%s/externalsearchv3?includeTFLUsers=true" % (email)),
+         'headers': headers,
+         'endpoint': "search"
+      }
+
+   def process_teams_user(self, email, content, outfile=None):
+      """
+      Parses the externalsearchv3 response of a user. Users that exist, but can't be looked up in detail are reported right away
+
+      Args:
+         email (str): Email address of the user that was checked
+         content (requests.Response): Response of the externalsearchv3 request
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         User (dict): User structure that still needs to be reported, or None if the user was already handled
+      """
       user = {'email':email}
       user['exists'] = False
 
-      content = requests.get("https://teams.microsoft.com/api/mt/emea/beta/users/%s/externalsearchv3?includeTFLUsers=true" % (email), headers=headers)
-      print(content.text)
-      print(content.headers)
+      p_debug(content.text)
+      p_debug(content.headers)
+      # Throttling and server errors say nothing about the user. The target fails, so it is retried instead of being reported as not found
+      check_throttled(content)
       if content.status_code == 403:
          user['exists'] = True
          if self.teams_enrolled:
@@ -89,45 +296,138 @@ class TeamsUserEnumerator:
          p_file(json.dumps(user), outfile)
          return
 
-      if content.status_code == 401:
-         if( not recursive_call and self.refresh_token ):
-            p_warn("Unable to enumerate user. Trying to get a new access token...")
-            result = logon_with_accesstoken(self.auth_metadata, self.auth_app)
-            if( 'access_token' in result ):
-               p_warn("Got new access token. Rechecking the user...")
-               self.bearertoken = result['access_token']
-               return self.check_teams_user(email, presence=presence, outfile=outfile, recursive_call=True)
-         else:
-            p_warn("Unable to enumerate user. Is the access token valid?", exit=True)
-
       if content.status_code != 200:
          p_warn("Unable to enumerate user %s. Invalid target email address?" % (email))
          return
 
-      print(f"{content.text}")
-      log_userinfo_db(self.database, content.text)
+      if self.db_writer:
+         self.db_writer.log_userinfo(content.text)
       user_profile = json.loads(content.text)
       user['info'] = user_profile
 
       if len(user_profile) > 0 and isinstance(user_profile, list):
          user['exists'] = True
-         if presence and "mri" in user_profile[0]:
-            print("----- Performing additional lookup --- ")
-            mri = user_profile[0].get('mri')
-            print(f"MRI: {mri}")
-            presence = self.check_teams_guid(mri)
-            #presence = self.check_teams_presence(mri)
-            user['presence'] = presence
+         self.index_mri(email, user)
+
+      return user
+
+   def report_teams_user(self, email, user, user_presence=None, outfile=None):
+      """
+      Prints the result of a teams.microsoft.com user lookup and writes it into the outfile
+
+      Args:
+         email (str): Email address of the user that was checked
+         user (dict): User structure, as returned by process_teams_user
+         user_presence (list): Presence records of the user, if they were looked up
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         None
+      """
+      if user.get('exists'):
+         if user_presence is not None:
+            user['presence'] = user_presence
          result_stdout = "%s - %s" % (email, user.get('info')[0].get('displayName'))
-         result_stdout += "" if not presence else " (%s, %s)" % (user.get('presence')[0].get('presence').get('availability'), user.get('presence')[0].get('presence').get('deviceType'))
+         result_stdout += "" if not user_presence else " (%s, %s)" % (user_presence[0].get('presence').get('availability'), user_presence[0].get('presence').get('deviceType'))
          p_success(result_stdout)
       else:
 
          user['info'] = "Target user not found. Either the user does not exist, is not Teams-enrolled or is configured to not appear in search results (personal accounts only)"
          p_warn("%s - %s" % (email, user.get('info')))
 
-      print(f"{json.dumps(user)}")
-      p_file(json.dumps(user), outfile)
+      line = json.dumps(user)
+      p_debug(line)
+      p_file(line, outfile)
+
+   def record_presence_failure(self, email, user, err):
+      """
+      Records a rejected presence lookup of a user that was found. The user is still reported, with the error in its result,
+      instead of failing the whole target and losing the user lookup
+
+      Args:
+         email (str): Email address of the user
+         user (dict): User structure, as returned by process_teams_user or process_live_users
+         err (PresenceError): Error of the presence lookup
+
+      Returns:
+         None
+      """
+      user['presence_error'] = str(err)
+      with self.presence_lock:
+         self.presence_failures += 1
+      p_warn("%s - %s. The user is reported without presence" % (email, err))
+
+   def presence_mri(self, user):
+      """
+      Returns the MRI of an existing user, which is required for a presence lookup
+
+      Args:
+         user (dict): User structure, as returned by process_teams_user or process_live_users
+
+      Returns:
+         MRI (str): MRI of the user, or None if the user doesn't exist or has no MRI
+      """
+      user_profile = user.get('info')
+      if user.get('exists') and isinstance(user_profile, list) and len(user_profile) > 0 and "mri" in user_profile[0]:
+         return user_profile[0].get('mri')
+      return None
+
+   def cached_response(self, email, account_type):
+      """
+      Returns the cached lookup response of a user, unless caching is disabled or a refresh was requested
+
+      Args:
+         email (str): Email address of the user
+         account_type (str): Either 'personal' or 'corporate'
+
+      Returns:
+         Response (teamsenum.transport.SimpleResponse): The cached response, or None
+      """
+      if self.cache is None or self.refresh:
+         return None
+      return self.cache.get(email, account_type)
+
+   def store_response(self, email, account_type, content):
+      """
+      Caches a lookup response. Only definitive answers are cached, errors are always retried
+
+      Args:
+         email (str): Email address of the user
+         account_type (str): Either 'personal' or 'corporate'
+         content (requests.Response): Response of the lookup
+
+      Returns:
+         None
+      """
+      if self.cache is not None and content.status_code in [200, 403]:
+         self.cache.put(email, account_type, content.status_code, content.text)
+
+   def refresh_access_token(self, stale=None):
+      """
+      Renews the access token after it was rejected. Concurrent callers that were rejected with the same token share a single renewal
+
+      Args:
+         stale (str): The token that was rejected
+
+      Returns:
+         Success (boolean): True if a new access token is available
+      """
+      return self.tokens.refresh(stale)
+
+   def acquire_access_token(self):
+      """
+      Acquires a new access token with the cached refresh token of the MSAL application. The refresh is forced, as MSAL would
+      otherwise return the cached access token until shortly before it expires
+
+      Returns:
+         Access token (str): The new access token, or None
+      """
+      p_info("Acquiring a new access token...")
+      result = logon_with_accesstoken(self.auth_metadata, self.auth_app, force_refresh=True)
+      if result and 'access_token' in result:
+         return result['access_token']
+      p_warn("Unable to acquire a new access token")
+      return None
 
    def check_live_user(self, email, presence=False, outfile=None):
       """
@@ -141,6 +441,114 @@ class TeamsUserEnumerator:
       Returns:
          None
       """
+      self.check_live_users([email], presence, outfile)
+
+   def check_live_users(self, emails, presence=False, outfile=None):
+      """
+      Checks the existence and properties of several users with a single request to the teams.live.com endpoint.
+      If the endpoint rejects a batch, the batch is split in half and both halves are checked separately, so a single offending address doesn't fail the whole batch.
+
+      Args:
+         emails (str []): Email addresses of the users that should be checked
+         presence (boolean): Flag that indicates whether the presence should also be checked
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         None
+      """
+      emails = [email.strip() for email in emails if email.strip()]
+      cached, emails = self.cached_live_users(emails)
+      self.finish_live_users(cached, presence, outfile)
+      if not emails:
+         return
+
+      content = self.http.request(**self.live_users_request(emails))
+
+      # Splitting a throttled batch would only multiply the rejected requests
+      check_throttled(content)
+      if content.status_code != 200 and content.status_code != 401 and len(emails) > 1:
+         p_warn("Error: %d for a batch of %d users. Splitting the batch..." % (content.status_code, len(emails)))
+         half = len(emails) // 2
+         self.check_live_users(emails[:half], presence, outfile)
+         self.check_live_users(emails[half:], presence, outfile)
+         return
+
+      self.finish_live_users(self.process_live_users(emails, content), presence, outfile)
+
+   def finish_live_users(self, users, presence=False, outfile=None):
+      """
+      Looks up the presence of existing users, if requested, and reports the results
+
+      Args:
+         users (list): Tuples of email address and user structure, as returned by process_live_users
+         presence (boolean): Flag that indicates whether the presence should also be checked
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         None
+      """
+      for email, user in users:
+         user_presence = None
+         mri = self.presence_mri(user) if presence else None
+         if mri:
+            #user_presence = self.check_live_presence(mri)
+            try:
+               user_presence = self.check_teams_guid(mri,outfile)
+            except PresenceError as err:
+               self.record_presence_failure(email, user, err)
+         self.report_live_user(email, user, user_presence, outfile)
+
+   def cached_live_users(self, emails):
+      """
+      Splits a batch of addresses into users that can be answered from the cache and addresses that need to be requested
+
+      Args:
+         emails (str []): Email addresses of the users that should be checked
+
+      Returns:
+         Users (list): Tuples of email address and user structure for the cached addresses
+         Misses (str []): Addresses that are not cached
+      """
+      if self.cache is None or self.refresh:
+         return [], emails
+
+      users = []
+      misses = []
+      for email in emails:
+         content = self.cache.get(email, "personal")
+         if content is None:
+            misses.append(email)
+         else:
+            users.append((email, self.live_user(email, json.loads(content.text))))
+      return users, misses
+
+   def live_user(self, email, result):
+      """
+      Builds the user structure from the searchUsers result of a single address
+
+      Args:
+         email (str): Email address of the user
+         result (dict): Result of the address, as contained in the searchUsers response
+
+      Returns:
+         User (dict): User structure
+      """
+      user = {'email': email}
+      user['exists'] = result.get("status") == "Success"
+      user['info'] = result.get('userProfiles')
+      self.index_mri(email, user)
+      return user
+
+   def live_users_request(self, emails):
+      """
+      Builds the searchUsers request for a batch of users
+
+      Args:
+         emails (str []): Email addresses of the users that should be checked
+
+      Returns:
+         Request (dict): Keyword arguments for teamsenum.transport.HttpPool.request
+      """
       headers = {
          "Content-Type": "application/json",
          "Authorization": "Bearer " + self.bearertoken,
@@ -148,11 +556,28 @@ class TeamsUserEnumerator:
       }
 
       payload = {
-         "emails": [email],
+         "emails": emails,
+      }
+
+      return {
+         'method': "POST",
+         'url': self.endpoints.url('teams_live', "/api/mt/beta/users/searchUsers"),
+         'headers': headers,
+         'json': payload,
+         'endpoint': "search"
       }
 
-      content = requests.post("https://teams.live.com/api/mt/beta/users/searchUsers", headers=headers, json=payload)
+   def process_live_users(self, emails, content):
+      """
+      Parses the searchUsers response and attributes the results to the requested addresses
 
+      Args:
+         emails (str []): Email addresses that were requested
+         content (requests.Response): Response of the searchUsers request
+
+      Returns:
+         Users (list): Tuples of email address and user structure, for every address that is part of the response
+      """
       if content.status_code == 400:
          p_warn("Unable to enumerate user. Is the Skypetoken valid?", exit=True)
 
@@ -161,39 +586,122 @@ class TeamsUserEnumerator:
 
       if content.status_code != 200:
          p_warn("Error: %d" % (content.status_code))
-         return
+         return []
 
       json_content = json.loads(content.text)
 
-      if len(json_content) == 0:
-         p_warn("Cannot retrieve information about the user %s" % (email))
+      # The response is keyed by email address. Match case-insensitively to attribute each result to the requested address
+      results = {}
+      for item in json_content:
+         results[item.lower()] = json_content.get(item)
+
+      users = []
+      for email in emails:
+         result = results.get(email.lower())
+         if result is None:
+            p_warn("Cannot retrieve information about the user %s" % (email))
+            continue
+
+         if self.cache is not None:
+            self.cache.put(email, "personal", 200, json.dumps(result))
+         users.append((email, self.live_user(email, result)))
+
+      return users
+
+   def report_live_user(self, email, user, user_presence=None, outfile=None):
+      """
+      Prints the result of a teams.live.com user lookup and writes it into the outfile
+
+      Args:
+         email (str): Email address of the user that was checked
+         user (dict): User structure, as returned by process_live_users
+         user_presence (list): Presence records of the user, if they were looked up
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         None
+      """
+      if user.get('exists'):
+         if user_presence is not None:
+            user['presence'] = user_presence
+         result_stdout = "%s - %s" % (email, user.get('info')[0].get('displayName'))
+         result_stdout += "" if not user_presence else " (%s, %s)" % (user_presence[0].get('presence').get('availability'), user_presence[0].get('presence').get('deviceType'))
+         p_success(result_stdout)
+      else:
+         user['info'] = "Target user not found. Either the user does not exist, is not enrolled for Teams or disallows communication with your account"
+         p_warn("%s - %s" % (email, user.get('info')))
+
+      p_file(json.dumps(user), outfile)
+
+   def check_guids(self, guids, outfile=None):
+      """
+      Checks the presence of several GUIDs at once, using a single batched request to the presence endpoint
+
+      Args:
+         guids (str []): ObjectID GUIDs (or MRIs) of the users that should be checked
+         outfile (str): File descriptor for writing the results into an outfile
+
+      Returns:
+         None
+      """
+      observed = observation_time()
+      targets = self.presence_targets(guids)
+      if not targets:
          return
 
-      for item in json_content:
-         user_profile = json_content.get(item).get('userProfiles')
-         user = {'email': item}
-         user['exists'] = False
-         user['info'] = user_profile
-         if json_content.get(item).get("status") == "Success":
-            user['exists'] = True
-            if presence and len(user_profile) > 0 and isinstance(user_profile, list) and "mri" in user_profile[0]:
-               mri = user_profile[0].get('mri')
-               #presence = self.check_live_presence(mri)
-               presence = self.check_teams_guid(mri,outfile)
-               user['presence'] = presence
-            result_stdout = "%s - %s" % (email, user.get('info')[0].get('displayName'))
-            result_stdout += "" if not presence else " (%s, %s)" % (user.get('presence')[0].get('presence').get('availability'), user.get('presence')[0].get('presence').get('deviceType'))
-            p_success(result_stdout)
-         else:
-            user['info'] = "Target user not found. Either the user does not exist, is not enrolled for Teams or disallows communication with your account"
-            p_warn("%s - %s" % (item, user.get('info')))
+      p_debug(f"Batch of {len(targets)} GUIDs, DB Logging: {self.db_logging}")
+      presence = self.check_teams_presence([mri for mri, guid in targets.values()])
+      self.process_presence_batch(targets, presence, outfile, observed)
 
-         p_file(json.dumps(user), outfile)
+   def presence_targets(self, guids):
+      """
+      Normalizes a batch of GUIDs for a presence lookup
 
+      Args:
+         guids (str []): ObjectID GUIDs (or MRIs) of the users that should be checked
+
+      Returns:
+         Targets (dict): Tuples of MRI and bare GUID, keyed by the lower-case MRI
+      """
+      # Keyed by lower-case MRI, since the endpoint doesn't necessarily preserve the casing of the request
+      targets = {}
+      for guid in guids:
+         guid = guid.strip()
+         if not guid:
+            continue
+         mri, guid = guid_to_mri(guid)
+         targets[mri.lower()] = (mri, guid)
+      return targets
+
+   def process_presence_batch(self, targets, presence, outfile=None, observed=None):
+      """
+      Splits the response of a batched presence lookup into per-GUID records and processes each of them
+
+      Args:
+         targets (dict): Requested targets, as returned by presence_targets
+         presence (list): Presence records returned by the presence endpoint
+         outfile (str): File descriptor for writing the results into an outfile
+         observed (dict): Timestamp information of the observation, as returned by observation_time()
+
+      Returns:
+         None
+      """
+      if not presence:
+         p_warn("Unable to retrieve presence for a batch of %d GUIDs" % (len(targets)))
+         return
 
+      records = {}
+      for record in presence:
+         records[record.get('mri', '').lower()] = record
 
+      for key, (mri, guid) in targets.items():
+         record = records.get(key)
+         if record is None:
+            p_warn("%s - No presence information returned for this GUID" % (guid))
+            continue
+         self.process_presence_record(guid, record, outfile, observed)
 
-   def check_teams_guid(self, guid, outfile=None, Recursive=False):
+   def check_teams_guid(self, guid, outfile=None):
       """
       Checks the presence and properties of a teams GUID
 
@@ -202,137 +710,165 @@ class TeamsUserEnumerator:
          outfile (str): File descriptor for writing the results into an outfile
 
       Returns:
-         None
+         Presence data structure (list): Presence records returned for the GUID, or None
       """
 
-      now = datetime.now()
-      unixtime = str(int(now.timestamp()))
-      currentdate = now.date().isoformat()
-      totalminutes = now.hour * 60 + now.minute
-      qh_period = totalminutes // 15
-      hh_period = totalminutes // 30
+      observed = observation_time()
 
-      headers = {
-         "Authorization": "Bearer " + self.bearertoken,
-         "X-Ms-Client-Version": "1415/1.0.0.2023031528",
-         "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"
-      }
+      if not guid:
+         p_warn("%s - Target user not found. Either the user does not exist, is not Teams-enrolled or is configured to not appear in search results (personal accounts only)" % (guid))
+         return
 
-      user = {'guid':guid}
-      if guid:
-         try:
-            #mri = f"8:orgid:{guid}"
-            #mri = guid if guid.startswith("8:orgid:") else f"8:orgid:{guid}"
-            mri = guid if guid.startswith(("8:orgid:", "8:sfb:")) else f"8:orgid:{guid}"
-            if guid.startswith(("8:orgid:", "8:sfb:")):
-               prefix,guid = guid.split(":", 2)[1:]
-            #mri = guid if guid.startswith("8:orgid:") else f"8:sfb:{guid}"
-            print(f"mri: {mri}, guid: {guid}")
-            presence = self.check_teams_presence(mri)
-            user['presence'] = presence
-
-         except:
-            if( not self.refresh_token ):
-               p_warn("Unable to enumerate user. Trying to get a new access token...")
-               result = logon_with_accesstoken(self.auth_metadata, self.auth_app)
-               if( 'access_token' in result ):
-                  p_warn("Got new access token. Rechecking the user...")
-                  self.bearertoken = result['access_token']
-                  return self.check_teams_guid(guid, outfile=outfile, recursive_call=True)
-            else:
-               p_warn("Unable to enumerate user. Is the access token valid?", exit=True)
-
-
-         """Extracts and cleans the out-of-office message if it exists."""
-         for record in presence:
-            # Check if 'presence' -> 'calendarData' -> 'outOfOfficeNote' exists
-            ooo_note = record.get('presence', {}).get('calendarData', {}).get('outOfOfficeNote', {})
-            if 'message' in ooo_note:
-               ooo_enabled = 1
-               raw_message = ooo_note['message']
-
-               # Remove HTML while preserving newlines
-               cleaned_message = remove_html_preserve_newlines(raw_message)
-               print("\nCleaned Message (HTML Removed):")
-               print(cleaned_message)
-               md5sum = calculate_md5(raw_message)
-               sanitized_text, truncated = sanitize_and_truncate(raw_message)
-               message_length = len(raw_message)
-               print(f"MD5: {md5sum}, Length: {message_length}, Truncated: {truncated}")
-               print(f"{sanitized_text}")
-               if self.db_logging:
-                  log_ooo_db(self.database, guid, raw_message)
-
-            else:
-               ooo_enabled = 0
-
-         devicetype = user.get('presence')[0].get('presence').get('deviceType')
-         if not devicetype:
-            devicetype = "Off"
-         availability = user.get('presence')[0].get('presence').get('availability')
-
-         result_stdout = "%s" % (guid)
-         #result_stdout += "" if not presence else " (%s, %s)" % (user.get('presence')[0].get('presence').get('availability'), user.get('presence')[0].get('presence').get('deviceType'))
-         result_stdout += "" if not presence else " (%s, %s, %s, %s,%s)" % (availability, devicetype, ooo_enabled, unixtime, qh_period)
-         p_success(result_stdout)
-      else:
-         user['info'] = "Target user not found. Either the user does not exist, is not Teams-enrolled or is configured to not appear in search results (personal accounts only)"
-         p_warn("%s - %s" % (email, user.get('info')))
+      mri, guid = guid_to_mri(guid)
+      p_debug(f"mri: {mri}, guid: {guid}")
+      presence = self.check_teams_presence(mri)
 
-      #print(f"{json.dumps(user)}")
+      if not presence:
+         p_warn("%s - Unable to retrieve presence information" % (guid))
+         return
 
-      p_file(json.dumps(user), outfile)
-      if self.db_logging:
-         # log to db with db_log() from utils.py
-         print("LOGGING TO DB")
+      self.process_presence_record(guid, presence[0], outfile, observed)
+      return presence
 
-         log_result = log_presence_db(
-            db_config=self.database,
+   def process_presence_record(self, guid, record, outfile=None, observed=None):
+      """
+      Handles a single presence record: extracts the out-of-office note, prints the result and logs it to the outfile and database
+
+      Args:
+         guid (str): ObjectID GUID of the user the record belongs to
+         record (dict): Presence record, as returned by the presence endpoint
+         outfile (str): File descriptor for writing the results into an outfile
+         observed (dict): Timestamp information of the observation, as returned by observation_time()
+
+      Returns:
+         None
+      """
+      if observed is None:
+         observed = observation_time()
+
+      user = {'guid':guid}
+      user['presence'] = [record]
+
+      """Extracts and cleans the out-of-office message if it exists."""
+      # Check if 'presence' -> 'calendarData' -> 'outOfOfficeNote' exists
+      ooo_note = record.get('presence', {}).get('calendarData', {}).get('outOfOfficeNote', {})
+      if 'message' in ooo_note:
+         ooo_enabled = 1
+         raw_message = ooo_note['message']
+
+         if get_console().enabled(DEBUG):
+            # Remove HTML while preserving newlines
+            cleaned_message = remove_html_preserve_newlines(raw_message)
+            p_debug("Cleaned Message (HTML Removed):\n%s" % (cleaned_message))
+            md5sum = calculate_md5(raw_message)
+            sanitized_text, truncated = sanitize_and_truncate(raw_message)
+            message_length = len(raw_message)
+            p_debug(f"MD5: {md5sum}, Length: {message_length}, Truncated: {truncated}")
+            p_debug(sanitized_text)
+         if self.db_writer:
+            self.db_writer.log_ooo(guid, raw_message)
+
+      else:
+         ooo_enabled = 0
+
+      devicetype = record.get('presence', {}).get('deviceType')
+      if not devicetype:
+         devicetype = "Off"
+      availability = record.get('presence', {}).get('availability')
+
+      result_stdout = "%s" % (guid)
+      result_stdout += " (%s, %s, %s, %s,%s)" % (availability, devicetype, ooo_enabled, observed['unixtime'], observed['qh_period'])
+      p_success(result_stdout)
+
+      if isinstance(outfile, PresenceParquetWriter):
+         outfile.write_presence({
+            'guid': guid,
+            'availability': availability,
+            'device': devicetype,
+            'ooo_enabled': bool(ooo_enabled),
+            'scrape_date_unix': int(observed['unixtime']),
+            'qh_period': observed['qh_period'],
+            'hh_period': observed['hh_period'],
+            'session': self.session
+         })
+      else:
+         p_file(json.dumps(user), outfile)
+      if self.db_writer:
+         # Rows are buffered and written in batches by the DatabaseWriter
+         self.db_writer.log_presence(
             teams_guid=guid,
             availability=availability,
             ooo_enabled=ooo_enabled,
             device=devicetype,
-            scrape_date_unix=unixtime,
-            scrape_date=currentdate,
-            hh_period=hh_period,
-            qh_period=qh_period,
+            scrape_date_unix=observed['unixtime'],
+            scrape_date=observed['currentdate'],
+            hh_period=observed['hh_period'],
+            qh_period=observed['qh_period'],
             session=self.session
          )
 
-         if log_result:
-            print("Data logged successfully.")
-         else:
-            print("Failed to log data.")
-
-
+   def check_teams_presence(self, mri, recursive_call=False):
+      """
+      Checks the presence of one or several users, using the teams.microsoft.com endpoint
 
+      Args:
+         mri (str or str []): MRI of the user that should be checked, or a list of MRIs for a batched lookup
 
+      Returns:
+         Presence data structure (list): Structure containing one presence record per requested MRI
+      """
+      token = self.bearertoken
+      content = self.http.request(**self.presence_request(mri))
+      if content.status_code == 401 and not recursive_call and self.refresh_access_token(token):
+         return self.check_teams_presence(mri, recursive_call=True)
+      return self.process_presence_response(content)
 
-   def check_teams_presence(self, mri):
+   def presence_request(self, mri):
       """
-      Checks the presence of a user, using the teams.microsoft.com endpoint
+      Builds the getpresence request for one or several users
 
       Args:
-         mri (str): MRI of the user that should be checked
+         mri (str or str []): MRI of the user that should be checked, or a list of MRIs for a batched lookup
 
       Returns:
-         Presence data structure (dict): Structure containing presence information about the targeted user
+         Request (dict): Keyword arguments for teamsenum.transport.HttpPool.request
       """
       headers = {
           "Content-Type": "application/json",
           "Authorization": "Bearer " + self.bearertoken,
       }
 
-      payload = [{"mri":mri}]
+      mris = [mri] if isinstance(mri, str) else mri
+      payload = [{"mri":item} for item in mris]
+
+      return {
+         'method': "POST",
+         'url': self.endpoints.url('presence', "/v1/presence/getpresence/"),
+         'headers': headers,
+         'json': payload,
+         'endpoint': "presence"
+      }
 
-      content = requests.post("https://presence.teams.microsoft.com/v1/presence/getpresence/", headers=headers, json=payload)
+   def process_presence_response(self, content):
+      """
+      Parses the response of the getpresence endpoint
+
+      Args:
+         content (requests.Response): Response of the getpresence request
+
+      Returns:
+         Presence data structure (list): Presence records
 
+      Raises:
+         ThrottledError: If the request was throttled or failed with a server error
+         PresenceError: If the request was rejected, e.g. because the access token is no longer valid
+      """
+      check_throttled(content)
       if content.status_code != 200:
-         p_warn("Error: %d" % (content.status_code))
-         return
+         raise PresenceError(content.status_code)
 
       json_content = json.loads(content.text)
-      print(json_content)
+      p_debug(json_content)
 
       return json_content
 
@@ -354,7 +890,7 @@ class TeamsUserEnumerator:
 
       payload = [{"mri":mri}]
 
-      content = requests.post("https://presence.teams.live.com/v1/presence/getpresence/", headers=headers, json=payload)
+      content = self.http.post(self.endpoints.url('presence_live', "/v1/presence/getpresence/"), headers=headers, json=payload, endpoint="presence")
 
       if content.status_code != 200:
          p_warn("Error: %d" % (content.status_code))
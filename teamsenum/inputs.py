@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+import gzip
+import hashlib
+import io
+import math
+import sys
+
+def open_input(filename):
+   """
+   Opens an input file for reading. Gzip-compressed files are detected by their extension, '-' reads from stdin.
+
+   Args:
+      filename (str): Path of the input file, or '-' for stdin
+
+   Returns:
+      File object (_io.TextIOWrapper): Text stream that yields one line per target
+   """
+   if filename == "-":
+      return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", errors="replace")
+   if filename.endswith(".gz"):
+      return gzip.open(filename, "rt", encoding="utf-8", errors="replace")
+   return open(filename, encoding="utf-8", errors="replace")
+
+def normalize_target(line):
+   """
+   Normalizes a line of an input file. Email addresses and GUIDs are case-insensitive, so they are lower-cased.
+
+   Args:
+      line (str): Raw line of an input file
+
+   Returns:
+      Target (str): Normalized target, or None for blank lines and comments
+   """
+   target = line.strip()
+   if not target or target.startswith("#"):
+      return None
+   return target.lower()
+
+def target_digest(target):
+   """
+   Returns a 64 bit fingerprint of a target. Storing the fingerprint instead of the string roughly halves the memory of the seen-set.
+   """
+   return int.from_bytes(hashlib.blake2b(target.encode("utf-8"), digest_size=8).digest(), "little")
+
+class SeenSet:
+   """ Exact seen-set that stores 64 bit fingerprints of the targets """
+
+   def __init__(self):
+      self.seen = set()
+
+   def add(self, target):
+      """
+      Adds a target to the set
+
+      Args:
+         target (str): Normalized target
+
+      Returns:
+         New (boolean): True if the target was not seen before
+      """
+      digest = target_digest(target)
+      if digest in self.seen:
+         return False
+      self.seen.add(digest)
+      return True
+
+   def __contains__(self, target):
+      return target_digest(target) in self.seen
+
+class BloomFilter:
+   """ Probabilistic seen-set with a fixed memory footprint. A small fraction of new targets might be reported as already seen """
+
+   def __init__(self, capacity, error_rate=0.0001):
+      """
+      Constructor that sizes the filter for the expected number of targets
+
+      Args:
+         capacity (int): Expected number of distinct targets
+         error_rate (float): Probability that a new target is reported as already seen, once the filter holds capacity targets
+
+      Returns:
+         None
+      """
+      capacity = max(1, capacity)
+      self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+      self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+      self.bits = bytearray((self.size + 7) // 8)
+
+   def add(self, target):
+      """
+      Adds a target to the filter
+
+      Args:
+         target (str): Normalized target
+
+      Returns:
+         New (boolean): True if the target was (most likely) not seen before
+      """
+      digest = hashlib.blake2b(target.encode("utf-8"), digest_size=16).digest()
+      h1 = int.from_bytes(digest[:8], "little")
+      h2 = int.from_bytes(digest[8:], "little") | 1
+
+      new = False
+      for i in range(self.hashes):
+         position = (h1 + i * h2) % self.size
+         byte, bit = position >> 3, 1 << (position & 7)
+         if not self.bits[byte] & bit:
+            self.bits[byte] |= bit
+            new = True
+      return new
+
+def read_targets(filename, dedupe="exact", capacity=10000000):
+   """
+   Lazily reads targets from an input file. Blank lines and comments are skipped and duplicates are dropped.
+
+   Args:
+      filename (str): Path of the input file. Gzip-compressed files and '-' for stdin are supported
+      dedupe (str): Duplicate detection, either 'exact', 'bloom' or 'off'
+      capacity (int): Expected number of distinct targets, used to size the bloom filter
+
+   Returns:
+      Targets (generator): Normalized, deduplicated targets
+   """
+   if dedupe == "bloom":
+      seen = BloomFilter(capacity)
+   elif dedupe == "exact":
+      seen = SeenSet()
+   else:
+      seen = None
+
+   with open_input(filename) as f:
+      for line in f:
+         target = normalize_target(line)
+         if target is None:
+            continue
+         if seen is not None and not seen.add(target):
+            continue
+         yield target
+
+def batched(items, size):
+   """
+   Groups an iterable into lists of up to size items, without reading ahead any further
+
+   Args:
+      items (iterable): Targets
+      size (int): Batch size
+
+   Returns:
+      Batches (generator): Lists of targets
+   """
+   batch = []
+   for item in items:
+      batch.append(item)
+      if len(batch) >= size:
+         yield batch
+         batch = []
+   if batch:
+      yield batch
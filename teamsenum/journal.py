@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import os
+import threading
+import time
+from teamsenum.inputs import SeenSet, normalize_target
+
+class Journal:
+   """ Append-only journal of completed targets, used to resume an interrupted run """
+
+   def __init__(self, filename, sync_every=500, sync_interval=2.0):
+      """
+      Constructor that loads the targets completed by previous runs and opens the journal for appending
+
+      Args:
+         filename (str): Path of the journal file. Created if it does not exist
+         sync_every (int): Number of records after which the journal is synced to disk
+         sync_interval (float): Time in [s] after which pending records are synced to disk
+
+      Returns:
+         None
+      """
+      self.filename = filename
+      self.sync_every = sync_every
+      self.sync_interval = sync_interval
+      self.completed = SeenSet()
+      self.num_completed = 0
+
+      if os.path.isfile(filename):
+         with open(filename, encoding="utf-8", errors="replace") as f:
+            for line in f:
+               target = normalize_target(line)
+               if target is not None and self.completed.add(target):
+                  self.num_completed += 1
+
+      self.fd = open(filename, "a", encoding="utf-8")
+      # A crash might have left a partially written last line. Terminate it, so it doesn't merge with the next record
+      if self.fd.tell() > 0:
+         with open(filename, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+               self.fd.write("\n")
+
+      self.lock = threading.Lock()
+      self.pending = 0
+      self.last_sync = time.monotonic()
+
+   def skip(self, targets):
+      """
+      Filters out the targets that were completed by a previous run. The targets are only looked up, so the memory of the journal
+      doesn't grow with the input and duplicates are left to the deduplication of the input
+
+      Args:
+         targets (iterable): Normalized targets
+
+      Returns:
+         Targets (generator): Targets that still need to be enumerated
+      """
+      for target in targets:
+         if target not in self.completed:
+            yield target
+
+   def record(self, item):
+      """
+      Marks a target, or a batch of targets, as completed
+
+      Args:
+         item (str or str []): Completed target or batch of targets
+
+      Returns:
+         None
+      """
+      targets = [item] if isinstance(item, str) else item
+      lines = "".join("%s\n" % (target.strip()) for target in targets)
+      with self.lock:
+         self.fd.write(lines)
+         self.pending += len(targets)
+         if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+   def sync(self):
+      self.fd.flush()
+      os.fsync(self.fd.fileno())
+      self.pending = 0
+      self.last_sync = time.monotonic()
+
+   def close(self):
+      with self.lock:
+         self.sync()
+         self.fd.close()
+
+class FailedTargets:
+   """ File of targets that still failed after all retries. It can be passed as input file (-f or -g) to enumerate them again """
+
+   def __init__(self, filename):
+      """
+      Constructor that opens the file for appending
+
+      Args:
+         filename (str): Path of the file. Created if it does not exist
+
+      Returns:
+         None
+      """
+      self.filename = filename
+      self.fd = open(filename, "a", encoding="utf-8")
+      self.lock = threading.Lock()
+      self.count = 0
+
+   def record(self, item):
+      """
+      Adds a failed target, or a batch of targets
+
+      Args:
+         item (str or str []): Failed target or batch of targets
+
+      Returns:
+         None
+      """
+      targets = [item] if isinstance(item, str) else item
+      lines = "".join("%s\n" % (target.strip()) for target in targets)
+      with self.lock:
+         self.fd.write(lines)
+         self.fd.flush()
+         self.count += len(targets)
+
+   def close(self):
+      with self.lock:
+         self.fd.close()
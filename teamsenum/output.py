@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+import gzip
+import io
+import queue
+import threading
+import time
+
+def open_compressed(filename, mode="wt"):
+   """
+   Opens an output file, compressing it on the fly based on the file extension (.gz for gzip, .zst for zstd)
+
+   Args:
+      filename (str): Path of the output file
+      mode (str): File mode
+
+   Returns:
+      File object (io.TextIOBase): Text file object
+   """
+   if filename.endswith(".gz"):
+      return gzip.open(filename, mode, encoding="utf-8", compresslevel=6)
+   if filename.endswith(".zst"):
+      import zstandard
+      stream = zstandard.ZstdCompressor().stream_writer(open(filename, mode.replace("t", "b")), closefd=True)
+      return io.TextIOWrapper(stream, encoding="utf-8")
+   return open(filename, mode, encoding="utf-8")
+
+class WriterError(Exception):
+   """ Raised when the background thread of a writer stopped because of an error, so callers fail instead of blocking on its full queue """
+
+class BackgroundWriter:
+   """
+   Base of the writers that are fed by the enumeration threads through a bounded queue and drained by a single background thread.
+   Subclasses implement run(), which processes queued items until it receives None. If run() fails, the error is kept and raised
+   by put() and stop(), as the queue would otherwise fill up and block every caller.
+   """
+
+   def start(self, max_queued):
+      """
+      Creates the queue and starts the background thread
+
+      Args:
+         max_queued (int): Number of queued items after which callers are blocked until the thread catches up
+
+      Returns:
+         None
+      """
+      self.queue = queue.Queue(maxsize=max_queued)
+      self.error = None
+      self.thread = threading.Thread(target=self.guarded_run, daemon=True)
+      self.thread.start()
+
+   def guarded_run(self):
+      try:
+         self.run()
+      except Exception as err:
+         self.error = err
+
+   def check(self):
+      """ Raises WriterError if the background thread failed """
+      if self.error is not None:
+         raise WriterError("%s failed: %s" % (type(self).__name__, str(self.error) or type(self.error).__name__)) from self.error
+
+   def put(self, item):
+      """
+      Queues an item. Blocks while the queue is full, as long as the background thread is running
+
+      Args:
+         item: Item for run()
+
+      Returns:
+         None
+
+      Raises:
+         WriterError: If the background thread failed
+      """
+      while True:
+         self.check()
+         if not self.thread.is_alive():
+            raise WriterError("%s is closed" % (type(self).__name__))
+         try:
+            self.queue.put(item, timeout=0.5)
+            return
+         except queue.Full:
+            pass
+
+   def stop(self):
+      """
+      Processes the queued items and stops the background thread
+
+      Raises:
+         WriterError: If the background thread failed
+      """
+      if self.thread.is_alive():
+         try:
+            self.put(None)
+         except WriterError:
+            pass
+      self.thread.join()
+      self.check()
+
+class ResultWriter(BackgroundWriter):
+   """
+   Writes result lines from a single background thread. Enumeration threads only queue complete lines,
+   which are written in batches, so lines never interleave and a whole batch costs a single write and flush.
+   """
+
+   def __init__(self, filename, batch_bytes=1048576, flush_interval=1.0, max_queued=100000):
+      """
+      Constructor that opens the output file and starts the writer thread
+
+      Args:
+         filename (str): Path of the output file. Files ending with .gz or .zst are compressed
+         batch_bytes (int): Number of buffered bytes after which they are written
+         flush_interval (float): Time in [s] after which buffered lines are written, even if the batch is not full
+         max_queued (int): Number of queued lines after which callers are blocked until the writer catches up
+
+      Returns:
+         None
+      """
+      self.filename = filename
+      self.fd = open_compressed(filename)
+      self.batch_bytes = max(1, batch_bytes)
+      self.flush_interval = flush_interval
+      self.lines = 0
+      self.closed = False
+      self.start(max_queued)
+
+   def write(self, line):
+      """
+      Queues a result line
+
+      Args:
+         line (str): Line to write. A newline is appended if it is missing
+
+      Returns:
+         None
+
+      Raises:
+         WriterError: If the writer thread failed, e.g. because the disk is full
+      """
+      if not line.endswith("\n"):
+         line += "\n"
+      self.put(line)
+
+   def flush(self):
+      # Lines are flushed by the writer thread. Kept for compatibility with file objects
+      pass
+
+   def run(self):
+      buffer = []
+      size = 0
+      last_write = time.monotonic()
+      while True:
+         timeout = max(0, last_write + self.flush_interval - time.monotonic())
+         try:
+            line = self.queue.get(timeout=timeout)
+         except queue.Empty:
+            line = False
+
+         if line:
+            buffer.append(line)
+            size += len(line)
+            self.lines += 1
+
+         if buffer and (line is None or size >= self.batch_bytes or time.monotonic() - last_write >= self.flush_interval):
+            self.fd.write("".join(buffer))
+            self.fd.flush()
+            buffer = []
+            size = 0
+
+         if line is None:
+            return
+         if not buffer:
+            last_write = time.monotonic()
+
+   def close(self):
+      """
+      Writes all remaining lines and closes the output file
+
+      Raises:
+         WriterError: If the writer thread failed. Lines queued after the failure were not written
+      """
+      if self.closed:
+         return
+      self.closed = True
+      try:
+         self.stop()
+      finally:
+         self.fd.close()
+
+# Columns of the Parquet output, as (name, pyarrow type name)
+PRESENCE_COLUMNS = [
+   ('guid', 'string'),
+   ('availability', 'string'),
+   ('device', 'string'),
+   ('ooo_enabled', 'bool_'),
+   ('scrape_date_unix', 'int64'),
+   ('qh_period', 'int16'),
+   ('hh_period', 'int16'),
+   ('session', 'string')
+]
+
+class PresenceParquetWriter(BackgroundWriter):
+   """
+   Writes presence observations as typed columns to a Parquet file. Rows are buffered per column and written as one row group
+   whenever row_group_size rows were collected, from a single background thread like ResultWriter.
+   """
+
+   def __init__(self, filename, row_group_size=100000, compression="zstd", max_queued=100000):
+      """
+      Constructor that opens the Parquet file and starts the writer thread
+
+      Args:
+         filename (str): Path of the Parquet file
+         row_group_size (int): Number of rows per row group
+         compression (str): Parquet compression codec
+         max_queued (int): Number of queued rows after which callers are blocked until the writer catches up
+
+      Returns:
+         None
+      """
+      import pyarrow
+      import pyarrow.parquet
+
+      self.pyarrow = pyarrow
+      self.filename = filename
+      self.row_group_size = max(1, row_group_size)
+      self.schema = pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in PRESENCE_COLUMNS])
+      self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression=compression)
+      self.columns = {name: [] for name, kind in PRESENCE_COLUMNS}
+      self.rows = 0
+      self.skipped = 0
+      self.closed = False
+      self.start(max_queued)
+
+   def write_presence(self, row):
+      """
+      Queues a presence observation
+
+      Args:
+         row (dict): Values keyed by the names of PRESENCE_COLUMNS
+
+      Returns:
+         None
+
+      Raises:
+         WriterError: If the writer thread failed
+      """
+      self.put(row)
+
+   def write(self, line):
+      # JSON lines of user lookups don't fit the presence schema. They are counted, so the loss can be reported
+      self.skipped += 1
+
+   def flush(self):
+      pass
+
+   def run(self):
+      while True:
+         row = self.queue.get()
+         if row is None:
+            self.write_row_group()
+            return
+         for name in self.columns:
+            self.columns[name].append(row.get(name))
+         self.rows += 1
+         if len(self.columns['guid']) >= self.row_group_size:
+            self.write_row_group()
+
+   def write_row_group(self):
+      if not self.columns['guid']:
+         return
+      table = self.pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+      self.writer.write_table(table, row_group_size=self.row_group_size)
+      self.columns = {name: [] for name in self.columns}
+
+   def close(self):
+      """
+      Writes the remaining rows and closes the Parquet file
+
+      Raises:
+         WriterError: If the writer thread failed. Rows queued after the failure were not written
+      """
+      if self.closed:
+         return
+      self.closed = True
+      try:
+         self.stop()
+      finally:
+         self.writer.close()
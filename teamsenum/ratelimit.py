@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+import email.utils
+import threading
+import time
+from teamsenum.utils import p_warn, p_info
+from teamsenum.transport import TransientError, THROTTLED
+
+class ThrottledError(TransientError):
+   """ Raised when a lookup was rejected because of throttling or a server error, so the target is retried instead of being reported as not found """
+
+   def __init__(self, status_code):
+      super().__init__("HTTP %d" % (status_code))
+      self.status_code = status_code
+
+def check_throttled(content):
+   """
+   Raises ThrottledError for responses that say nothing about the target, i.e. throttling and server errors
+
+   Args:
+      content (requests.Response): Response of a lookup
+
+   Returns:
+      None
+   """
+   if content.status_code in THROTTLED or content.status_code >= 500:
+      raise ThrottledError(content.status_code)
+
+def retry_after(headers, default=1.0):
+   """
+   Parses the Retry-After header, which is either a number of seconds or an HTTP date
+
+   Args:
+      headers (dict): Response headers
+      default (float): Time in [s] that is returned if the header is missing or invalid
+
+   Returns:
+      Delay (float): Time in [s] to wait before the next request
+   """
+   value = headers.get('Retry-After') if headers else None
+   if not value:
+      return default
+   try:
+      return max(0.0, float(value))
+   except ValueError:
+      pass
+   try:
+      return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+   except (TypeError, ValueError, OverflowError):
+      return default
+
+class RateLimiter:
+   """
+   Token bucket shared by all requests of a run, combined with an adaptive limit of the requests in flight.
+   The bucket caps the request rate with sub-second precision. A throttled response pauses all requests for its Retry-After
+   and halves the concurrency limit. Every recover_after successful responses, the limit grows by one again, up to the initial value.
+   """
+
+   def __init__(self, rate=0, concurrency=7, burst=1, recover_after=20, default_retry_after=1.0, max_retries=5):
+      """
+      Constructor
+
+      Args:
+         rate (float): Maximum number of requests per second. 0 disables the rate ceiling
+         concurrency (int): Maximum number of requests in flight
+         burst (float): Number of requests that may be sent at once after an idle period
+         recover_after (int): Number of successful responses after which the concurrency limit is raised by one
+         default_retry_after (float): Pause in [s] after a throttled response without a Retry-After header
+         max_retries (int): Number of times a throttled request is sent again before its response is returned
+
+      Returns:
+         None
+      """
+      self.rate = rate
+      self.burst = max(1.0, burst)
+      self.tokens = self.burst
+      self.max_concurrency = max(1, concurrency)
+      self.limit = self.max_concurrency
+      self.recover_after = max(1, recover_after)
+      self.default_retry_after = default_retry_after
+      self.max_retries = max_retries
+
+      self.condition = threading.Condition()
+      self.in_flight = 0
+      self.successes = 0
+      self.paused_until = 0
+      self.last_refill = time.monotonic()
+      self.throttled = 0
+
+   def reserve(self):
+      """
+      Takes a token and a concurrency slot, if both are available
+
+      Returns:
+         Wait (float): 0 if the request may be sent, otherwise the time in [s] after which reserve() should be called again
+      """
+      now = time.monotonic()
+      if now < self.paused_until:
+         return self.paused_until - now
+      if self.in_flight >= self.limit:
+         # A slot is freed by release(), which wakes up blocked threads. The timeout only bounds the polling of the async engine
+         return 0.05
+      if self.rate:
+         self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+         self.last_refill = now
+         if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+         self.tokens -= 1
+      self.in_flight += 1
+      return 0
+
+   def acquire(self):
+      """ Blocks until a request may be sent """
+      with self.condition:
+         while True:
+            wait = self.reserve()
+            if not wait:
+               return
+            self.condition.wait(wait)
+
+   async def acquire_async(self):
+      """ Waits without blocking the event loop until a request may be sent """
+      import asyncio
+      while True:
+         with self.condition:
+            wait = self.reserve()
+         if not wait:
+            return
+         await asyncio.sleep(wait)
+
+   def release(self, status_code=None, headers=None):
+      """
+      Frees the concurrency slot of a request and adapts the limit to its response
+
+      Args:
+         status_code (int): Status code of the response, or None if the request failed
+         headers (dict): Response headers
+
+      Returns:
+         Throttled (boolean): True if the response asked to slow down
+      """
+      with self.condition:
+         self.in_flight -= 1
+         throttled = status_code in THROTTLED
+         if throttled:
+            self.throttled += 1
+            self.successes = 0
+            delay = retry_after(headers, self.default_retry_after)
+            now = time.monotonic()
+            if now >= self.paused_until:
+               # Only the first of several concurrently throttled requests reduces the limit
+               self.limit = max(1, self.limit // 2)
+               p_warn("Throttled (HTTP %d). Pausing for %.1fs and reducing the concurrency to %d" % (status_code, delay, self.limit))
+            self.paused_until = max(self.paused_until, now + delay)
+            self.tokens = 0
+         elif status_code is not None and status_code < 500:
+            self.successes += 1
+            if self.successes >= self.recover_after and self.limit < self.max_concurrency:
+               self.successes = 0
+               self.limit += 1
+               if self.limit == self.max_concurrency:
+                  p_info("Concurrency recovered to %d" % (self.limit))
+         self.condition.notify_all()
+         return throttled
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import time
+from datetime import date
+
+# Availability values of the presence endpoint, mapped to the columns of daily_stats_detailed
+STATES = {
+   'Available': 'available',
+   'AvailableIdle': 'available',
+   'Busy': 'busy',
+   'BusyIdle': 'busy',
+   'InACall': 'busy',
+   'InAMeeting': 'busy',
+   'DoNotDisturb': 'donotdisturb',
+   'Presenting': 'donotdisturb',
+   'Away': 'away',
+   'BeRightBack': 'away',
+   'Offline': 'offline'
+}
+
+DETAILED_QUERY = """
+   REPLACE INTO daily_stats_detailed (
+      date, hh_period, qh_period, r_available, r_busy, r_donotdisturb, r_away, r_offline, r_ooocount, total_users, r_online,
+      p_available, p_busy, p_donotdisturb, p_away, p_offline, p_ooocount, p_online
+   ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+SUMMARY_QUERY = """
+   REPLACE INTO daily_stats_summary (
+      date, total_users, total_online, r_available, r_available2hr, r_available4hr, r_alwaysavailable, r_alwaysoffline, r_ooocount,
+      p_total_online, p_available, p_available2hr, p_available4hr, p_alwaysavailable, p_alwaysoffline, p_ooocount
+   ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# Indices into the per-user day record
+# AVAILABLE_HH is a bitmask of the half-hour periods in which the user was available
+OBSERVATIONS, AVAILABLE, OFFLINE, ONLINE, OOO, AVAILABLE_HH = range(6)
+
+def percent(count, total):
+   return round(100.0 * count / total, 2) if total else 0.0
+
+class Rollup:
+   """
+   Maintains daily_stats_detailed and daily_stats_summary from the presence rows as they are logged, instead of aggregating user_presence.
+   Keeps the last state of every user per half-hour period and a small record per user and day, and upserts the affected rows periodically.
+   Not thread-safe. It is driven by the flusher thread of DatabaseWriter, which passes every observation, including the ones that
+   change-only logging doesn't write.
+
+   A day summary is recomputed from the records in memory, so it is only correct if every observation of the day was passed to the
+   rollup. Days for which that doesn't hold are partial and their summary is never written: days whose rows were only partially loaded
+   by seed(), and days before the seeded day, which were not loaded at all.
+   """
+
+   def __init__(self, interval=60, keep_periods=2):
+      """
+      Constructor
+
+      Args:
+         interval (float): Time in [s] between two upserts of the statistics tables
+         keep_periods (int): Number of most recent half-hour periods that are kept in memory after an upsert
+
+      Returns:
+         None
+      """
+      self.interval = interval
+      self.keep_periods = max(1, keep_periods)
+      self.periods = {}
+      self.period_qh = {}
+      self.days = {}
+      self.dirty_periods = set()
+      self.dirty_days = set()
+      self.partial_days = set()
+      self.first_day = None
+      self.last_write = time.monotonic()
+
+   def seed(self, backend, presence_table, day=None, complete=True):
+      """
+      Loads the presence rows of a day that are already in the database, so a restarted run continues the statistics of the day.
+      Only the rows of that day are read, using the scrape_date index.
+
+      Args:
+         backend (teamsenum.storage.MySQLBackend or SQLiteBackend): Storage backend
+         presence_table (str): Name of the presence table
+         day (str): Date in YYYY-MM-DD format. Defaults to today
+         complete (boolean): Whether the table holds every observation of the day. False with change-only logging, in which case
+            the rows only provide the last state of the users, and the summary of the day is left as it is
+
+      Returns:
+         Rows (int): Number of rows that were loaded
+      """
+      day = day if day else date.today().isoformat()
+      rows = backend.fetchall(f"SELECT teams_guid, availability, ooo_enabled, device, scrape_date_unix, scrape_date, hh_period, qh_period, session FROM {presence_table} WHERE scrape_date = %s ORDER BY id", (day,))
+      self.first_day = day
+      for row in rows:
+         self.add(row, complete)
+      if rows and not complete:
+         self.partial_days.add(day)
+      return len(rows)
+
+   def add(self, row, dirty=True):
+      """
+      Counts a presence row
+
+      Args:
+         row (tuple): Presence row, as built by teamsenum.utils.presence_row
+         dirty (boolean): Whether the period and day of the row are upserted with the next write
+
+      Returns:
+         None
+      """
+      guid, availability, ooo_enabled, device, scrape_date_unix, scrape_date, hh_period, qh_period, session = row
+      day = str(scrape_date)
+      state = STATES.get(availability)
+      online = state is not None and state != 'offline'
+
+      # Within a period, the latest observation of a user wins, so repeated sweeps don't count a user twice
+      key = (day, hh_period)
+      self.periods.setdefault(key, {})[guid] = (state, bool(ooo_enabled))
+      self.period_qh[key] = max(self.period_qh.get(key, qh_period), qh_period)
+      if dirty:
+         self.dirty_periods.add(key)
+
+      if day not in self.days and self.first_day and day < self.first_day:
+         # Observations of the day before the restart are not in memory
+         self.partial_days.add(day)
+      users = self.days.setdefault(day, {})
+      record = users.get(guid)
+      if record is None:
+         record = users[guid] = [0, 0, 0, False, False, 0]
+      record[OBSERVATIONS] += 1
+      record[ONLINE] = record[ONLINE] or online
+      record[OOO] = record[OOO] or bool(ooo_enabled)
+      if state == 'available':
+         record[AVAILABLE] += 1
+         record[AVAILABLE_HH] |= 1 << int(hh_period)
+      elif state == 'offline':
+         record[OFFLINE] += 1
+      if dirty and day not in self.partial_days:
+         self.dirty_days.add(day)
+
+   def due(self):
+      return bool(self.dirty_periods or self.dirty_days) and time.monotonic() - self.last_write >= self.interval
+
+   def detailed_rows(self):
+      rows = []
+      for key in sorted(self.dirty_periods):
+         day, hh_period = key
+         counts = {'available': 0, 'busy': 0, 'donotdisturb': 0, 'away': 0, 'offline': 0}
+         ooo = 0
+         for state, ooo_enabled in self.periods[key].values():
+            if state in counts:
+               counts[state] += 1
+            ooo += ooo_enabled
+         total = len(self.periods[key])
+         online = counts['available'] + counts['busy'] + counts['donotdisturb'] + counts['away']
+         rows.append((
+            day, hh_period, self.period_qh[key],
+            counts['available'], counts['busy'], counts['donotdisturb'], counts['away'], counts['offline'], ooo, total, online,
+            percent(counts['available'], total), percent(counts['busy'], total), percent(counts['donotdisturb'], total),
+            percent(counts['away'], total), percent(counts['offline'], total), percent(ooo, total), percent(online, total)
+         ))
+      return rows
+
+   def summary_rows(self):
+      rows = []
+      for day in sorted(self.dirty_days - self.partial_days):
+         users = self.days[day].values()
+         total = len(self.days[day])
+         online = sum(1 for record in users if record[ONLINE])
+         available = sum(1 for record in users if record[AVAILABLE])
+         # Each half-hour period in which a user was seen available counts as 30 minutes
+         available_hh = [bin(record[AVAILABLE_HH]).count("1") for record in users]
+         available2hr = sum(1 for count in available_hh if count >= 4)
+         available4hr = sum(1 for count in available_hh if count >= 8)
+         always_available = sum(1 for record in users if record[AVAILABLE] == record[OBSERVATIONS])
+         always_offline = sum(1 for record in users if record[OFFLINE] == record[OBSERVATIONS])
+         ooo = sum(1 for record in users if record[OOO])
+         rows.append((
+            day, total, online, available, available2hr, available4hr, always_available, always_offline, ooo,
+            percent(online, total), percent(available, total), percent(available2hr, total), percent(available4hr, total),
+            percent(always_available, total), percent(always_offline, total), percent(ooo, total)
+         ))
+      return rows
+
+   def write(self, backend):
+      """
+      Upserts the statistics rows that changed since the last write and drops periods and days that are no longer current
+
+      Args:
+         backend (teamsenum.storage.MySQLBackend or SQLiteBackend): Storage backend
+
+      Returns:
+         Rows (int): Number of upserted rows
+      """
+      detailed = self.detailed_rows()
+      summary = self.summary_rows()
+      if detailed:
+         backend.executemany(DETAILED_QUERY, detailed)
+      if summary:
+         backend.executemany(SUMMARY_QUERY, summary)
+      self.dirty_periods = set()
+      self.dirty_days = set()
+      self.last_write = time.monotonic()
+
+      for key in sorted(self.periods)[:-self.keep_periods]:
+         del self.periods[key]
+         del self.period_qh[key]
+      # Yesterday is kept, so rows that are logged shortly after midnight still update its summary
+      for day in sorted(self.days)[:-2]:
+         del self.days[day]
+         self.partial_days.add(day)
+
+      return len(detailed) + len(summary)
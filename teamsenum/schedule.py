@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+import time
+from datetime import datetime, timedelta
+from teamsenum.utils import p_warn, p_info
+
+class Scheduler:
+   """
+   Runs a sweep repeatedly, starting each one on a quarter- or half-hour boundary of the local time, so the sweeps line up with the
+   qh_period and hh_period of the presence rows. Sweeps never overlap. A sweep that takes longer than the interval is reported as an overrun
+   and the next sweep starts on the first boundary after it finished.
+   """
+
+   def __init__(self, interval_minutes=15):
+      """
+      Constructor
+
+      Args:
+         interval_minutes (int): Interval between two sweeps in [min]. Should divide an hour, e.g. 15 or 30
+
+      Returns:
+         None
+      """
+      self.interval = interval_minutes * 60
+      self.sweeps = 0
+      self.overruns = 0
+
+   def next_boundary(self, now=None):
+      """
+      Returns the next interval boundary after now
+
+      Args:
+         now (datetime): Reference time. Defaults to the current local time
+
+      Returns:
+         Boundary (datetime): Start time of the next sweep
+      """
+      now = now if now else datetime.now()
+      midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+      elapsed = (now - midnight).total_seconds()
+      return midnight + timedelta(seconds=(int(elapsed // self.interval) + 1) * self.interval)
+
+   def wait(self, boundary):
+      while True:
+         remaining = (boundary - datetime.now()).total_seconds()
+         if remaining <= 0:
+            return
+         # Sleep in steps, so clock adjustments don't delay the sweep
+         time.sleep(min(remaining, 60))
+
+   def run(self, sweep):
+      """
+      Runs the sweep on every interval boundary until it is interrupted
+
+      Args:
+         sweep (function): Called without arguments for every sweep. May return a summary dict with an 'interrupted' flag
+
+      Returns:
+         None
+      """
+      try:
+         while True:
+            boundary = self.next_boundary()
+            p_info("Next sweep at %s" % (boundary.strftime("%H:%M:%S")))
+            self.wait(boundary)
+
+            self.sweeps += 1
+            started = time.monotonic()
+            summary = sweep()
+            duration = time.monotonic() - started
+
+            if duration > self.interval:
+               self.overruns += 1
+               missed = int(duration // self.interval)
+               p_warn("Sweep %d took %.1fs, longer than the %ds interval. %d sweep(s) were skipped (%d overruns so far)" % (self.sweeps, duration, self.interval, missed, self.overruns))
+            else:
+               p_info("Sweep %d took %.1fs (%.0f%% of the %ds interval)" % (self.sweeps, duration, 100 * duration / self.interval, self.interval))
+
+            if summary and summary.get('interrupted'):
+               break
+      except KeyboardInterrupt:
+         p_warn("Interrupted")
+      p_info("Stopped after %d sweeps, %d overruns" % (self.sweeps, self.overruns))
@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+
+import json
+import queue
+from datetime import datetime
+import sqlite3
+import time
+from teamsenum.cache import open_database
+from teamsenum.output import BackgroundWriter, WriterError
+from teamsenum.utils import p_err, p_warn, p_debug, ooo_query, ooo_row, userinfo_query, userinfo_rows, presence_query, presence_row
+
+# Tables of db_schema.sql in SQLite syntax. Table names are filled in from the configuration
+SQLITE_SCHEMA = """
+   CREATE TABLE IF NOT EXISTS {presence_table} (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      teams_guid TEXT NOT NULL,
+      availability TEXT NOT NULL,
+      ooo_enabled INTEGER NOT NULL,
+      device TEXT NOT NULL,
+      scrape_date_unix INTEGER NOT NULL,
+      scrape_date TEXT NOT NULL,
+      hh_period INTEGER NOT NULL,
+      qh_period INTEGER NOT NULL,
+      session TEXT DEFAULT NULL
+   );
+   CREATE INDEX IF NOT EXISTS idx_{presence_table}_scrape_date ON {presence_table} (scrape_date);
+   CREATE INDEX IF NOT EXISTS idx_{presence_table}_availability ON {presence_table} (availability);
+   CREATE INDEX IF NOT EXISTS idx_{presence_table}_hh_period ON {presence_table} (hh_period);
+
+   CREATE TABLE IF NOT EXISTS {user_info_table} (
+      object_id TEXT NOT NULL PRIMARY KEY,
+      user_principal_name TEXT NOT NULL,
+      email TEXT DEFAULT NULL,
+      display_name TEXT DEFAULT NULL,
+      tenant_id TEXT DEFAULT NULL,
+      co_existence_mode TEXT DEFAULT NULL,
+      given_name TEXT DEFAULT NULL,
+      surname TEXT DEFAULT NULL,
+      account_enabled INTEGER DEFAULT NULL,
+      tenant_name TEXT DEFAULT NULL,
+      country TEXT DEFAULT NULL,
+      city TEXT DEFAULT NULL,
+      scrape_date TEXT DEFAULT NULL,
+      scrape_time TEXT DEFAULT NULL,
+      scrape_date_unix INTEGER DEFAULT NULL,
+      isOOO INTEGER DEFAULT 0,
+      session TEXT DEFAULT NULL
+   );
+
+   CREATE TABLE IF NOT EXISTS {ooo_table} (
+      md5sum TEXT NOT NULL PRIMARY KEY,
+      teams_guid TEXT NOT NULL,
+      scrape_date TEXT NOT NULL,
+      scrape_time TEXT NOT NULL,
+      scrape_date_unix INTEGER NOT NULL,
+      length INTEGER NOT NULL,
+      truncated INTEGER NOT NULL,
+      text TEXT NOT NULL
+   );
+   CREATE INDEX IF NOT EXISTS idx_{ooo_table}_user_date ON {ooo_table} (teams_guid, scrape_date);
+
+   CREATE TABLE IF NOT EXISTS daily_stats_detailed (
+      date TEXT NOT NULL,
+      hh_period INTEGER NOT NULL,
+      qh_period INTEGER NOT NULL,
+      r_available INTEGER DEFAULT NULL,
+      r_busy INTEGER DEFAULT NULL,
+      r_donotdisturb INTEGER DEFAULT NULL,
+      r_away INTEGER DEFAULT NULL,
+      r_offline INTEGER DEFAULT NULL,
+      r_ooocount INTEGER DEFAULT NULL,
+      total_users INTEGER DEFAULT NULL,
+      r_online INTEGER DEFAULT NULL,
+      p_available REAL DEFAULT NULL,
+      p_busy REAL DEFAULT NULL,
+      p_donotdisturb REAL DEFAULT NULL,
+      p_away REAL DEFAULT NULL,
+      p_offline REAL DEFAULT NULL,
+      p_ooocount REAL DEFAULT NULL,
+      p_online REAL DEFAULT NULL,
+      PRIMARY KEY (date, hh_period)
+   );
+
+   CREATE TABLE IF NOT EXISTS daily_stats_summary (
+      date TEXT NOT NULL PRIMARY KEY,
+      total_users INTEGER DEFAULT NULL,
+      total_online INTEGER DEFAULT NULL,
+      r_available INTEGER DEFAULT NULL,
+      r_available2hr INTEGER DEFAULT NULL,
+      r_available4hr INTEGER DEFAULT NULL,
+      r_alwaysavailable INTEGER DEFAULT NULL,
+      r_alwaysoffline INTEGER DEFAULT NULL,
+      r_ooocount INTEGER DEFAULT NULL,
+      p_total_online REAL DEFAULT NULL,
+      p_available REAL DEFAULT NULL,
+      p_available2hr REAL DEFAULT NULL,
+      p_available4hr REAL DEFAULT NULL,
+      p_alwaysavailable REAL DEFAULT NULL,
+      p_alwaysoffline REAL DEFAULT NULL,
+      p_ooocount REAL DEFAULT NULL
+   );
+"""
+
+def sqlite_query(query):
+   """
+   Translates one of the MySQL INSERT statements of teamsenum.utils into SQLite syntax
+
+   Args:
+      query (str): MySQL statement with %s placeholders
+
+   Returns:
+      Query (str): SQLite statement with ? placeholders
+   """
+   return query.replace("INSERT IGNORE", "INSERT OR IGNORE").replace("%s", "?")
+
+class MySQLBackend:
+   """
+   Writes rows to a MySQL server over a single persistent connection. Rows are only written by the flusher thread of DatabaseWriter,
+   so more connections wouldn't add concurrency. A connection that was dropped by the server is reopened before the next statement.
+   """
+
+   def __init__(self, db_config):
+      import mysql.connector
+
+      self.errors = (mysql.connector.Error,)
+      self.connection = mysql.connector.connect(
+         host=db_config["host"],
+         user=db_config["user"],
+         password=db_config["password"],
+         database=db_config["database"]
+      )
+      self.queries = {
+         'presence': presence_query(db_config),
+         'ooo': ooo_query(db_config),
+         'userinfo': userinfo_query(db_config)
+      }
+
+   def write(self, kind, rows):
+      """
+      Writes the rows of a table in a single transaction
+
+      Args:
+         kind (str): One of 'presence', 'ooo' and 'userinfo'
+         rows (tuple []): Rows in the column order of the table's query
+
+      Returns:
+         None
+      """
+      self.executemany(self.queries[kind], rows)
+
+   def executemany(self, query, rows):
+      self.connection.ping(reconnect=True, attempts=3, delay=1)
+      cursor = self.connection.cursor()
+      try:
+         # For INSERT statements, executemany sends a single multi-row INSERT
+         cursor.executemany(query, rows)
+         self.connection.commit()
+      except self.errors:
+         # Leaves the connection usable for the next batch, unless it was lost
+         try:
+            self.connection.rollback()
+         except self.errors:
+            pass
+         raise
+      finally:
+         cursor.close()
+
+   def fetchall(self, query, params=()):
+      self.connection.ping(reconnect=True, attempts=3, delay=1)
+      cursor = self.connection.cursor()
+      try:
+         cursor.execute(query, params)
+         return cursor.fetchall()
+      finally:
+         cursor.close()
+
+   def close(self):
+      try:
+         self.connection.close()
+      except self.errors:
+         pass
+
+class SQLiteBackend:
+   """ Writes rows to an embedded SQLite database in WAL mode, using the schema of db_schema.sql """
+
+   def __init__(self, db_config):
+      self.errors = (sqlite3.Error,)
+      self.connection = open_database(db_config["path"])
+      self.connection.executescript(SQLITE_SCHEMA.format(**db_config))
+      self.queries = {
+         'presence': presence_query(db_config),
+         'ooo': ooo_query(db_config),
+         'userinfo': userinfo_query(db_config)
+      }
+
+   def write(self, kind, rows):
+      self.executemany(self.queries[kind], rows)
+
+   def executemany(self, query, rows):
+      # The connection is only used by the flusher thread. The with block commits the batch as one transaction
+      with self.connection:
+         self.connection.executemany(sqlite_query(query), rows)
+
+   def fetchall(self, query, params=()):
+      return self.connection.execute(sqlite_query(query), params).fetchall()
+
+   def close(self):
+      self.connection.close()
+
+def open_backend(db_config):
+   """
+   Creates the storage backend selected by the database configuration
+
+   Args:
+      db_config (dict): Database configuration, as returned by check_db_conf
+
+   Returns:
+      Backend (MySQLBackend or SQLiteBackend): Backend with write(kind, rows), executemany(query, rows) and fetchall(query, params).
+      Queries are given in MySQL syntax and translated by the SQLite backend
+   """
+   if db_config.get("backend") == "sqlite":
+      return SQLiteBackend(db_config)
+   return MySQLBackend(db_config)
+
+class PresenceChanges:
+   """
+   Last logged presence state per GUID. With it, only transitions of availability, device or OOO status are logged,
+   plus a heartbeat row per GUID if its state didn't change for a while. Only used by the flusher thread of DatabaseWriter.
+   """
+
+   def __init__(self, heartbeat=3600):
+      """
+      Constructor
+
+      Args:
+         heartbeat (int): Time in [s] after which an unchanged state is logged again
+
+      Returns:
+         None
+      """
+      self.heartbeat = heartbeat
+      self.states = {}
+      self.skipped = 0
+
+   def seed(self, backend, presence_table):
+      """
+      Loads the last state of every GUID that was logged within the heartbeat interval. States that are older would be logged again anyway
+
+      Args:
+         backend (MySQLBackend or SQLiteBackend): Storage backend
+         presence_table (str): Name of the presence table
+
+      Returns:
+         GUIDs (int): Number of GUIDs with a known state
+      """
+      cutoff = int(time.time()) - self.heartbeat
+      # The date condition lets the database use the scrape_date index
+      day = datetime.fromtimestamp(cutoff).date().isoformat()
+      rows = backend.fetchall(f"SELECT teams_guid, availability, ooo_enabled, device, scrape_date_unix FROM {presence_table} WHERE scrape_date >= %s AND scrape_date_unix >= %s ORDER BY id", (day, cutoff))
+      for guid, availability, ooo_enabled, device, scrape_date_unix in rows:
+         self.states[guid] = ((availability, int(ooo_enabled), device), int(scrape_date_unix))
+      return len(self.states)
+
+   def changed(self, row):
+      """
+      Checks whether a presence row has to be logged, and remembers its state if so
+
+      Args:
+         row (tuple): Presence row, as built by teamsenum.utils.presence_row
+
+      Returns:
+         Changed (boolean): True if the state differs from the last logged one, or the heartbeat is due
+      """
+      guid, availability, ooo_enabled, device, scrape_date_unix = row[:5]
+      state = (availability, int(ooo_enabled), device)
+      observed = int(scrape_date_unix)
+      last = self.states.get(guid)
+      if last is not None and last[0] == state and observed - last[1] < self.heartbeat:
+         self.skipped += 1
+         return False
+      self.states[guid] = (state, observed)
+      return True
+
+class DatabaseWriter(BackgroundWriter):
+   """
+   Buffers presence, OOO and user information rows and writes them with multi-row inserts from a background thread.
+   Rows are written to MySQL over a single connection, or to an embedded SQLite database, depending on the configuration.
+   If the flusher thread fails, the log_* methods raise teamsenum.output.WriterError instead of blocking on the full queue.
+   """
+
+   def __init__(self, db_config, batch_size=500, flush_interval=2.0, rollup=None, changes=None):
+      """
+      Constructor that opens the storage backend and starts the flusher thread
+
+      Args:
+         db_config (dict): Database configuration, as returned by check_db_conf
+         batch_size (int): Number of rows of a table after which they are written
+         flush_interval (float): Time in [s] after which buffered rows are written, even if the batch is not full
+         rollup (teamsenum.rollup.Rollup): Optional rollup that maintains the daily_stats tables from the presence observations
+         changes (PresenceChanges): If set, only presence rows that differ from the last logged state of the GUID are written
+
+      Returns:
+         None
+      """
+      self.db_config = db_config
+      self.batch_size = max(1, batch_size)
+      self.flush_interval = flush_interval
+      self.backend = open_backend(db_config)
+      self.rollup = rollup
+      if self.rollup:
+         # With change-only logging, today's rows are incomplete. They only provide the last state of the users
+         seeded = self.rollup.seed(self.backend, db_config["presence_table"], complete=not changes)
+         p_debug(f"Loaded {seeded} presence rows of today into the daily statistics.")
+         if seeded and changes:
+            p_warn("With --changes-only, the daily summary of today is not updated after a restart. It continues with the next day")
+      self.changes = changes
+      if self.changes:
+         known = self.changes.seed(self.backend, db_config["presence_table"])
+         p_debug(f"Loaded the last presence state of {known} GUIDs.")
+
+      self.rows = {kind: [] for kind in self.backend.queries}
+      self.written = {kind: 0 for kind in self.backend.queries}
+      self.failed = {kind: 0 for kind in self.backend.queries}
+
+      # Bounded, so that workers are slowed down instead of buffering unlimited rows if the database can't keep up
+      self.start(self.batch_size * 10)
+
+   def log_presence(self, teams_guid, availability, ooo_enabled, device, scrape_date_unix, scrape_date, hh_period, qh_period, session):
+      """
+      Queues a presence row. Takes the same arguments as teamsenum.utils.presence_row
+      """
+      self.put(('presence', presence_row(teams_guid, availability, ooo_enabled, device, scrape_date_unix, scrape_date, hh_period, qh_period, session)))
+
+   def log_ooo(self, teams_guid, raw_message):
+      """
+      Queues an OOO message row. Takes the same arguments as teamsenum.utils.ooo_row
+      """
+      self.put(('ooo', ooo_row(teams_guid, raw_message)))
+
+   def log_userinfo(self, content_text):
+      """
+      Queues the user information rows of an externalsearchv3 response. Takes the same arguments as teamsenum.utils.userinfo_rows
+      """
+      try:
+         rows = userinfo_rows(content_text)
+      except (ValueError, json.JSONDecodeError) as e:
+         p_err(f"Failed to parse user information: {e}")
+         return
+      for row in rows:
+         self.put(('userinfo', row))
+
+   def run(self):
+      last_flush = time.monotonic()
+      while True:
+         timeout = max(0, last_flush + self.flush_interval - time.monotonic())
+         try:
+            entry = self.queue.get(timeout=timeout)
+         except queue.Empty:
+            entry = False
+
+         if entry is None:
+            self.flush()
+            self.write_rollup()
+            return
+
+         if entry:
+            kind, row = entry
+            if kind == 'presence':
+               # The statistics count every observation, even if it is not logged as a row
+               if self.rollup:
+                  self.rollup.add(row)
+               if self.changes and not self.changes.changed(row):
+                  row = None
+            if row is not None:
+               self.rows[kind].append(row)
+               if len(self.rows[kind]) >= self.batch_size:
+                  self.flush(kind)
+
+         if time.monotonic() - last_flush >= self.flush_interval:
+            self.flush()
+            last_flush = time.monotonic()
+            if self.rollup and self.rollup.due():
+               self.write_rollup()
+
+   def flush(self, kind=None):
+      """
+      Writes the buffered rows of one table, or of all tables. Only called from the flusher thread
+      """
+      for kind in ([kind] if kind else list(self.rows)):
+         rows = self.rows[kind]
+         if not rows:
+            continue
+         self.rows[kind] = []
+
+         try:
+            self.backend.write(kind, rows)
+            self.written[kind] += len(rows)
+            p_debug(f"Logged {len(rows)} {kind} rows to the database.")
+         except self.backend.errors as e:
+            if len(rows) == 1:
+               self.failed[kind] += 1
+               p_err(f"Failed to log a {kind} row {rows[0]}: {e}")
+               continue
+            # The batch was rolled back as a whole. Writing the rows one by one only drops the ones that are rejected
+            p_warn(f"Failed to log {len(rows)} {kind} rows: {e}. Retrying them one by one...")
+            for row in rows:
+               try:
+                  self.backend.write(kind, [row])
+                  self.written[kind] += 1
+               except self.backend.errors as e:
+                  self.failed[kind] += 1
+                  p_err(f"Failed to log a {kind} row {row}: {e}")
+
+   def write_rollup(self):
+      """
+      Upserts the daily statistics that changed. Only called from the flusher thread
+      """
+      if not self.rollup:
+         return
+      try:
+         count = self.rollup.write(self.backend)
+         if count:
+            p_debug(f"Updated {count} daily statistics rows.")
+      except self.backend.errors as e:
+         p_err(f"Failed to update the daily statistics: {e}")
+
+   def close(self):
+      """
+      Writes all remaining rows and stops the flusher thread. Reports if the flusher thread failed
+      """
+      try:
+         self.stop()
+      except WriterError as err:
+         p_err(f"Database logging stopped early. Rows logged after the failure were not written. {err}")
+      finally:
+         self.backend.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import msal
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from teamsenum.utils import p_warn, p_debug
+
+# Environment variable with a passphrase for the token cache. Without it, a random key is stored next to the cache file
+KEY_VARIABLE = "TEAMSENUM_TOKEN_CACHE_KEY"
+
+def write_private(filename, data):
+   """
+   Replaces a file atomically with content that only the current user can read
+
+   Args:
+      filename (str): Path of the file
+      data (bytes): New content
+
+   Returns:
+      None
+   """
+   temp = "%s.%d.tmp" % (filename, os.getpid())
+   fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+   with os.fdopen(fd, "wb") as f:
+      f.write(data)
+   os.replace(temp, filename)
+
+class EncryptedTokenCache(msal.SerializableTokenCache):
+   """
+   MSAL token cache that is persisted in an encrypted file, so the refresh token of a previous run allows a silent login.
+   A file can hold the caches of several identities. Each one is stored under a hash of the username and tenant, encrypted with Fernet.
+   The cache is written whenever MSAL adds or renews tokens.
+   """
+
+   def __init__(self, filename, username, tenant):
+      """
+      Constructor that loads the cache of the identity, if the file contains one
+
+      Args:
+         filename (str): Path of the cache file. Created on the first save
+         username (str): Username of the identity
+         tenant (str): Tenant ID of the identity
+
+      Returns:
+         None
+      """
+      super().__init__()
+      self.filename = filename
+      self.identity = hashlib.sha256(("%s|%s" % (username.strip().lower(), tenant)).encode("utf-8")).hexdigest()
+      self.file_lock = threading.Lock()
+      self.salt = None
+      self.entries = {}
+
+      if os.path.isfile(filename):
+         try:
+            with open(filename, encoding="utf-8") as f:
+               content = json.load(f)
+            self.salt = base64.b64decode(content.get('salt'))
+            self.entries = content.get('entries', {})
+         except (OSError, ValueError, TypeError) as err:
+            p_warn("Unable to read the token cache %s: %s. Starting with an empty cache" % (filename, err))
+            self.entries = {}
+      if self.salt is None:
+         self.salt = os.urandom(16)
+      self.fernet = Fernet(self.key())
+
+      if self.identity in self.entries:
+         try:
+            self.deserialize(self.fernet.decrypt(self.entries[self.identity].encode("ascii")).decode("utf-8"))
+            p_debug("Loaded cached tokens from %s" % (filename))
+         except InvalidToken:
+            p_warn("Unable to decrypt the token cache %s. Is %s set to the passphrase it was created with? Starting with an empty cache" % (filename, KEY_VARIABLE))
+
+   def key(self):
+      """
+      Returns the Fernet key, derived from the passphrase in KEY_VARIABLE or read from the key file next to the cache
+
+      Returns:
+         Key (bytes): URL-safe base64 encoded key
+      """
+      passphrase = os.environ.get(KEY_VARIABLE)
+      if passphrase:
+         kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=self.salt, iterations=390000)
+         return base64.urlsafe_b64encode(kdf.derive(passphrase.encode("utf-8")))
+
+      keyfile = self.filename + ".key"
+      if os.path.isfile(keyfile):
+         with open(keyfile, "rb") as f:
+            return f.read().strip()
+      key = Fernet.generate_key()
+      write_private(keyfile, key)
+      return key
+
+   def add(self, event, **kwargs):
+      super().add(event, **kwargs)
+      self.save()
+
+   def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+      super().modify(credential_type, old_entry, new_key_value_pairs)
+      self.save()
+
+   def save(self):
+      """
+      Writes the cache of the identity, keeping the caches of other identities in the file
+      """
+      with self.file_lock:
+         self.entries[self.identity] = self.fernet.encrypt(self.serialize().encode("utf-8")).decode("ascii")
+         content = {'salt': base64.b64encode(self.salt).decode("ascii"), 'entries': self.entries}
+         write_private(self.filename, json.dumps(content).encode("utf-8"))
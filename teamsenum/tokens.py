@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+import base64
+import json
+import threading
+import time
+from teamsenum.utils import p_err, p_info, p_debug
+
+def token_expiry(token):
+   """
+   Reads the expiry time of a JWT access token. The signature is not verified
+
+   Args:
+      token (str): Access token
+
+   Returns:
+      Expiry (int): Unix time of the exp claim, or None for tokens that are not JWTs (e.g. personal account tokens)
+   """
+   try:
+      payload = token.split(".")[1]
+      payload += "=" * (-len(payload) % 4)
+      claims = json.loads(base64.urlsafe_b64decode(payload))
+      return int(claims["exp"])
+   except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+      return None
+
+class TokenManager:
+   """
+   Holds the current access token and renews it before it expires, from a background thread.
+   Workers read the token without locking. Refreshes are serialized, so a burst of 401 responses results in a single refresh.
+   """
+
+   def __init__(self, token, refresher=None, margin=600, retry_interval=60):
+      """
+      Constructor
+
+      Args:
+         token (str): Current access token
+         refresher (function): Called without arguments to acquire a new access token. Returns the token, or None on failure
+         margin (int): Time in [s] before the expiry at which the token is renewed. Above the 300 s in which MSAL renews cached tokens by itself
+         retry_interval (int): Time in [s] after which a failed background refresh is retried
+
+      Returns:
+         None
+      """
+      self.token = token
+      self.expires = token_expiry(token)
+      self.refresher = refresher
+      self.margin = margin
+      self.retry_interval = retry_interval
+      self.lock = threading.Lock()
+      self.stopping = threading.Event()
+      self.thread = None
+      self.refreshes = 0
+
+   def refresh(self, stale=None):
+      """
+      Acquires a new access token. If another thread already replaced the token the caller used, nothing is requested
+
+      Args:
+         stale (str): The token that was rejected. If None, the token is always renewed
+
+      Returns:
+         Success (boolean): True if a token other than the stale one is available. False if the refresher returned the current token
+      """
+      with self.lock:
+         if stale is not None and self.token != stale:
+            return True
+         if not self.refresher:
+            return False
+         token = self.refresher()
+         if not token:
+            return False
+         expires = token_expiry(token)
+         if token == self.token or (expires and self.expires and expires <= self.expires):
+            # A cached token does not help, and renewing it again right away would loop
+            p_debug("The refresher returned the current access token")
+            return False
+         self.token = token
+         self.expires = expires
+         self.refreshes += 1
+         if self.expires:
+            p_debug("Access token renewed. Valid until %s" % (time.strftime("%H:%M:%S", time.localtime(self.expires))))
+         return True
+
+   def start(self):
+      """
+      Starts renewing the token in the background. Only tokens with a known expiry and a refresher are renewed proactively
+      """
+      if not self.refresher or not self.expires or self.thread:
+         return
+      p_info("Access token valid until %s. It is renewed %d seconds before it expires" % (time.strftime("%H:%M:%S", time.localtime(self.expires)), self.margin))
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+   def run(self):
+      while self.expires:
+         if self.stopping.wait(max(0, self.expires - self.margin - time.time())):
+            return
+         try:
+            success = self.refresh(self.token)
+         except BaseException as err:
+            # The MSAL helpers exit on errors, which must not end the refresh thread
+            success = False
+            p_err("Error while renewing the access token: %s" % (err))
+         if not success and self.stopping.wait(self.retry_interval):
+            return
+
+   def stop(self):
+      self.stopping.set()
+      if self.thread:
+         self.thread.join()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+import json
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from teamsenum.endpoints import DEFAULT_TIMEOUTS
+
+# Status codes with which the endpoints ask the client to slow down
+THROTTLED = (429, 503)
+
+class TransientError(Exception):
+   """ Raised when a request failed for a reason that may go away, e.g. a timeout, a dropped connection or a server error """
+
+class SimpleResponse:
+   """
+   Response that was not received through requests, i.e. by the async engine or from the result cache.
+   Exposes the attributes of requests.Response that TeamsUserEnumerator relies on
+   """
+
+   def __init__(self, status_code, text, headers=None):
+      self.status_code = status_code
+      self.text = text
+      self.headers = headers if headers is not None else {}
+
+   def json(self):
+      return json.loads(self.text)
+
+class RetryPolicy:
+   """ Bounded retries with exponential backoff and full jitter, so retries of many workers don't hit the endpoint at the same time """
+
+   def __init__(self, retries=2, base=0.5, cap=10.0):
+      """
+      Constructor
+
+      Args:
+         retries (int): Number of times a failed request is sent again
+         base (float): Backoff in [s] before the first retry. It doubles with every further retry
+         cap (float): Maximum backoff in [s]
+
+      Returns:
+         None
+      """
+      self.retries = max(0, retries)
+      self.base = base
+      self.cap = cap
+
+   def backoff(self, attempt):
+      """
+      Returns a random delay between 0 and the exponential backoff of an attempt
+
+      Args:
+         attempt (int): Number of the retry, starting with 0
+
+      Returns:
+         Delay (float): Time in [s] to wait before the retry
+      """
+      return random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+
+   def retryable(self, status_code, limited=False):
+      """
+      Returns whether a response is worth sending the request again
+
+      Args:
+         status_code (int): Status code of the response
+         limited (boolean): True if the request went through a RateLimiter, which already resent throttled responses
+
+      Returns:
+         Retryable (boolean): True for throttling and server errors
+      """
+      if limited and status_code in THROTTLED:
+         return False
+      return status_code == 429 or status_code >= 500
+
+class EndpointClient:
+   """ HTTP client for libraries that send requests on their own (e.g. MSAL), bound to the timeouts and retries of one endpoint category """
+
+   def __init__(self, pool, endpoint):
+      self.pool = pool
+      self.endpoint = endpoint
+
+   def get(self, url, **kwargs):
+      return self.pool.request("GET", url, endpoint=self.endpoint, **kwargs)
+
+   def post(self, url, **kwargs):
+      return self.pool.request("POST", url, endpoint=self.endpoint, **kwargs)
+
+   def close(self):
+      pass
+
+class HttpPool:
+   """ Keep-alive HTTP session with a connection pool per host, shared by all enumeration threads """
+
+   def __init__(self, pool_size=10, limiter=None, timeouts=None, policy=None):
+      """
+      Constructor that prepares a session whose connection pools can hold one connection per worker thread
+
+      Args:
+         pool_size (int): Maximum number of idle connections kept per host. Should match the number of threads
+         limiter (teamsenum.ratelimit.RateLimiter): Rate limiter that paces all requests. Can also be set later
+         timeouts (dict): (connect, read) timeouts in [s] per endpoint category, overriding DEFAULT_TIMEOUTS
+         policy (RetryPolicy): Retries of timeouts, connection errors and server errors. Defaults to RetryPolicy()
+
+      Returns:
+         None
+      """
+      self.pool_size = max(1, pool_size)
+      self.limiter = limiter
+      self.timeouts = dict(DEFAULT_TIMEOUTS)
+      self.timeouts.update(timeouts or {})
+      self.policy = policy if policy else RetryPolicy()
+      self.retried = 0
+      # Requests that were sent by other clients, i.e. the aiohttp session of the async engine
+      self.external = {'requests': 0, 'connections': 0}
+      self.lock = threading.Lock()
+      self.session = requests.Session()
+      # pool_connections is the number of distinct hosts that are cached, pool_maxsize the number of connections per host
+      adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size)
+      self.session.mount("https://", adapter)
+      self.session.mount("http://", adapter)
+
+   def request(self, method, url, endpoint=None, **kwargs):
+      """
+      Sends a request over the shared session. Accepts the same keyword arguments as requests.request.
+      Timeouts, dropped connections and server errors are retried according to the retry policy. Throttled responses are left to the rate limiter, if there is one.
+
+      Args:
+         method (str): HTTP method
+         url (str): Target URL
+         endpoint (str): Endpoint category (search, presence or auth) whose timeouts apply, unless a timeout is passed
+
+      Returns:
+         Response (requests.Response): The response of the request. After the last retry, this may be an error response
+
+      Raises:
+         TransientError: If the request timed out or the connection failed on every attempt
+      """
+      kwargs.setdefault('timeout', self.timeouts.get(endpoint, DEFAULT_TIMEOUTS['search']))
+      for attempt in range(self.policy.retries + 1):
+         try:
+            response = self.send(method, url, **kwargs)
+         except (requests.Timeout, requests.ConnectionError) as err:
+            if attempt == self.policy.retries:
+               raise TransientError("%s %s failed: %s" % (method, url, err)) from err
+         else:
+            if attempt == self.policy.retries or not self.policy.retryable(response.status_code, self.limiter is not None):
+               return response
+         with self.lock:
+            self.retried += 1
+         time.sleep(self.policy.backoff(attempt))
+
+   def send(self, method, url, **kwargs):
+      if not self.limiter:
+         return self.session.request(method, url, **kwargs)
+
+      # Throttled requests are sent again once the pause requested by the server is over
+      for attempt in range(self.limiter.max_retries + 1):
+         self.limiter.acquire()
+         response = None
+         try:
+            response = self.session.request(method, url, **kwargs)
+         finally:
+            throttled = self.limiter.release(response.status_code if response is not None else None, response.headers if response is not None else None)
+         if not throttled:
+            break
+      return response
+
+   def get(self, url, **kwargs):
+      return self.request("GET", url, **kwargs)
+
+   def post(self, url, **kwargs):
+      return self.request("POST", url, **kwargs)
+
+   def client(self, endpoint):
+      """
+      Returns an HTTP client for libraries that expect a requests-like object, bound to an endpoint category
+
+      Args:
+         endpoint (str): Endpoint category whose timeouts apply
+
+      Returns:
+         Client (EndpointClient): Client with get() and post() methods
+      """
+      return EndpointClient(self, endpoint)
+
+   def stats(self):
+      """
+      Collects connection reuse statistics from the underlying connection pools, including the requests added by add_stats()
+
+      Returns:
+         Statistics (dict): Number of requests sent, TCP/TLS connections opened, requests served over an already open connection and retried requests
+      """
+      requests_sent = 0
+      connections = 0
+      for adapter in set(self.session.adapters.values()):
+         pools = adapter.poolmanager.pools
+         for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+               requests_sent += pool.num_requests
+               connections += pool.num_connections
+      requests_sent += self.external['requests']
+      connections += self.external['connections']
+      return {
+         'requests': requests_sent,
+         'connections': connections,
+         'reused': max(0, requests_sent - connections),
+         'retried': self.retried
+      }
+
+   def add_stats(self, requests_sent=0, connections=0, retried=0):
+      """
+      Adds the requests of another HTTP client to the statistics
+
+      Args:
+         requests_sent (int): Number of requests sent
+         connections (int): Number of TCP/TLS connections opened
+         retried (int): Number of retried requests
+
+      Returns:
+         None
+      """
+      with self.lock:
+         self.external['requests'] += requests_sent
+         self.external['connections'] += connections
+         self.retried += retried
+
+   def close(self):
+      self.session.close()
+
+_default_pool = None
+_default_lock = threading.Lock()
+
+def get_pool(pool_size=None):
+   """
+   Returns the process-wide HTTP pool, creating it on first use
+
+   Args:
+      pool_size (int): Connections per host, used only when the pool is created by this call
+
+   Returns:
+      HTTP pool (HttpPool): The shared pool
+   """
+   global _default_pool
+   with _default_lock:
+      if _default_pool is None:
+         _default_pool = HttpPool(pool_size if pool_size else 10)
+      return _default_pool
@@ -9,9 +9,30 @@ import errno
 import re
 import hashlib
 from html import unescape
-import mysql.connector
-from mysql.connector import Error
 import configparser
+from teamsenum.console import get_console, DEBUG, INFO, WARN, ERROR
+from teamsenum.output import ResultWriter, PresenceParquetWriter
+
+def p_emit(level, prefix, msg, exit=False, exitcode=0, end="\n"):
+   """
+   Hands a message to the console writer and exits if requested. Messages that end the program are always shown.
+
+   Args:
+       level (int): Console level of the message
+       prefix (str): Colored prefix of the message
+       msg (str): The message to be printed.
+       exit (boolean): If True, exits after printing the message
+       exitcode (int): If exit is True, exit program using this exit code
+       end (str): Line terminator after printing. Defaults to newline
+
+   Returns:
+       None
+   """
+   console = get_console()
+   console.emit(max(level, ERROR) if exit else level, prefix, msg, end)
+   if exit:
+      console.flush()
+      sys.exit(exitcode)
 
 def p_err(msg, exit=False, exitcode=1, end="\n"):
    """
@@ -26,8 +47,7 @@ def p_err(msg, exit=False, exitcode=1, end="\n"):
    Returns:
        None
    """
-   print(Fore.RED + "[-] ", end='')
-   p_normal(msg, exit, exitcode, end)
+   p_emit(ERROR, Fore.RED + "[-] ", msg, exit, exitcode, end)
 
 def p_warn(msg, exit=False, exitcode=1, end="\n"):
    """
@@ -42,8 +62,7 @@ def p_warn(msg, exit=False, exitcode=1, end="\n"):
    Returns:
        None
    """
-   print(Fore.YELLOW + "[-] ", end='')
-   p_normal(msg, exit, exitcode, end)
+   p_emit(WARN, Fore.YELLOW + "[-] ", msg, exit, exitcode, end)
 
 def p_success(msg, exit=False, exitcode=0, end="\n"):
    """
@@ -58,8 +77,7 @@ def p_success(msg, exit=False, exitcode=0, end="\n"):
    Returns:
        None
    """
-   print(Fore.GREEN + "[+] ", end='')
-   p_normal(msg, exit, exitcode, end)
+   p_emit(INFO, Fore.GREEN + "[+] ", msg, exit, exitcode, end)
 
 def p_info(msg, exit=False, exitcode=0, end="\n"):
    """
@@ -74,8 +92,21 @@ def p_info(msg, exit=False, exitcode=0, end="\n"):
    Returns:
        None
    """
-   print(Fore.CYAN + "[~] ", end='')
-   p_normal(msg, exit, exitcode, end)
+   p_emit(INFO, Fore.CYAN + "[~] ", msg, exit, exitcode, end)
+
+def p_debug(msg, end="\n"):
+   """
+   Prints a string only if verbose output is enabled (-v). The message is converted to a string by the console writer,
+   so dicts and lists can be passed as they are.
+
+   Args:
+       msg (object): The message to be printed.
+       end (str): Line terminator after printing. Defaults to newline
+
+   Returns:
+       None
+   """
+   p_emit(DEBUG, Style.DIM + "[*] ", msg, end=end)
 
 def p_normal(msg, exit=False, exitcode=0, end="\n"):
    """
@@ -90,10 +121,7 @@ def p_normal(msg, exit=False, exitcode=0, end="\n"):
    Returns:
        None
    """
-   print(msg, end='')
-   print(Style.RESET_ALL, end=end)
-   if exit:
-      sys.exit(exitcode)
+   p_emit(INFO, "", msg, exit, exitcode, end)
 
 def p_file(msg, fd=None):
    """
@@ -101,32 +129,33 @@ def p_file(msg, fd=None):
 
    Args:
        msg (str): The message to be written into a file.
-       fd (_io.TextIOWrapper): File descriptor used for file write
+       fd (teamsenum.output.ResultWriter): Result writer, or any file object
 
    Returns:
        None
    """
    if fd is None:
       return
-   fd.write(msg)
-   fd.write("\n")
-   fd.flush()
+   # A single write per line. With a ResultWriter, the line is queued and written in a batch by the writer thread
+   fd.write(msg + "\n")
 
-def open_file(filename):
+def open_file(filename, format="jsonl"):
    """
-   Prints a string.
+   Opens the output file. Files ending with .gz or .zst are compressed.
 
    Args:
        filename (str): Name of the file that is used for logging the results
+       format (str): Either 'jsonl' for JSON lines, or 'parquet' for a Parquet file of presence observations
 
    Returns:
-       File descriptor (_io.TextIOWrapper): File descriptor that is later used for write operations
+       Result writer (teamsenum.output.ResultWriter or PresenceParquetWriter): Writer that is later used for write operations. Must be closed to write the remaining lines
    """
    try:
       os.stat(filename)
       overwrite = ""
       while overwrite not in ["y","n"]:
          p_warn("The output file already exists. Overwrite? (y/n): ", end='')
+         get_console().flush()
          overwrite = input()
       if overwrite == "n":
          p_warn("Output file will not be overwritten. Please choose another file", True, 1)
@@ -135,12 +164,17 @@ def open_file(filename):
       pass
 
    try:
-      fd = open(filename, 'w')
+      fd = PresenceParquetWriter(filename) if format == "parquet" else ResultWriter(filename)
    except IOError as err:
       if err.errno == errno.EACCES:
          p_warn("No permissions to write output file", True, 1)
       elif err.errno == errno.EISDIR:
          p_warn("Output file is a directory", True, 1)
+      p_warn("Unable to open output file: %s" % (err), True, 1)
+   except ImportError:
+      if format == "parquet":
+         p_warn("Parquet output requires the pyarrow package. Install it with: pip3 install pyarrow", True, 1)
+      p_warn("Writing .zst files requires the zstandard package. Install it with: pip3 install zstandard", True, 1)
 
    return fd
 
@@ -157,20 +191,31 @@ def check_db_conf(file_path="db.conf"):
     """
     # Check if db.conf exists
     if not os.path.isfile(file_path):
-        print(f"Error: Configuration file '{file_path}' does not exist.")
+        p_err(f"Configuration file '{file_path}' does not exist.")
         return None
 
     # Parse db.conf
     config = configparser.ConfigParser()
     config.read(file_path)
 
+    # An embedded SQLite database only needs a path. Table names default to the ones of db_schema.sql
+    if 'sqlite' in config:
+        return {
+            "backend": "sqlite",
+            "path": config['sqlite'].get('path', 'teamsenum.db'),
+            "presence_table": config['sqlite'].get('presence_table', 'user_presence'),
+            "ooo_table": config['sqlite'].get('ooo_table', 'user_ooo'),
+            "user_info_table": config['sqlite'].get('user_info_table', 'user_info_all')
+        }
+
     if 'mysql' not in config:
-        print(f"Error: Section [mysql] not found in '{file_path}'.")
+        p_err(f"Section [mysql] or [sqlite] not found in '{file_path}'.")
         return None
 
     # Get connection info
     try:
         db_config = {
+            "backend": "mysql",
             "host": config['mysql']['host'],
             "user": config['mysql']['user'],
             "password": config['mysql']['password'],
@@ -181,161 +226,141 @@ def check_db_conf(file_path="db.conf"):
         }
         return db_config
     except KeyError as e:
-        print(f"Error: Missing key {e} in '{file_path}'.")
+        p_err(f"Missing key {e} in '{file_path}'.")
         return None
 
-def log_ooo_db(db_config, teams_guid, raw_message):
+def ooo_query(db_config):
     """
-    Logs the OOO message to the database if it's unique.
+    Returns the INSERT statement for OOO messages.
     """
-    try:
-        # Calculate MD5 hash and sanitize/truncate the message
-        md5sum = calculate_md5(raw_message)
-        sanitized_text, truncated = sanitize_and_truncate(raw_message)
-        message_length = len(raw_message)
-
-        print(f"MD5: {md5sum}, Length: {message_length}, Truncated: {truncated}")
-
-        # Current timestamp details
-        now = datetime.now()
-        current_date = now.strftime('%Y-%m-%d')
-        current_time = now.strftime('%H:%M:%S')
-        unix_timestamp = int(now.timestamp())
-
-        connection = mysql.connector.connect(
-            host=db_config["host"],
-            user=db_config["user"],
-            password=db_config["password"],
-            database=db_config["database"]
-        )
-
-        if connection.is_connected():
-            cursor = connection.cursor()
-
-        ooo_table=db_config["ooo_table"]
-        # SQL query to insert the OOO message
-        query = f"""
-            INSERT IGNORE INTO {ooo_table} (
-                md5sum, teams_guid, scrape_date, scrape_time, scrape_date_unix, length, truncated, text
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        values = (md5sum, teams_guid, current_date, current_time, unix_timestamp, message_length, int(truncated), sanitized_text)
-
-        # Execute the query
-        cursor.execute(query, values)
-        connection.commit()
-        print("OOO message logged successfully.")
-        return True
-    except Error as e:
-        print(f"Failed to log presence data: {e}")
-        return False
-    finally:
-        if connection.is_connected():
-            connection.close()
-
-
-
-def log_userinfo_db(db_config, content_text):
+    ooo_table=db_config["ooo_table"]
+    return f"""
+        INSERT IGNORE INTO {ooo_table} (
+            md5sum, teams_guid, scrape_date, scrape_time, scrape_date_unix, length, truncated, text
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
     """
-    Parses content_text, extracts user information, and logs it to the database.
+
+def ooo_row(teams_guid, raw_message):
     """
-    try:
-        # Split the content into separate JSON-like parts
-        content_parts = content_text.split("\n")
-        if len(content_parts) < 1:
-            raise ValueError("Invalid format: Expected at least one JSON object.")
-
-        # Parse the first part as the user information
-        user_info = json.loads(content_parts[0].strip())  # Ensure it's parsed as JSON
-
-        # Parse the second part as presence information (optional)
-        presence_info = None
-        if len(content_parts) > 1:
-            try:
-                presence_info = json.loads(content_parts[1].strip())
-            except json.JSONDecodeError:
-                print("Second part is not valid JSON, skipping presence information.")
-
-        # Prepare database connection
-        now = datetime.now()
-        current_date = now.strftime('%Y-%m-%d')
-        current_time = now.strftime('%H:%M:%S')
-        unix_timestamp = int(now.timestamp())
-
-        connection = mysql.connector.connect(
-            host=db_config["host"],
-            user=db_config["user"],
-            password=db_config["password"],
-            database=db_config["database"]
-        )
-
-        if connection.is_connected():
-            cursor = connection.cursor()
-
-        # Process each user in the user_info list
-        for user in user_info:
-            object_id = user.get("objectId")
-            user_principal_name = user.get("userPrincipalName")
-
-            # Essential fields must be present
-            if not object_id or not user_principal_name:
-                print(f"Skipping entry. Missing essential fields: {user}")
-                continue
-
-            # Non-essential fields
-            email = user.get("email", None)
-            display_name = user.get("displayName", None)
-            tenant_id = user.get("tenantId", None)
-            co_existence_mode = user.get("featureSettings", {}).get("coExistenceMode", None)
-            given_name = user.get("givenName", None)
-            surname = user.get("surname", None)
-            account_enabled = user.get("accountEnabled", None)
-            tenant_name = user.get("tenantName", None)
-            country = user.get("Country", None)
-            city = user.get("City", None)
-
-
-            # SQL query to insert the user info with INSERT IGNORE
-            query = """
-                INSERT IGNORE INTO user_info_all (
-                    object_id, user_principal_name, email, display_name, tenant_id,
-                    co_existence_mode, given_name, surname, account_enabled, tenant_name,
-                    country, city, scrape_date, scrape_time, scrape_date_unix
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            values = (
-                object_id, user_principal_name, email, display_name, tenant_id,
-                co_existence_mode, given_name, surname, account_enabled, tenant_name,
-                country, city, current_date, current_time, unix_timestamp
-            )
-
-            # Execute the query
-            cursor.execute(query, values)
-
-        connection.commit()
-        print("User information logged successfully.")
-        return True
-
-    except Error as e:
-        print(f"Failed to log user information: {e}")
-        return False
-    except json.JSONDecodeError as e:
-        print(f"Failed to parse JSON: {e}")
-        return False
-    except ValueError as e:
-        print(f"Invalid format: {e}")
-        return False
-    finally:
-        if connection.is_connected():
-            connection.close()
-
-
-def log_presence_db(db_config, teams_guid, availability, ooo_enabled, device, scrape_date_unix, scrape_date, hh_period, qh_period, session):
+    Builds the values of an OOO message row.
+
+    Args:
+        teams_guid (str): GUID of the user.
+        raw_message (str): OOO message, as returned by the presence endpoint.
+
+    Returns:
+        tuple: Values in the column order of ooo_query().
     """
-    Logs user presence data into the MySQL database.
+    # Calculate MD5 hash and sanitize/truncate the message
+    md5sum = calculate_md5(raw_message)
+    sanitized_text, truncated = sanitize_and_truncate(raw_message)
+    message_length = len(raw_message)
+
+    p_debug(f"MD5: {md5sum}, Length: {message_length}, Truncated: {truncated}")
+
+    # Current timestamp details
+    now = datetime.now()
+    current_date = now.strftime('%Y-%m-%d')
+    current_time = now.strftime('%H:%M:%S')
+    unix_timestamp = int(now.timestamp())
+
+    return (md5sum, teams_guid, current_date, current_time, unix_timestamp, message_length, int(truncated), sanitized_text)
+
+def userinfo_query(db_config):
+    """
+    Returns the INSERT statement for user information.
+    """
+    user_info_table=db_config.get("user_info_table", "user_info_all")
+    return f"""
+        INSERT IGNORE INTO {user_info_table} (
+            object_id, user_principal_name, email, display_name, tenant_id,
+            co_existence_mode, given_name, surname, account_enabled, tenant_name,
+            country, city, scrape_date, scrape_time, scrape_date_unix
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+
+def userinfo_rows(content_text):
+    """
+    Parses content_text and builds one user information row per user.
+
+    Args:
+        content_text (str): Body of the externalsearchv3 response.
+
+    Returns:
+        list: Tuples of values in the column order of userinfo_query().
+
+    Raises:
+        ValueError: If the content doesn't contain user information.
+        json.JSONDecodeError: If the content is not valid JSON.
+    """
+    # Split the content into separate JSON-like parts
+    content_parts = content_text.split("\n")
+    if len(content_parts) < 1:
+        raise ValueError("Invalid format: Expected at least one JSON object.")
+
+    # Parse the first part as the user information
+    user_info = json.loads(content_parts[0].strip())  # Ensure it's parsed as JSON
+
+    now = datetime.now()
+    current_date = now.strftime('%Y-%m-%d')
+    current_time = now.strftime('%H:%M:%S')
+    unix_timestamp = int(now.timestamp())
+
+    rows = []
+    # Process each user in the user_info list
+    for user in user_info:
+        object_id = user.get("objectId")
+        user_principal_name = user.get("userPrincipalName")
+
+        # Essential fields must be present
+        if not object_id or not user_principal_name:
+            p_debug(f"Skipping entry. Missing essential fields: {user}")
+            continue
+
+        # Non-essential fields
+        email = user.get("email", None)
+        display_name = user.get("displayName", None)
+        tenant_id = user.get("tenantId", None)
+        co_existence_mode = user.get("featureSettings", {}).get("coExistenceMode", None)
+        given_name = user.get("givenName", None)
+        surname = user.get("surname", None)
+        account_enabled = user.get("accountEnabled", None)
+        tenant_name = user.get("tenantName", None)
+        country = user.get("Country", None)
+        city = user.get("City", None)
+
+        rows.append((
+            object_id, user_principal_name, email, display_name, tenant_id,
+            co_existence_mode, given_name, surname, account_enabled, tenant_name,
+            country, city, current_date, current_time, unix_timestamp
+        ))
+
+    return rows
+
+def presence_query(db_config):
+    """
+    Returns the INSERT statement for presence data.
+    """
+    presence_table=db_config["presence_table"]
+    return f"""
+        INSERT INTO {presence_table} (
+            teams_guid,
+            availability,
+            ooo_enabled,
+            device,
+            scrape_date_unix,
+            scrape_date,
+            hh_period,
+            qh_period,
+            session
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+
+def presence_row(teams_guid, availability, ooo_enabled, device, scrape_date_unix, scrape_date, hh_period, qh_period, session):
+    """
+    Builds the values of a presence row.
 
     Args:
-        db_config (dict): A dictionary containing database configuration values.
         teams_guid (str): GUID of the user.
         availability (str): User status (e.g., 'away', 'busy').
         ooo_enabled (bool): Out of office status (True = 1, False = 0).
@@ -344,61 +369,22 @@ def log_presence_db(db_config, teams_guid, availability, ooo_enabled, device, sc
         scrape_date (str): Date in YYYY-MM-DD format.
         hh_period (int): Half-hour period (0-47).
         qh_period (int): Quarter-hour period (0-95).
+        session (str): Identifier of the enumeration run.
 
     Returns:
-        bool: True if the data is logged successfully, False otherwise.
+        tuple: Values in the column order of presence_query().
     """
-    try:
-        connection = mysql.connector.connect(
-            host=db_config["host"],
-            user=db_config["user"],
-            password=db_config["password"],
-            database=db_config["database"]
-        )
-
-
-        if connection.is_connected():
-            cursor = connection.cursor()
-
-            presence_table=db_config["presence_table"]
-
-            # SQL query to insert presence data
-            query = f"""
-                INSERT INTO {presence_table} (
-                    teams_guid,
-                    availability,
-                    ooo_enabled,
-                    device,
-                    scrape_date_unix,
-                    scrape_date,
-                    hh_period,
-                    qh_period,
-                    session
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-
-            # Execute query with provided values
-            cursor.execute(query, (
-                teams_guid,
-                availability,
-                int(ooo_enabled),  # Convert bool to int
-                device,
-                scrape_date_unix,
-                scrape_date,
-                hh_period,
-                qh_period,
-                session
-            ))
-            connection.commit()
-            print("Presence data logged successfully.")
-            return True
-    except Error as e:
-        print(f"Failed to log presence data: {e}")
-        return False
-    finally:
-        if connection.is_connected():
-            connection.close()
-
+    return (
+        teams_guid,
+        availability,
+        int(ooo_enabled),  # Convert bool to int
+        device,
+        scrape_date_unix,
+        scrape_date,
+        hh_period,
+        qh_period,
+        session
+    )
 
 def remove_html_preserve_newlines(text):
     """Removes HTML tags from text while preserving newlines."""
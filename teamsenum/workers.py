@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+import collections
+import queue
+import threading
+import time
+from teamsenum.utils import p_err, p_warn, p_info
+from teamsenum.transport import RetryPolicy
+
+class WorkerPool:
+   """ Fixed set of worker threads that pull targets from a bounded queue. A new target is started as soon as any worker becomes free """
+
+   def __init__(self, worker, num_threads=7, delay=0, max_retries=0, on_done=None, on_failed=None, policy=None):
+      """
+      Constructor that prepares the pool. The threads are started by run()
+
+      Args:
+         worker (function): Called as worker(item) for each target
+         num_threads (int): Number of worker threads
+         delay (float): Delay in [s] between starting two targets, across all workers
+         max_retries (int): Number of times a target is retried after its worker raised an exception
+         on_done (function): Called as on_done(item) after a target was enumerated successfully
+         on_failed (function): Called as on_failed(item) after a target failed on its last attempt
+         policy (teamsenum.transport.RetryPolicy): Provides the jittered backoff before a target is retried
+
+      Returns:
+         None
+      """
+      self.worker = worker
+      self.num_threads = max(1, num_threads)
+      self.delay = delay
+      self.max_retries = max_retries
+      self.on_done = on_done
+      self.on_failed = on_failed
+      self.policy = policy if policy else RetryPolicy()
+
+      self.queue = queue.Queue(maxsize=self.num_threads * 2)
+      # Failed targets are queued separately, so that a worker never blocks on the bounded queue
+      self.retry_queue = collections.deque()
+      self.stopping = threading.Event()
+      self.lock = threading.Lock()
+      self.next_start = 0
+      self.exit_code = None
+
+      self.done = 0
+      self.failed = 0
+      self.retried = 0
+
+   def pace(self):
+      """
+      Waits until the next start slot, so that targets are started at most once per delay, regardless of the number of workers
+      """
+      if not self.delay:
+         return
+      with self.lock:
+         now = time.monotonic()
+         start = max(now, self.next_start)
+         self.next_start = start + self.delay
+      time.sleep(start - now)
+
+   def next_item(self):
+      try:
+         return self.retry_queue.popleft()
+      except IndexError:
+         return self.queue.get()
+
+   def process(self, item, attempt):
+      if attempt:
+         # Back off before a retry, so that targets that failed together aren't retried together
+         time.sleep(self.policy.backoff(attempt - 1))
+      self.pace()
+      try:
+         self.worker(item)
+         if self.on_done:
+            self.on_done(item)
+         with self.lock:
+            self.done += 1
+      except SystemExit as err:
+         # A worker requested to terminate the program, e.g. because the access token is invalid. Stop handing out new targets
+         with self.lock:
+            self.failed += 1
+            if self.exit_code is None:
+               self.exit_code = err.code
+         self.stopping.set()
+      except Exception as err:
+         if attempt < self.max_retries and not self.stopping.is_set():
+            p_warn("Error while enumerating %s: %s. Retrying..." % (str(item).strip(), err))
+            with self.lock:
+               self.retried += 1
+            self.retry_queue.append((item, attempt + 1))
+         else:
+            p_err("Error while enumerating %s: %s" % (str(item).strip(), err))
+            with self.lock:
+               self.failed += 1
+            if self.on_failed:
+               self.on_failed(item)
+
+   def run_worker(self):
+      while True:
+         entry = self.next_item()
+         if entry is None:
+            # Retries that were queued by other workers after the end of the input still need to be processed
+            if self.retry_queue and not self.stopping.is_set():
+               self.queue.put(None)
+               continue
+            return
+         if self.stopping.is_set():
+            continue
+         item, attempt = entry
+         self.process(item, attempt)
+
+   def run(self, items):
+      """
+      Enumerates all items and blocks until they are done. On Ctrl-C, no new targets are started, but running ones are allowed to finish.
+
+      Args:
+         items (iterable): Targets that are handed to the worker
+
+      Returns:
+         Summary (dict): Number of targets done, failed and retried, and whether the run was interrupted
+      """
+      threads = []
+      for i in range(self.num_threads):
+         thread = threading.Thread(target=self.run_worker, daemon=True)
+         thread.start()
+         threads.append(thread)
+
+      try:
+         for item in items:
+            if self.stopping.is_set():
+               break
+            self.queue.put((item, 0))
+      except KeyboardInterrupt:
+         p_warn("Interrupted. Waiting for running requests to finish (press Ctrl-C again to abort)...")
+         self.stopping.set()
+
+      for thread in threads:
+         self.queue.put(None)
+
+      try:
+         for thread in threads:
+            thread.join()
+      except KeyboardInterrupt:
+         p_warn("Aborted", exit=True)
+
+      summary = {'done': self.done, 'failed': self.failed, 'retried': self.retried, 'interrupted': self.stopping.is_set()}
+      p_info("Done: %d, failed: %d, retried: %d" % (summary.get('done'), summary.get('failed'), summary.get('retried')))
+
+      if self.exit_code is not None:
+         raise SystemExit(self.exit_code)
+
+      return summary